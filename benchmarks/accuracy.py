@@ -0,0 +1,284 @@
+"""Accuracy versus cost of the engines, measured on models with known
+solutions:
+
+decay        : A -> 0, as in examples/degradation_ode.py.  The mean is
+               q0 exp(-k t), and the number of molecules is binomial.
+birth_death  : 0 <-> A, as in examples/birth_death.py.  The mean is
+               (kb/kd)(1 - exp(-kd t)) starting from zero, and the
+               stationary distribution is Poisson with mean kb/kd.
+diffusion_1d : free diffusion on a CompartmentArray1D, starting with
+               all molecules in the first compartment.  The exact
+               solution of the compartment model is obtained from the
+               eigenvectors of the (reflecting) discrete Laplacian:
+               cos(pi m (i + 1/2) / K), with eigenvalues
+               -2 d (1 - cos(pi m / K)).
+
+Every ODE method of solve_ivp is run at a range of tolerances, and the
+Gillespie engine with a range of ensemble sizes (for the mean) and
+trajectory lengths (for the stationary distribution).  The error is:
+
+ODE and SSA ensembles : max |q - q_ref| / max |q_ref|, over all
+                        quantities and times
+SSA stationary        : total variation distance between the sampled
+                        and the exact distribution
+
+Each record contains the wall time, and pareto() returns the records
+that are not beaten in both error and time by another record.
+
+Usage:
+
+python -m benchmarks.accuracy --out accuracy.json
+python -m benchmarks.accuracy --quick --models decay birth_death
+
+(from the root directory of the repository, with src/ in PYTHONPATH)
+"""
+
+from openrxn.reactions import Reaction, Species
+from openrxn.model import Model
+from openrxn.compartments.compartment import Compartment
+from openrxn.compartments.arrays import CompartmentArray1D
+from openrxn.connections import IsotropicConnection
+from openrxn.systems.ODESystem import ODESystem
+from openrxn.systems.GillespieSystem import GillespieSystem
+from openrxn.systems.reporters import AllReporter
+from openrxn import unit
+
+from scipy.stats import poisson
+import numpy as np
+import argparse
+import json
+import time
+
+ODE_METHODS = ['RK23','RK45','DOP853','Radau','BDF','LSODA']
+RTOLS = [1e-3,1e-5,1e-7,1e-9]
+ENSEMBLE_SIZES = [10,100,1000]
+STATIONARY_TIMES = [1e2,1e3,1e4]
+
+class Reference(object):
+    """A model with a known solution.  Subclasses set self.flat_model,
+    self.q0 and self.times, and define mean(t), which returns the exact
+    mean of each quantity at the times t, as an array of shape (N, T)."""
+
+    stationary = None
+
+    def mean(self, t):
+        raise NotImplementedError
+
+class Decay(Reference):
+
+    name = 'decay'
+
+    def __init__(self, k=0.1, q0=20, total_time=30):
+        A = Species('A')
+        c = Compartment('main')
+        c.add_rxn_to_compartment(Reaction('degradation',[A],[],[1],[],kf=k/unit.sec))
+        self.flat_model = Model(compartments=[c]).flatten()
+        self.k = k
+        self.q0 = np.array([q0],dtype=float)
+        self.times = np.linspace(0,total_time,31)
+
+    def mean(self, t):
+        return self.q0[:,None]*np.exp(-self.k*np.asarray(t))[None,:]
+
+class BirthDeath(Reference):
+
+    name = 'birth_death'
+
+    def __init__(self, kd=0.1, kb=1.0, total_time=100):
+        A = Species('A')
+        c = Compartment('main')
+        c.add_rxn_to_compartment(Reaction('birth_and_death',[A],[],[1],[],
+                                          kf=kd/unit.sec,kr=kb/unit.sec))
+        self.flat_model = Model(compartments=[c]).flatten()
+        self.kd = kd
+        self.kb = kb
+        self.q0 = np.zeros(1)
+        self.times = np.linspace(0,total_time,51)
+
+    def mean(self, t):
+        return (self.kb/self.kd)*(1 - np.exp(-self.kd*np.asarray(t)))[None,:]
+
+    def stationary(self, n):
+        return poisson.pmf(n,self.kb/self.kd)
+
+class Diffusion1D(Reference):
+
+    name = 'diffusion_1d'
+
+    def __init__(self, K=20, d=0.16, n0=100, total_time=200):
+        A = Species('A')
+        boundaries = np.linspace(0,1,K+1)*unit.mm
+        arr = CompartmentArray1D('main',boundaries,IsotropicConnection({A.ID : d/unit.sec},dim=1))
+        self.flat_model = Model(arrays=[arr]).flatten()
+
+        self.K = K
+        self.d = d
+        self.q0 = np.zeros(K)
+        self.q0[0] = n0
+        self.times = np.linspace(0,total_time,41)
+
+        # orthonormal eigenvectors of the reflecting Laplacian
+        m = np.arange(K)
+        i = np.arange(K)
+        V = np.cos(np.pi*np.outer(i + 0.5,m)/K)
+        V /= np.linalg.norm(V,axis=0)
+        self.V = V
+        self.lam = -2*d*(1 - np.cos(np.pi*m/K))
+
+    def mean(self, t):
+        coef = self.V.T.dot(self.q0)
+        return self.V.dot(coef[:,None]*np.exp(np.outer(self.lam,np.asarray(t))))
+
+REFERENCES = {'decay' : Decay,
+              'birth_death' : BirthDeath,
+              'diffusion_1d' : Diffusion1D}
+
+def _order(system, ref):
+    # the indices of the state vector, in the order of the
+    # compartments of the reference (main-0, main-1, ...)
+    tags = list(system.state.index.keys())
+    if len(tags) == 1:
+        return np.array([system.state.index[tags[0]]['A']])
+    return np.array([system.state.index['main-{0}'.format(i)]['A'] for i in range(len(tags))])
+
+def relative_error(q, q_ref):
+    return float(np.max(np.abs(q - q_ref))/np.max(np.abs(q_ref)))
+
+def ode_record(ref, method, rtol):
+    """Integrates the reference model with solve_ivp, and returns the
+    error and wall time."""
+
+    system = ODESystem(ref.flat_model)
+    idx = _order(system,ref)
+    system.state.q_val[:] = 0
+    system.state.q_val[idx] = ref.q0
+
+    atol = float(rtol*max(1.0,np.max(ref.q0))*1e-3)
+    t0 = time.perf_counter()
+    result = system.propagate((ref.times[0],ref.times[-1]),t_eval=ref.times,
+                              method=method,rtol=rtol,atol=atol)
+    wall = time.perf_counter() - t0
+
+    return {'model' : ref.name,
+            'engine' : 'ode',
+            'setting' : {'method' : method, 'rtol' : rtol, 'atol' : atol},
+            'wall_time' : wall,
+            'rhs_evals' : int(result.nfev),
+            'error' : relative_error(result.y[idx],ref.mean(ref.times)),
+            'metric' : 'mean'}
+
+def _ssa_trajectory(ref, freq, total_time):
+    system = GillespieSystem(ref.flat_model)
+    idx = _order(system,ref)
+    system.state.q_val[:] = 0
+    system.state.q_val[idx] = ref.q0
+    rep = AllReporter(freq=freq)
+    system.add_reporter(rep)
+    system.run(total_time)
+    return rep.values()[:,idx].T
+
+def ssa_ensemble_record(ref, n_runs, seed=0):
+    """Compares the mean of an ensemble of Gillespie trajectories with
+    the exact mean."""
+
+    np.random.seed(seed)
+    freq = ref.times[1] - ref.times[0]
+    t0 = time.perf_counter()
+    total = 0
+    for r in range(n_runs):
+        total = total + _ssa_trajectory(ref,freq,ref.times[-1])
+    wall = time.perf_counter() - t0
+    mean = total/n_runs
+
+    # the reporters are called at t = freq, 2*freq, ...
+    times = ref.times[1:]
+    return {'model' : ref.name,
+            'engine' : 'ssa',
+            'setting' : {'n_runs' : n_runs},
+            'wall_time' : wall,
+            'error' : relative_error(mean[:,:len(times)],ref.mean(times)),
+            'metric' : 'mean'}
+
+def ssa_stationary_record(ref, total_time, burn_in=100, seed=0):
+    """Compares the distribution sampled (once per unit time) along a
+    single long Gillespie trajectory with the exact stationary
+    distribution."""
+
+    np.random.seed(seed)
+    t0 = time.perf_counter()
+    samples = _ssa_trajectory(ref,1.0,burn_in + total_time)[0,burn_in:]
+    wall = time.perf_counter() - t0
+
+    n_max = int(max(samples.max(),3*ref.kb/ref.kd)) + 1
+    n = np.arange(n_max+1)
+    hist = np.bincount(samples.astype(int),minlength=n_max+1)[:n_max+1]/len(samples)
+    exact = ref.stationary(n)
+    tv = 0.5*(np.abs(hist - exact).sum() + (1 - exact.sum()))
+
+    return {'model' : ref.name,
+            'engine' : 'ssa',
+            'setting' : {'total_time' : total_time},
+            'wall_time' : wall,
+            'error' : float(tv),
+            'metric' : 'stationary'}
+
+def pareto(records):
+    """Returns the records that are on the Pareto front of error
+    vs. wall time (for each model and metric), sorted by wall time."""
+
+    front = []
+    groups = {}
+    for r in records:
+        groups.setdefault((r['model'],r['metric']),[]).append(r)
+
+    for key, group in groups.items():
+        group = sorted(group,key=lambda r: (r['wall_time'],r['error']))
+        best = np.inf
+        for r in group:
+            if r['error'] < best:
+                front.append(r)
+                best = r['error']
+    return front
+
+def run_all(models=None, methods=ODE_METHODS, rtols=RTOLS, ensemble_sizes=ENSEMBLE_SIZES,
+            stationary_times=STATIONARY_TIMES):
+    """Runs every engine and setting on each reference model, and
+    returns a dictionary with all of the records, and the Pareto
+    front."""
+
+    records = []
+    for name, ref_class in REFERENCES.items():
+        if models is not None and name not in models:
+            continue
+        ref = ref_class()
+
+        for method in methods:
+            for rtol in rtols:
+                records.append(ode_record(ref,method,rtol))
+        for n_runs in ensemble_sizes:
+            records.append(ssa_ensemble_record(ref,n_runs))
+        if ref.stationary is not None:
+            for total_time in stationary_times:
+                records.append(ssa_stationary_record(ref,total_time))
+
+    for r in records:
+        print("{0:>14s} {1:>4s} {2:<45s} error {3:9.3e}  time {4:9.4f} s".format(
+            r['model'],r['engine'],json.dumps(r['setting']),r['error'],r['wall_time']))
+
+    return {'records' : records, 'pareto' : pareto(records)}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Accuracy vs. cost of the OpenRXN engines.")
+    parser.add_argument('--out',default='accuracy_results.json')
+    parser.add_argument('--models',nargs='*',default=None)
+    parser.add_argument('--quick',action='store_true',
+                        help="fewer methods, tolerances and ensemble sizes")
+    args = parser.parse_args()
+
+    if args.quick:
+        results = run_all(args.models,methods=['RK45','BDF','LSODA'],rtols=[1e-3,1e-7],
+                          ensemble_sizes=[10,100],stationary_times=[1e2,1e3])
+    else:
+        results = run_all(args.models)
+    with open(args.out,'w') as f:
+        json.dump(results,f,indent=2)
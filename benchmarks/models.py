@@ -0,0 +1,159 @@
+"""Size-scalable versions of the example models.
+
+Each builder takes a size argument and returns (model, init), where
+model is an (unflattened) Model and init(system) sets the initial
+state vector of a System built from it.  The models follow the
+examples directory:
+
+birth_death      : examples/birth_death.py, in size separate compartments
+ab_system        : examples/Gillespie_AB_system.py, in size separate compartments
+reac_diff_1d     : examples/1D_reac_diff_AB.py, with size compartments
+reac_diff_2d     : the same reactions on a size x size grid
+membrane_slab    : examples/membrane_slab.py, with size x size compartments
+                   in each layer (periodic in x and y, so size >= 3)
+reaction_network : a single compartment with size species and 2*size
+                   reactions (scales the number of reactions)
+"""
+
+from openrxn.reactions import Reaction, Species
+from openrxn.model import Model
+from openrxn.compartments.compartment import Compartment
+from openrxn.compartments.arrays import CompartmentArray1D, CompartmentArray2D, CompartmentArray3D
+from openrxn.connections import IsotropicConnection, AnisotropicConnection, FicksConnection
+from openrxn import unit
+
+import numpy as np
+
+def _zero(system):
+    system.state.q_val[:] = 0
+
+def birth_death(size):
+    A = Species('A')
+    rxn = Reaction('birth_and_death',[A],[],[1],[],kf=0.1/unit.sec,kr=1.0/unit.sec)
+
+    comps = []
+    for i in range(size):
+        c = Compartment('main-{0}'.format(i))
+        c.add_rxn_to_compartment(rxn)
+        comps.append(c)
+
+    return Model(compartments=comps), _zero
+
+def _ab_rxns(conc=None):
+    A, B, C, D = [Species(s) for s in 'ABCD']
+    k1 = 1e-3/unit.sec
+    k2 = 1e-2/unit.sec
+    if conc is not None:
+        k1 = k1/conc
+        k2 = k2/conc
+
+    rxns = [Reaction('AAC',[A],[C],[2],[1],kf=k1),
+            Reaction('ABD',[A,B],[D],[1,1],[1],kf=k2),
+            Reaction('birth_A',[],[A],[],[1],kf=1.2/unit.sec),
+            Reaction('birth_B',[],[B],[],[1],kf=1.0/unit.sec)]
+    return rxns
+
+def ab_system(size):
+    rxns = _ab_rxns()
+
+    comps = []
+    for i in range(size):
+        c = Compartment('main-{0}'.format(i))
+        c.add_rxns_to_compartment(rxns)
+        comps.append(c)
+
+    return Model(compartments=comps), _zero
+
+def reac_diff_1d(size):
+    L = 1*unit.mm
+    h = L/size
+    rxns = _ab_rxns(conc=1.0*unit.mol/h)
+
+    boundaries = np.linspace(0,L.magnitude,size+1)*L.units
+    conn = IsotropicConnection({'A' : 0.16/unit.sec, 'B' : 0.16/unit.sec},dim=1)
+    arr = CompartmentArray1D('main',boundaries,conn)
+    arr.add_rxns_to_array(rxns[:2])
+    for c in arr.compartments.values():
+        if c.pos[0][1] <= 9*L/10:
+            c.add_rxn_to_compartment(rxns[2])
+        if c.pos[0][1] > 2*L/5:
+            c.add_rxn_to_compartment(rxns[3])
+
+    return Model(arrays=[arr]), _zero
+
+def reac_diff_2d(size):
+    L = 1*unit.mm
+    h = L/size
+    rxns = _ab_rxns(conc=1.0*unit.mol/h**2)
+
+    pos = np.linspace(0,L.magnitude,size+1)*L.units
+    conn = IsotropicConnection({'A' : 0.16/unit.sec, 'B' : 0.16/unit.sec},dim=2)
+    arr = CompartmentArray2D('main',pos,pos,conn)
+    arr.add_rxns_to_array(rxns[:2])
+    for c in arr.compartments.values():
+        if c.pos[0][1] <= 9*L/10:
+            c.add_rxn_to_compartment(rxns[2])
+        if c.pos[1][1] > 2*L/5:
+            c.add_rxn_to_compartment(rxns[3])
+
+    return Model(arrays=[arr]), _zero
+
+def membrane_slab(size, n_bulk=5):
+    drug = Species('drug')
+    receptor = Species('receptor')
+    dr_complex = Species('complex')
+    kon = 1e6/(unit.mol*unit.sec/unit.liter)
+    binding = Reaction('binding',[drug,receptor],[dr_complex],[1,1],[1],kf=kon,kr=0.1/unit.sec)
+
+    in_slab = FicksConnection({'drug' : 1e-8*unit.cm**2/unit.sec})
+    x_pos = np.linspace(-5*size,5*size,size+1)*unit.nanometer
+    lower = CompartmentArray3D('lower_slab',x_pos,x_pos,np.array([-1,0])*unit.nanometer,
+                               in_slab,periodic=[True,True,False])
+    upper = CompartmentArray3D('upper_slab',x_pos,x_pos,np.array([0,1])*unit.nanometer,
+                               in_slab,periodic=[True,True,False])
+    upper.add_rxn_to_array(binding)
+    lower.join3D(upper,IsotropicConnection({'drug' : 1e-5/unit.sec}),append_side='z+')
+
+    z_bulk = np.linspace(1,1+n_bulk,n_bulk+1)*unit.nanometer
+    bulk = CompartmentArray3D('bulk',x_pos,x_pos,z_bulk,
+                              FicksConnection({'drug' : 1e-5*unit.cm**2/unit.sec}),
+                              periodic=[True,True,False])
+    bulk.join3D(upper,AnisotropicConnection({'drug' : (1e-5/unit.sec, 1e-1/unit.sec)}),
+                append_side='z-')
+
+    def init(system):
+        _zero(system)
+        # positions in the state are in nanometers
+        top = system.state.select(species=drug.ID,slab=('z',n_bulk,n_bulk+1))
+        system.set_q(top,1e-2*unit.mol/unit.L)
+        rec = system.state.select(species=receptor.ID,slab=('z',0.5,0.5))
+        system.set_q(rec,1e-2*unit.mol/unit.L)
+
+    return Model([lower,upper,bulk]), init
+
+def reaction_network(size, seed=0):
+    if size < 3:
+        raise ValueError("Error! reaction_network needs at least 3 species")
+    rng = np.random.RandomState(seed)
+    species = [Species('S{0}'.format(i)) for i in range(size)]
+
+    c = Compartment('main')
+    c.add_rxn_to_compartment(Reaction('birth',[],[species[0]],[],[1],kf=10/unit.sec))
+    for i in range(size):
+        # a chain of conversions, and random binding reactions
+        if i < size-1:
+            c.add_rxn_to_compartment(Reaction('conv{0}'.format(i),[species[i]],[species[i+1]],
+                                              [1],[1],kf=1/unit.sec,kr=0.5/unit.sec))
+        a, b, p = rng.choice(size,3,replace=False)
+        c.add_rxn_to_compartment(Reaction('bind{0}'.format(i),[species[a],species[b]],[species[p]],
+                                          [1,1],[1],kf=1e-3/unit.sec,kr=0.1/unit.sec))
+    c.add_rxn_to_compartment(Reaction('death',[species[-1]],[],[1],[],kf=1/unit.sec))
+
+    return Model(compartments=[c]), _zero
+
+MODELS = {'birth_death' : birth_death,
+          'ab_system' : ab_system,
+          'reac_diff_1d' : reac_diff_1d,
+          'reac_diff_2d' : reac_diff_2d,
+          'membrane_slab' : membrane_slab,
+          'reaction_network' : reaction_network}
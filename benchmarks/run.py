@@ -0,0 +1,253 @@
+"""Runs the benchmark suites and saves the results as JSON.
+
+Each case builds a model from benchmarks.models for a list of sizes,
+and times every stage separately:
+
+build   : constructing the Model (compartments, arrays, reactions)
+flatten : Model.flatten()
+system  : building the System (State and MassActionNetwork / processes)
+run     : System.run()
+
+The throughput (RHS evaluations or SSA events per second of run time)
+is taken from a Profiler attached to the system.  The peak memory of
+each stage is measured with tracemalloc in a separate, untimed pass,
+since tracing slows down allocations.
+
+Usage:
+
+python -m benchmarks.run --suite quick --out results.json
+python -m benchmarks.run --compare old.json new.json
+
+(from the root directory of the repository, with src/ in PYTHONPATH)
+"""
+
+from benchmarks.models import MODELS
+from openrxn.systems.ODESystem import ODESystem
+from openrxn.systems.GillespieSystem import GillespieSystem
+from openrxn.systems.profiler import Profiler
+
+import numpy as np
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+# each case is (model, engine, options, sizes, total_time)
+SUITES = {'quick' : [('birth_death','ssa',{},[1,4,16],100),
+                     ('ab_system','ode',{'method' : 'LSODA'},[1,10,100],100),
+                     ('reac_diff_1d','ode',{'method' : 'BDF'},[10,40,160],100),
+                     ('reac_diff_1d','ssa',{},[10,40],10),
+                     ('reac_diff_2d','ode',{'method' : 'BDF'},[5,10,20],100),
+                     ('reaction_network','ode',{'method' : 'LSODA'},[10,40,160],10)],
+          'full' :  [('birth_death','ssa',{},[1,4,16,64],100),
+                     ('ab_system','ssa',{},[1,4,16],100),
+                     ('ab_system','ode',{'method' : 'LSODA'},[1,10,100,1000],100),
+                     ('reac_diff_1d','ode',{'method' : 'BDF'},[10,40,160,640],1800),
+                     ('reac_diff_1d','ode',{'method' : 'LSODA'},[10,40,160,640],1800),
+                     ('reac_diff_1d','ssa',{},[10,40,160],100),
+                     ('reac_diff_2d','ode',{'method' : 'BDF'},[5,10,20,40],100),
+                     ('membrane_slab','ode',{'method' : 'BDF'},[3,5,10],1e-6),
+                     ('reaction_network','ode',{'method' : 'LSODA'},[10,40,160,640],10),
+                     ('reaction_network','ssa',{},[10,40],10)]}
+
+ENGINES = {'ode' : ODESystem,
+           'ssa' : GillespieSystem}
+
+def run_stages(model_name, engine, size, total_time, options={}, seed=0):
+    """Builds and runs one model, and returns a dictionary with the
+    time of each stage, the size of the system and the counters of
+    the profiler."""
+
+    prof = Profiler()
+    times = {}
+
+    t0 = time.perf_counter()
+    model, init = MODELS[model_name](size)
+    times['build'] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    flat = model.flatten()
+    times['flatten'] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    system = ENGINES[engine](flat,profiler=prof)
+    times['system'] = time.perf_counter() - t0
+
+    init(system)
+    np.random.seed(seed)
+    t0 = time.perf_counter()
+    system.run(total_time,**options)
+    times['run'] = time.perf_counter() - t0
+
+    result = {'times' : times,
+              'n_compartments' : len(flat.compartments),
+              'n_quantities' : int(system.state.size),
+              'counters' : dict(prof.counters)}
+
+    if engine == 'ode':
+        result['n_processes'] = system.dqdt.n_processes
+        result['throughput'] = {'rhs_evals_per_s' : prof.counters.get('rhs_evals',0)/times['run']}
+    else:
+        result['n_processes'] = len(system.processes)
+        result['throughput'] = {'ssa_events_per_s' : prof.counters.get('ssa_events',0)/times['run']}
+
+    return result
+
+def peak_memory(model_name, engine, size, total_time, options={}, seed=0):
+    """Returns the peak memory (in bytes, as traced by tracemalloc)
+    of each stage."""
+
+    peaks = {}
+    tracemalloc.start()
+
+    def stage(name, func, *args, **kwargs):
+        tracemalloc.reset_peak()
+        out = func(*args,**kwargs)
+        peaks[name] = tracemalloc.get_traced_memory()[1]
+        return out
+
+    try:
+        model, init = stage('build',MODELS[model_name],size)
+        flat = stage('flatten',model.flatten)
+        system = stage('system',ENGINES[engine],flat)
+        init(system)
+        np.random.seed(seed)
+        stage('run',system.run,total_time,**options)
+    finally:
+        tracemalloc.stop()
+
+    return peaks
+
+def run_case(model_name, engine, options, sizes, total_time, repeat=3, memory=True):
+    """Runs a case for each size, and returns a list with a record
+    for each size.  The minimum time of each stage over the repeats
+    is reported."""
+
+    records = []
+    for size in sizes:
+        runs = [run_stages(model_name,engine,size,total_time,options) for r in range(repeat)]
+        best = runs[0]
+        for stage in best['times']:
+            best['times'][stage] = min(r['times'][stage] for r in runs)
+        for name in best['throughput']:
+            best['throughput'][name] = max(r['throughput'][name] for r in runs)
+
+        record = {'model' : model_name,
+                  'engine' : engine,
+                  'options' : options,
+                  'size' : size,
+                  'total_time' : total_time,
+                  'repeat' : repeat}
+        record.update(best)
+        if memory:
+            record['peak_memory'] = peak_memory(model_name,engine,size,total_time,options)
+        records.append(record)
+
+        print("{0:>18s} {1:>4s} {2:>6d}  run {3:9.4f} s  total {4:9.4f} s".format(
+            model_name,engine,size,record['times']['run'],sum(record['times'].values())))
+
+    return records
+
+def scaling(records, stage='run'):
+    """Returns the scaling exponent of a stage with the number of
+    quantities, from a least squares fit of log(time) vs. log(N)."""
+
+    n = np.array([r['n_quantities'] for r in records],dtype=float)
+    t = np.array([r['times'][stage] for r in records])
+    if len(n) < 2 or np.any(t <= 0):
+        return None
+    return float(np.polyfit(np.log(n),np.log(t),1)[0])
+
+def environment():
+    """Returns a description of the machine and the code version."""
+
+    import scipy
+    try:
+        commit = subprocess.check_output(['git','rev-parse','HEAD'],
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {'commit' : commit,
+            'date' : datetime.datetime.now().isoformat(),
+            'python' : platform.python_version(),
+            'numpy' : np.__version__,
+            'scipy' : scipy.__version__,
+            'platform' : platform.platform(),
+            'processor' : platform.processor()}
+
+def run_suite(suite='quick', repeat=3, memory=True, models=None):
+    """Runs all of the cases in a suite, and returns the results.
+    A case that raises an exception is recorded with its error message,
+    and the suite continues."""
+
+    results = {'environment' : environment(), 'suite' : suite, 'cases' : []}
+    for model_name, engine, options, sizes, total_time in SUITES[suite]:
+        if models is not None and model_name not in models:
+            continue
+        case = {'model' : model_name,
+                'engine' : engine,
+                'options' : options}
+        try:
+            records = run_case(model_name,engine,options,sizes,total_time,repeat,memory)
+        except Exception as e:
+            print("{0:>18s} {1:>4s}  failed: {2!r}".format(model_name,engine,e))
+            case['error'] = repr(e)
+            case['records'] = []
+        else:
+            case['records'] = records
+            case['scaling'] = {stage : scaling(records,stage) for stage in records[0]['times']}
+        results['cases'].append(case)
+    return results
+
+def _key(case, record):
+    return (case['model'],case['engine'],json.dumps(case['options'],sort_keys=True),record['size'])
+
+def compare(old, new, stage='run', threshold=1.2):
+    """Compares two results dictionaries (e.g. from two commits), and
+    returns a list of (case, old time, new time, ratio), for the cases
+    that are in both.  Ratios larger than threshold are marked as
+    regressions in the printed table."""
+
+    old_times = {}
+    for case in old['cases']:
+        for r in case['records']:
+            old_times[_key(case,r)] = r['times'][stage]
+
+    rows = []
+    for case in new['cases']:
+        for r in case['records']:
+            key = _key(case,r)
+            if key in old_times:
+                ratio = r['times'][stage]/old_times[key]
+                rows.append((key,old_times[key],r['times'][stage],ratio))
+                flag = 'REGRESSION' if ratio > threshold else ''
+                print("{0:>18s} {1:>4s} {2:>6d}  {3:9.4f} -> {4:9.4f} s  x{5:.2f} {6}".format(
+                    key[0],key[1],key[3],old_times[key],r['times'][stage],ratio,flag))
+    return rows
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Runs the OpenRXN benchmarks.")
+    parser.add_argument('--suite',default='quick',choices=list(SUITES.keys()))
+    parser.add_argument('--out',default='benchmark_results.json')
+    parser.add_argument('--repeat',type=int,default=3)
+    parser.add_argument('--no-memory',action='store_true')
+    parser.add_argument('--models',nargs='*',default=None)
+    parser.add_argument('--compare',nargs=2,metavar=('OLD','NEW'))
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        compare(old,new)
+        sys.exit(0)
+
+    results = run_suite(args.suite,args.repeat,not args.no_memory,args.models)
+    with open(args.out,'w') as f:
+        json.dump(results,f,indent=2)
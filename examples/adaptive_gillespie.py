@@ -0,0 +1,62 @@
+# Adaptive refinement of a 3D slab with the Gillespie engine.
+#
+# A drug diffuses in a 3x3x3 box array (periodic in x and y) and binds
+# to a receptor.  The boxes where the drug gradient is largest are
+# refined into octants, the numbers of molecules are split between the
+# octants multinomially (since they are integers), and the boxes are
+# merged back at the end.  The numbers of molecules are conserved by
+# each remap.
+
+from openrxn.systems.GillespieSystem import GillespieSystem
+from openrxn.reactions import Reaction, Species
+from openrxn.model import Model
+from openrxn.compartments.arrays import CompartmentArray3D
+from openrxn.compartments.adaptive import AdaptiveMesh
+from openrxn.connections import FicksConnection
+from openrxn import unit
+
+import numpy as np
+
+# define species and reactions
+drug = Species('drug')
+receptor = Species('receptor')
+cx = Species('complex')
+
+kon = 1e-20/(unit.mol*unit.sec/unit.liter)
+koff = 0.1/unit.sec
+binding = Reaction('binding',[drug,receptor],[cx],[1,1],[1],kf=kon,kr=koff)
+
+# create a Model
+x = np.linspace(-5,5,4)*unit.nanometer
+z = np.linspace(0,3,4)*unit.nanometer
+conn = FicksConnection({'drug' : 1e-8*unit.cm**2/unit.sec})
+comp_array = CompartmentArray3D('bulk',x,x,z,conn,periodic=[True,True,False])
+comp_array.add_rxn_to_array(binding)
+model = Model([comp_array])
+mesh = AdaptiveMesh(model.flatten(),max_level=1)
+
+def totals(system):
+    return {s : system.state.q_val[system.state.species == s].sum() for s in ['drug','receptor','complex']}
+
+# create a system, with all of the drug at the bottom
+sys = GillespieSystem(mesh.flat_model)
+for i, (c, s) in enumerate(zip(sys.state.compartment,sys.state.species)):
+    if s == 'drug' and c.endswith('_0'):
+        sys.state.q_val[i] = 100
+    elif s == 'receptor':
+        sys.state.q_val[i] = 10
+sys.run(1e-6)
+print("Before refinement:", len(mesh.leaves()), "compartments,", totals(sys))
+
+# refine the boxes with the largest gradients
+ind = mesh.gradient_indicator(sys.state,'drug')
+mesh.adapt(ind,refine_above=np.percentile(ind,70))
+sys = mesh.remap_system(sys)
+print("After refinement: ", len(mesh.leaves()), "compartments,", totals(sys))
+sys.run(1e-6)
+
+# merge all of the refined boxes again
+mesh.adapt(np.zeros(len(mesh.leaves())),coarsen_below=1)
+sys = mesh.remap_system(sys)
+print("After coarsening: ", len(mesh.leaves()), "compartments,", totals(sys))
+sys.run(1e-6)
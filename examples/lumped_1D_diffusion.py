@@ -0,0 +1,55 @@
+# Lumping of the one dimensional diffusion system of 1D_diffusion.py,
+# run with the Gillespie engine.
+#
+# The 40 compartments are lumped into blocks of 4, and the lumped model
+# is run from the same initial state (restricted to the lumps).  The
+# number of molecules in each lump of the full model is compared to the
+# lumped model, at t = 60s.  Since each lump is well mixed, the spread
+# between lumps is faster than in the full model (see openrxn.lumping).
+
+from openrxn.systems.GillespieSystem import GillespieSystem
+from openrxn.reactions import Species
+from openrxn.model import Model
+from openrxn.compartments.arrays import CompartmentArray1D
+from openrxn.lumping import LumpedModel, block_partition
+from openrxn import unit
+from openrxn.connections import IsotropicConnection
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+# define species
+A = Species('A')
+
+d = 0.16/unit.sec
+K = 40   # number of compartments
+L = 1*unit.mm
+
+# create a Model
+boundaries = np.linspace(0,L.magnitude,K+1)*L.units
+conn = IsotropicConnection({'A' : d},dim=1)
+comp_array = CompartmentArray1D('main',boundaries,conn)
+model = Model(arrays=[comp_array])
+flat_model = model.flatten()
+
+# lump blocks of 4 compartments
+lumped = LumpedModel(flat_model,block_partition(flat_model,4))
+
+fig, ax = plt.subplots()
+for i in range(5):
+    sys = GillespieSystem(flat_model)
+    sys.set_q(np.arange(sys.state.size),0)
+    sys.set_q([16,17],500)
+
+    lumped_sys = GillespieSystem(lumped.flat_model)
+    lumped_sys.state.q_val = lumped.restrict(sys.state,lumped_sys.state)
+
+    sys.run(60)
+    lumped_sys.run(60)
+    ax.plot(lumped.restrict(sys.state,lumped_sys.state),color='C0',label='full' if i == 0 else None)
+    ax.plot(lumped_sys.state.q_val,color='C1',label='lumped' if i == 0 else None)
+
+ax.set_xlabel('lump')
+ax.set_ylabel('number of A molecules')
+ax.legend()
+plt.show()
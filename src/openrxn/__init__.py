@@ -1,2 +1,48 @@
-from pint import UnitRegistry
-unit = UnitRegistry()
+"""openrxn.unit is the Pint UnitRegistry used throughout OpenRXN.
+
+The registry is only built when it is first used (e.g. unit.sec),
+so that importing openrxn is fast.  The parsed unit definitions are
+cached on disk by Pint (cache_folder=':auto:'), which makes building
+the registry much faster in short-lived processes (e.g. workers).
+It is also set as Pint's application registry, so that pickled
+quantities are restored in the same registry."""
+
+class _LazyUnitRegistry(object):
+
+    def __init__(self):
+        self._registry = None
+
+    def _get_registry(self):
+        if self._registry is None:
+            import pint
+            try:
+                registry = pint.UnitRegistry(cache_folder=':auto:')
+            except Exception:
+                # e.g. the cache folder can not be created
+                registry = pint.UnitRegistry()
+            pint.set_application_registry(registry)
+            self._registry = registry
+        return self._registry
+
+    def __getattr__(self, name):
+        # Pint parses the name on every attribute access (e.g. unit.nm),
+        # so the result is stored on the proxy, and later accesses do
+        # not reach __getattr__
+        value = getattr(self._get_registry(),name)
+        if not name.startswith('_'):
+            self.__dict__[name] = value
+        return value
+
+    def __getitem__(self, name):
+        return self._get_registry()[name]
+
+    def __contains__(self, name):
+        return name in self._get_registry()
+
+    def __call__(self, *args, **kwargs):
+        return self._get_registry()(*args,**kwargs)
+
+    def __dir__(self):
+        return dir(self._get_registry())
+
+unit = _LazyUnitRegistry()
@@ -0,0 +1,486 @@
+"""An AdaptiveMesh refines and coarsens the box compartments of a
+FlatModel (e.g. a flattened CompartmentArray3D) as an octree:
+
+mesh = AdaptiveMesh(my_model.flatten(), max_level=2)
+s = ODESystem(mesh.flat_model)
+...
+s.run(10, method='BDF')
+ind = mesh.gradient_indicator(s.state, 'drug')
+if mesh.adapt(ind, refine_above=0.1, coarsen_below=0.01):
+    s = mesh.remap_system(s)
+
+The compartments of the original model are the roots of the tree.
+A refined compartment is split at its midpoints into 8 children, with
+IDs made by appending '.c' to the ID of the parent (c = 4*ix + 2*iy + iz
+for the position of the child along x, y and z), and 8 sibling leaves
+can be merged back into their parent.
+
+The transport between leaves is rebuilt from the geometry: two leaves
+are connected if their boxes share a face (also when they are
+non-conforming, e.g. one leaf and four smaller ones), with a
+DivByVConnection of rate D*A/d, where A is the overlap of the faces and
+d the distance between the centers (with periodic wraps).  The
+diffusion constants D are recovered from the (resolved Fick's)
+DivByVConnections of the original model, D = k*d/A.  D within a
+refined compartment is taken from the diffusion argument if it is given
+for a species, and otherwise is the mean over the connections of the
+compartment to other compartments of the tree (or over all of the
+connections of the tree, for species that its own connections do not
+carry).  A compartment whose species have no D can not be refined.
+Connections between compartments that are not refined are kept as they
+are, so that the connections of refined compartments must be DivByVConnections
+(Reservoirs can only be connected to compartments that are not refined).
+
+Leaves get the reactions of their root; zero-order reactions (sources)
+are scaled by the volume fraction of the leaf, since their rates are
+per compartment.
+
+The quantities are remapped conservatively (remap): the quantity in a
+refined compartment is split between its children in proportion to
+their volumes (or multinomially, for integer quantities), and the
+quantities of merged compartments are summed.
+"""
+
+from openrxn.model import FlatModel
+from openrxn.compartments.compartment import Compartment3D
+from openrxn.connections import DivByVConnection
+from openrxn import unit
+
+import numpy as np
+import copy
+
+class _Node(object):
+    # a box of the octree (positions in nm)
+
+    __slots__ = ['tag','root','parent','children','lo','hi','level']
+
+    def __init__(self, tag, root, parent, lo, hi, level):
+        self.tag = tag
+        self.root = root
+        self.parent = parent
+        self.children = None
+        self.lo = lo
+        self.hi = hi
+        self.level = level
+
+    def volume(self):
+        return float(np.prod(self.hi - self.lo))
+
+class AdaptiveMesh(object):
+
+    def __init__(self, flat_model, max_level=2, diffusion=None):
+        """flat_model is the FlatModel at the coarsest level, whose
+        Compartment3D objects can be refined up to max_level times.
+
+        diffusion is an optional dictionary of diffusion constants (in
+        units of L^2/s), keyed by Species ID, that are used for the
+        transport within refined compartments."""
+
+        self.base = flat_model
+        self.max_level = max_level
+        self.diffusion = {}
+        if diffusion is not None:
+            self.diffusion = {s : d.to(unit.nm**2/unit.sec).magnitude for s, d in diffusion.items()}
+
+        self.nodes = {}
+        self.roots = []
+        for tag, c in flat_model.compartments.items():
+            if isinstance(c,Compartment3D):
+                lo = np.array([c.pos[a][0].to(unit.nm).magnitude for a in range(3)],dtype=float)
+                hi = np.array([c.pos[a][1].to(unit.nm).magnitude for a in range(3)],dtype=float)
+                node = _Node(tag,tag,None,lo,hi,0)
+                self.nodes[tag] = node
+                self.roots.append(node)
+
+        if len(self.roots) == 0:
+            raise ValueError("Error! An AdaptiveMesh needs a model with Compartment3D objects")
+        lo = np.min([n.lo for n in self.roots],axis=0)
+        hi = np.max([n.hi for n in self.roots],axis=0)
+        self._box_len = hi - lo
+        self._tol = 1e-9*np.max(self._box_len)
+
+        self._root_pairs = self._find_root_pairs()
+        self._D = {}
+        self._D_tree = None
+        self._merged = {}
+        self.flat_model = self._build()
+
+    def leaves(self):
+        """Returns the tags of the leaves, in the order of the
+        compartments of flat_model."""
+        return [n.tag for n in self._leaf_nodes()]
+
+    def _leaf_nodes(self):
+        leaves = []
+        stack = list(reversed(self.roots))
+        while len(stack) > 0:
+            n = stack.pop()
+            if n.children is None:
+                leaves.append(n)
+            else:
+                stack += list(reversed(n.children))
+        return leaves
+
+    def _under(self, node):
+        # the leaves under a node
+        if node.children is None:
+            return [node]
+        leaves = []
+        for c in node.children:
+            leaves += self._under(c)
+        return leaves
+
+    def _find_root_pairs(self):
+        # the pairs of connected root compartments, with the shift of
+        # the second one that makes their faces touch
+        pairs = {}
+        for n in self.roots:
+            c = self.base.compartments[n.tag]
+            for other_tag in c.connections:
+                if other_tag not in self.nodes or other_tag == n.tag:
+                    continue
+                key = tuple(sorted((n.tag,other_tag)))
+                if key not in pairs:
+                    n1, n2 = self.nodes[key[0]], self.nodes[key[1]]
+                    pairs[key] = self._shift(n1,n2)
+        return pairs
+
+    def _shift(self, n1, n2):
+        # the periodic shift of n2 that puts it next to n1
+        shift = np.zeros(3)
+        for a in range(3):
+            if n1.hi[a] < n2.lo[a] - self._tol or n2.hi[a] < n1.lo[a] - self._tol:
+                # not touching along a: use the nearest periodic image
+                d = 0.5*(n1.lo[a] + n1.hi[a] - n2.lo[a] - n2.hi[a])
+                shift[a] = self._box_len[a]*np.round(d/self._box_len[a])
+        return shift
+
+    def _contacts(self, nodes1, nodes2, shift):
+        # returns the pairs (i, j) of nodes1 x nodes2 that share a face,
+        # with the areas of the faces and the center distances
+        lo1 = np.array([n.lo for n in nodes1])
+        hi1 = np.array([n.hi for n in nodes1])
+        lo2 = np.array([n.lo for n in nodes2]) + shift
+        hi2 = np.array([n.hi for n in nodes2]) + shift
+
+        overlap = np.minimum(hi1[:,None,:],hi2[None,:,:]) - np.maximum(lo1[:,None,:],lo2[None,:,:])
+        touching = np.abs(overlap) <= self._tol
+        inside = overlap > self._tol
+        face = (touching.sum(axis=2) == 1) & (inside.sum(axis=2) == 2)
+        i, j = np.nonzero(face)
+
+        areas = np.prod(np.where(inside[i,j],overlap[i,j],1.0),axis=1)
+        d = 0.5*(lo1[i] + hi1[i]) - 0.5*(lo2[j] + hi2[j])
+        return i, j, areas, np.sqrt((d**2).sum(axis=1))
+
+    def _diffusion(self, tag1, tag2):
+        # the diffusion constants (D_out, D_in) of each species along
+        # the connection of root tag1 to root tag2, in nm^3/s * nm / nm^2
+        if (tag1,tag2) not in self._D:
+            conn = self.base.compartments[tag1].connections[tag2][1]
+            if not isinstance(conn,DivByVConnection) or conn.dim != 3:
+                raise ValueError("Error! Only DivByVConnections (e.g. resolved FicksConnections) can be refined ({0} to {1})".format(tag1,tag2))
+            n1, n2 = self.nodes[tag1], self.nodes[tag2]
+            i, j, areas, dists = self._contacts([n1],[n2],self._shift(n1,n2))
+            if len(areas) == 0:
+                raise ValueError("Error! Connected compartments {0} and {1} do not share a face".format(tag1,tag2))
+            f = dists[0]/areas[0]
+            rate_units = unit.nm**3/unit.sec
+            self._D[(tag1,tag2)] = {s : (k[0].to(rate_units).magnitude*f,k[1].to(rate_units).magnitude*f)
+                                    for s,k in conn.species_rates.items()}
+        return self._D[(tag1,tag2)]
+
+    def _mean_diffusion(self, pairs):
+        # the mean diffusion constant of each species over the
+        # connections from root tag1 to root tag2 in pairs
+        D = {}
+        for tag1, tag2 in pairs:
+            for s, (d_out, d_in) in self._diffusion(tag1,tag2).items():
+                D.setdefault(s,[]).append(d_out)
+        return {s : float(np.mean(d)) for s, d in D.items()}
+
+    def _tree_diffusion(self):
+        # the mean diffusion constant of each species over all of the
+        # DivByVConnections between roots
+        if self._D_tree is None:
+            pairs = []
+            for t1, t2 in self._root_pairs:
+                for a, b in [(t1,t2),(t2,t1)]:
+                    conns = self.base.compartments[a].connections
+                    if b in conns and isinstance(conns[b][1],DivByVConnection) and conns[b][1].dim == 3:
+                        pairs.append((a,b))
+            self._D_tree = self._mean_diffusion(pairs)
+        return self._D_tree
+
+    def _internal_diffusion(self, root):
+        # the diffusion constant of each species within a refined root
+        # compartment (see the module docstring)
+        own = self._mean_diffusion([(root,other_tag) for other_tag in self.base.compartments[root].connections
+                                    if other_tag in self.nodes and other_tag != root])
+        species = set(x.ID for r in self.base.compartments[root].reactions for x in r.reactants + r.products)
+        species.update(own)
+
+        D = {}
+        for s in species:
+            if s in self.diffusion:
+                D[s] = self.diffusion[s]
+            elif s in own:
+                D[s] = own[s]
+            else:
+                tree = self._tree_diffusion()
+                if s in tree:
+                    D[s] = tree[s]
+        if len(D) == 0:
+            raise ValueError("Error! No diffusion constants can be found for the compartments within {0}; they can be given with the diffusion argument".format(root))
+        return D
+
+    def _build(self):
+        # builds a FlatModel with one compartment per leaf
+        leaves = self._leaf_nodes()
+        refined = set(n.root for n in leaves if n.parent is not None)
+        nm = unit.nm
+        rate_units = unit.nm**3/unit.sec
+        conn_cache = {}
+
+        def connection(rates):
+            # shares the connection objects with the same rates
+            key = tuple(sorted(rates.items()))
+            if key not in conn_cache:
+                conn_cache[key] = DivByVConnection({s : (unit.Quantity(k0,rate_units),unit.Quantity(k1,rate_units))
+                                                    for s,(k0,k1) in rates.items()})
+            return conn_cache[key]
+
+        comps = {}
+        for n in leaves:
+            base = self.base.compartments[n.root]
+            if n.parent is None:
+                comps[n.tag] = Compartment3D(n.tag,pos=base.pos,surface_area=base.surface_area,volume=base.volume)
+                comps[n.tag].reactions = base.reactions
+            else:
+                size = n.hi - n.lo
+                pos = [(unit.Quantity(n.lo[a],nm),unit.Quantity(n.hi[a],nm)) for a in range(3)]
+                sa = {'xy' : unit.Quantity(size[0]*size[1],nm**2),
+                      'yz' : unit.Quantity(size[1]*size[2],nm**2),
+                      'xz' : unit.Quantity(size[0]*size[2],nm**2)}
+                comps[n.tag] = Compartment3D(n.tag,pos=pos,surface_area=sa,volume=unit.Quantity(n.volume(),nm**3))
+                comps[n.tag].reactions = _scaled_reactions(base.reactions,n.volume()/self.nodes[n.root].volume())
+
+        # connections of the compartments that are not refined, and to
+        # compartments that are not in the tree (e.g. Reservoirs)
+        for n in leaves:
+            if n.parent is not None:
+                continue
+            for other_tag, (other, conn) in self.base.compartments[n.tag].connections.items():
+                if other_tag not in self.nodes:
+                    comps[n.tag].connections[other_tag] = (other,conn)
+                elif other_tag not in refined:
+                    comps[n.tag].connections[other_tag] = (comps[other_tag],conn)
+        for tag in refined:
+            for other_tag in self.base.compartments[tag].connections:
+                if other_tag not in self.nodes:
+                    raise ValueError("Error! Compartments connected to {0} can not be refined ({1})".format(other_tag,tag))
+
+        # leaves of connected roots, when one of them is refined
+        for (t1, t2), shift in self._root_pairs.items():
+            if t1 not in refined and t2 not in refined:
+                continue
+            nodes1 = self._under(self.nodes[t1])
+            nodes2 = self._under(self.nodes[t2])
+            i, j, areas, dists = self._contacts(nodes1,nodes2,shift)
+            for a, b, area, d in zip(i,j,areas,dists):
+                l1, l2 = nodes1[a].tag, nodes2[b].tag
+                if t2 in self.base.compartments[t1].connections:
+                    D = self._diffusion(t1,t2)
+                    comps[l1].connections[l2] = (comps[l2],connection({s : (d0*area/d,d1*area/d) for s,(d0,d1) in D.items()}))
+                if t1 in self.base.compartments[t2].connections:
+                    D = self._diffusion(t2,t1)
+                    comps[l2].connections[l1] = (comps[l1],connection({s : (d0*area/d,d1*area/d) for s,(d0,d1) in D.items()}))
+
+        # leaves within a refined root
+        for tag in refined:
+            nodes = self._under(self.nodes[tag])
+            D = self._internal_diffusion(tag)
+            i, j, areas, dists = self._contacts(nodes,nodes,np.zeros(3))
+            for a, b, area, d in zip(i,j,areas,dists):
+                rates = {s : (dm*area/d,dm*area/d) for s, dm in D.items()}
+                comps[nodes[a].tag].connections[nodes[b].tag] = (comps[nodes[b].tag],connection(rates))
+
+        flat = FlatModel()
+        for tag, c in self.base.compartments.items():
+            if tag not in self.nodes:
+                flat.add_compartment(c)
+        flat.add_compartments([comps[n.tag] for n in leaves])
+
+        # neighbouring leaves, for the indicators
+        position = {n.tag : k for k, n in enumerate(leaves)}
+        pairs = [(position[n.tag],position[o]) for n in leaves for o in comps[n.tag].connections if o in position]
+        self._pairs = np.array(pairs,dtype=int).reshape(-1,2)
+        self._volumes = np.array([n.volume() for n in leaves])
+        self._levels = np.array([n.level for n in leaves])
+
+        return flat
+
+    def concentrations(self, state, species):
+        """Returns the quantity of species in each leaf (in the order
+        of leaves()) divided by its volume (in nm^3), with zeros for
+        leaves without the species."""
+        q = np.zeros(len(self._volumes))
+        for k, tag in enumerate(self.leaves()):
+            if tag in state.index and species in state.index[tag]:
+                q[k] = state.q_val[state.index[tag][species]]
+        return q/self._volumes
+
+    def gradient_indicator(self, state, species):
+        """Returns, for each leaf, the largest difference of the
+        concentration of species (or the largest over a list of
+        species) with a neighbouring leaf, relative to the largest
+        concentration."""
+
+        ind = np.zeros(len(self._volumes))
+        for s in np.atleast_1d(species):
+            c = self.concentrations(state,s)
+            scale = np.max(np.abs(c))
+            if scale == 0 or len(self._pairs) == 0:
+                continue
+            jump = np.abs(c[self._pairs[:,0]] - c[self._pairs[:,1]])/scale
+            np.maximum.at(ind,self._pairs[:,0],jump)
+        return ind
+
+    def adapt(self, indicator, refine_above=None, coarsen_below=None, max_level=None):
+        """Refines the leaves whose indicator (an array in the order of
+        leaves()) is above refine_above, and merges groups of 8 sibling
+        leaves whose indicators are all below coarsen_below.  Returns
+        the number of leaves that were refined and of groups that were
+        merged; if either is nonzero, flat_model is rebuilt, and the
+        quantities of a system should be moved to the new model with
+        remap or remap_system."""
+
+        if max_level is None:
+            max_level = self.max_level
+        leaves = self._leaf_nodes()
+        indicator = np.asarray(indicator,dtype=float)
+        if len(indicator) != len(leaves):
+            raise ValueError("Error! indicator must have one value per leaf ({0})".format(len(leaves)))
+
+        to_refine = []
+        if refine_above is not None:
+            to_refine = [n for n, x in zip(leaves,indicator) if x > refine_above and n.level < max_level]
+
+        to_coarsen = []
+        if coarsen_below is not None:
+            low = set(n.tag for n, x in zip(leaves,indicator) if x < coarsen_below)
+            parents = {}
+            for n in leaves:
+                if n.parent is not None:
+                    parents[n.parent.tag] = n.parent
+            for p in parents.values():
+                if all(c.children is None and c.tag in low for c in p.children):
+                    to_coarsen.append(p)
+
+        # checks that transport within the refined roots can be built,
+        # before the tree is changed
+        for root in set(n.root for n in to_refine):
+            self._internal_diffusion(root)
+
+        if len(to_refine) > 0 or len(to_coarsen) > 0:
+            self._merged = {}
+        for n in to_refine:
+            self._split(n)
+        for p in to_coarsen:
+            # the nodes below p are kept (for remap) until the next adapt
+            for c in self._subtree(p):
+                if c is not p:
+                    self._merged[c.tag] = self.nodes.pop(c.tag)
+            p.children = None
+
+        if len(to_refine) > 0 or len(to_coarsen) > 0:
+            self.flat_model = self._build()
+        return len(to_refine), len(to_coarsen)
+
+    def _subtree(self, node):
+        # a node and all of the nodes below it
+        nodes = [node]
+        for c in node.children or []:
+            nodes += self._subtree(c)
+        return nodes
+
+    def _split(self, node):
+        mid = 0.5*(node.lo + node.hi)
+        node.children = []
+        for c in range(8):
+            ix, iy, iz = (c >> 2) & 1, (c >> 1) & 1, c & 1
+            lo = np.where([ix,iy,iz],mid,node.lo)
+            hi = np.where([ix,iy,iz],node.hi,mid)
+            child = _Node("{0}.{1}".format(node.tag,c),node.root,node,lo,hi,node.level+1)
+            self.nodes[child.tag] = child
+            node.children.append(child)
+
+    def remap(self, old_state, new_state, integer=False):
+        """Returns the q_val array of new_state (built from flat_model)
+        that conserves the quantities of old_state (built from the
+        model before adapt).  If integer is True, the quantities of
+        refined compartments are split multinomially."""
+
+        q = np.zeros(new_state.size)
+
+        # totals of the old leaves under each of their ancestors
+        sums = {}
+        for tag in old_state.index:
+            node = self.nodes.get(tag,self._merged.get(tag))
+            if node is None:
+                continue
+            node = node.parent
+            while node is not None:
+                for s, i in old_state.index[tag].items():
+                    sums[(node.tag,s)] = sums.get((node.tag,s),0) + old_state.q_val[i]
+                node = node.parent
+
+        splits = {}
+        for tag in new_state.index:
+            for s, i in new_state.index[tag].items():
+                if tag in old_state.index and s in old_state.index[tag]:
+                    q[i] = old_state.q_val[old_state.index[tag][s]]
+                elif (tag,s) in sums:
+                    q[i] = sums[(tag,s)]
+                elif tag in self.nodes:
+                    # split the quantity of the old ancestor
+                    node = self.nodes[tag].parent
+                    while node is not None and node.tag not in old_state.index:
+                        node = node.parent
+                    if node is not None and s in old_state.index[node.tag]:
+                        splits.setdefault((node.tag,s),[]).append((i,self.nodes[tag].volume()))
+
+        for (tag, s), items in splits.items():
+            total = old_state.q_val[old_state.index[tag][s]]
+            idx = np.array([i for i,v in items])
+            frac = np.array([v for i,v in items])/self.nodes[tag].volume()
+            if integer:
+                q[idx] = np.random.multinomial(int(round(total)),frac/frac.sum())
+            else:
+                q[idx] = total*frac
+        return q
+
+    def remap_system(self, system, **kwargs):
+        """Returns a new system of the same type as system, built from
+        flat_model (kwargs are passed to its constructor), with the
+        quantities of system remapped (see remap).  Reporters and
+        events are not carried over, since they refer to the indexes of
+        the old state."""
+
+        new_system = type(system)(self.flat_model,**kwargs)
+        new_system.state.q_val = self.remap(system.state,new_system.state,integer=system.integer_q)
+        return new_system
+
+def _scaled_reactions(reactions, frac):
+    # zero-order reactions have rates per compartment, which are
+    # scaled by the volume fraction of a leaf
+    scaled = []
+    for r in reactions:
+        if len(r.reactants) == 0 or len(r.products) == 0:
+            r = copy.copy(r)
+            if len(r.reactants) == 0:
+                r.kf = r.kf*frac
+            if len(r.products) == 0:
+                r.kr = r.kr*frac
+        scaled.append(r)
+    return scaled
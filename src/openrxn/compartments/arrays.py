@@ -1,20 +1,78 @@
 """Compartment arrays are groups of compartments that make
-it easier to connect and manipulate large groups."""
+it easier to connect and manipulate large groups.
+
+The connectivity of an array is stored as index arrays, and the
+Compartment objects are only built when array.compartments is first
+used (e.g. by Model.flatten).  Compartments are numbered in C order
+of their IDs (i, (i,j) or (i,j,k)), and each "link" of the array is
+a list:
+
+[src, other_array, dst, conn_type]
+
+which connects the compartments src[n] of this array to the
+compartments dst[n] of other_array (the array itself for connections
+within the array).  Links are made from the face-neighbour offsets and
+periodic wraps of the grid, and from the faces of stacked or joined
+arrays (see connectivity).
+"""
 
 from openrxn.connections import Connection
 from openrxn.compartments.compartment import Compartment1D, Compartment2D, Compartment3D
+from openrxn.compartments.ID import makeID
+
+import numpy as np
+import logging
 
 class CompartmentArray(object):
     """Base class for compartment arrays."""
 
+    def _init_links(self, shape):
+        self.shape = shape
+        self._links = []
+        self._reactions = []
+        self._compartments = None
+
+    @property
+    def compartments(self):
+        """A dictionary of the Compartment objects of the array, keyed
+        by their IDs.  They are built (and connected) on first use."""
+        if self._compartments is None:
+            self._build_compartments()
+        return self._compartments
+
+    def compartment_IDs(self):
+        """Returns a list of the compartment IDs, in the order of their
+        indexes."""
+        if len(self.shape) == 1:
+            return list(range(self.shape[0]))
+        return list(np.ndindex(*self.shape))
+
+    def index(self, ID):
+        """Returns the index of the compartment with a given ID."""
+        return int(np.ravel_multi_index(np.atleast_1d(ID),self.shape))
+
+    def connectivity(self):
+        """Returns a list of the links of the array, as tuples:
+
+        (src, other_array_ID, dst, conn_type)
+
+        where src and dst are arrays of compartment indexes in this
+        array and in the other array."""
+        return [(src.copy(), other.array_ID, dst.copy(), conn_type) for src, other, dst, conn_type in self._links]
+
     def to_graph(self):
         """Returns a graph, with compartments as nodes and
         connections as edges."""
 
     def add_rxn_to_array(self, rxn):
         """Adds a reaction to each compartment in the array."""
-        for c in self.compartments.values():
-            c.add_rxn_to_compartment(rxn)
+        if self._compartments is not None:
+            for c in self._compartments.values():
+                c.add_rxn_to_compartment(rxn)
+        elif rxn.ID in [r.ID for r in self._reactions]:
+            logging.warn("Reaction {0} already in array {1}".format(rxn.ID,self.array_ID))
+        else:
+            self._reactions.append(rxn)
 
     def add_rxns_to_array(self, rxns):
         """Adds each reaction in rxns to each compartment in the array."""
@@ -29,12 +87,17 @@ class CompartmentArray(object):
         This only affects connections within the array,
         not connections between arrays."""
 
-        for c in self.compartments.values():
-            for n,c_type in c.connections.values():
+        changed = [l for l in self._links if l[1].array_ID == self.array_ID]
+        for l in changed:
+            l[3] = new_ctype
+
+        if self._compartments is not None:
+            for c in self._compartments.values():
+                for n,c_type in c.connections.values():
 
-                # check if both compartments are in same array
-                if n.array_ID == self.array_ID:
-                    c.connect(n,new_ctype,warn_overwrite=False)    
+                    # check if both compartments are in same array
+                    if n.array_ID == self.array_ID:
+                        c.connect(n,new_ctype,warn_overwrite=False)
 
     def change_all_inter_connection_type(self, other_array, new_ctype):
         """Change the connection type between the compartments in this
@@ -44,13 +107,89 @@ class CompartmentArray(object):
         This only affects connections between the arrays,
         not connections within arrays."""
 
-        for c in self.compartments.values():
-            for n,c_type in c.connections.values():
-
-                # check if other compartment is in other_array
-                if n.array_ID == other_array.array_ID:
-                    c.connect(n,new_ctype,warn_overwrite=False)    
-
+        changed = [l for l in self._links if l[1].array_ID == other_array.array_ID]
+        for l in changed:
+            l[3] = new_ctype
+
+        if self._compartments is not None:
+            for c in self._compartments.values():
+                for n,c_type in c.connections.values():
+
+                    # check if other compartment is in other_array
+                    if n.array_ID == other_array.array_ID:
+                        c.connect(n,new_ctype,warn_overwrite=False)
+
+    def _add_link(self, src, other_array, dst, conn_type):
+        link = [np.asarray(src,dtype=int).ravel(),other_array,np.asarray(dst,dtype=int).ravel(),conn_type]
+        self._links.append(link)
+        if self._compartments is not None:
+            self._wire([link])
+
+    def _grid_links(self, conn_type, periodic):
+        # connects each compartment to its face neighbours, along each
+        # axis in turn (previous, then next), then makes the periodic
+        # wraps
+        grid = np.arange(int(np.prod(self.shape))).reshape(self.shape)
+        for axis, n in enumerate(self.shape):
+            first = [slice(None)]*len(self.shape)
+            last = [slice(None)]*len(self.shape)
+            first[axis] = slice(0,n-1)
+            last[axis] = slice(1,n)
+            self._add_link(grid[tuple(last)],self,grid[tuple(first)],conn_type)
+            self._add_link(grid[tuple(first)],self,grid[tuple(last)],conn_type)
+
+        for axis, n in enumerate(self.shape):
+            if periodic[axis]:
+                lo = grid.take([0],axis=axis)
+                hi = grid.take([n-1],axis=axis)
+                self._add_link(lo,self,hi,conn_type)
+                self._add_link(hi,self,lo,conn_type)
+
+    def _build_compartments(self):
+        comps = self._make_compartments()
+        self._compartment_list = comps
+        self._tags = [makeID(self.array_ID,c.ID) for c in comps]
+        for c in comps:
+            c.reactions = list(self._reactions)
+        self._compartments = {c.ID : c for c in comps}
+        self._wire(self._links)
+
+    def _wire(self, links, warn_overwrite=True):
+        # makes the connections of the links, in the order of the
+        # compartments, and for each compartment in the order of the
+        # links (as the connections were made one at a time)
+        if len(links) == 0:
+            return
+        src = np.concatenate([l[0] for l in links])
+        link_no = np.concatenate([np.full(len(l[0]),k) for k,l in enumerate(links)])
+        pos = np.concatenate([np.arange(len(l[0])) for l in links])
+        order = np.lexsort((pos,link_no,src))
+
+        comps = self._compartment_list
+        for e in order:
+            k = link_no[e]
+            other = links[k][1]
+            if other._compartments is None:
+                other._build_compartments()
+            c = comps[src[e]]
+            d = links[k][2][pos[e]]
+            tag = other._tags[d]
+            if tag in c.connections and warn_overwrite:
+                logging.warn("Warning: overwriting connection between {0} and {1}".format(self._tags[src[e]],tag))
+            c.connections[tag] = (other._compartment_list[d],links[k][3])
+
+def _cells(edges):
+    # the (lo, hi) positions and lengths of the cells between a list of
+    # edges, and integer codes that are equal for equal lengths, so that
+    # products of lengths are computed once per distinct cell size
+    pos = [(edges[i],edges[i+1]) for i in range(len(edges)-1)]
+    lengths = [hi - lo for lo, hi in pos]
+    if all(l.units == lengths[0].units for l in lengths):
+        mags = np.array([l.magnitude for l in lengths])
+        codes = np.unique(mags,return_inverse=True)[1].ravel()
+    else:
+        codes = np.arange(len(lengths))
+    return pos, lengths, codes
                     
 class CompartmentArray1D(CompartmentArray):
     """Uses a 1D array of compartments, which are connected
@@ -74,21 +213,15 @@ class CompartmentArray1D(CompartmentArray):
 
         # set number of compartments
         self.n_compartments = len(positions)-1
+        self.positions = positions
 
-        # initialize compartment dictionary
-        self.compartments = {}
-        for i in range(len(positions)-1):
-            self.compartments[(i)] = Compartment1D((i), pos=[(positions[i],positions[i+1])], array_ID=self.array_ID)
-
-        # add connections
-        for i in range(self.n_compartments):
-            if i > 0:
-                self.compartments[(i)].connect(self.compartments[(i-1)],conn_type)
-            if i < self.n_compartments-1:
-                self.compartments[(i)].connect(self.compartments[(i+1)],conn_type)
-        if periodic:
-            self.compartments[(0)].connect(self.compartments[(self.n_compartments-1)],conn_type)
-            self.compartments[(self.n_compartments-1)].connect(self.compartments[(0)],conn_type)
+        self._init_links((self.n_compartments,))
+        self._grid_links(conn_type,[periodic])
+
+    def _make_compartments(self):
+        pos, lengths, codes = _cells(self.positions)
+        return [Compartment1D((i), pos=[pos[i]], array_ID=self.array_ID, volume=lengths[i])
+                for i in range(self.n_compartments)]
 
     def stack(self,other_array,conn_type):
         """Stacks another 1D compartment array on top of this
@@ -104,9 +237,9 @@ class CompartmentArray1D(CompartmentArray):
         assert isinstance(conn_type, Connection), "conn_type must be of type Connection"
 
         # add connections between compartments
-        for i in range(self.n_compartments):
-            self.compartments[(i)].connect(other_array.compartments[(i)],conn_type)
-            other_array.compartments[(i)].connect(self.compartments[(i)],conn_type)
+        idx = np.arange(self.n_compartments)
+        self._add_link(idx,other_array,idx,conn_type)
+        other_array._add_link(idx,self,idx,conn_type)
 
 class CompartmentArray2D(CompartmentArray):
     """Uses a 2D array of compartments, which are connected
@@ -143,39 +276,22 @@ class CompartmentArray2D(CompartmentArray):
         self.box_len = [x_pos[-1]-x_pos[0],y_pos[-1]-y_pos[0]]
         self.periodic = periodic
 
-        # initialize compartment dictionary
-        self.compartments = {}
-        for i in range(self.nx-1):
-            posx = (x_pos[i],x_pos[i+1])
-            for j in range(self.ny-1):
-                posy = (y_pos[j],y_pos[j+1])
-                self.compartments[(i,j)] = Compartment2D((i,j), pos=[posx,posy], array_ID=self.array_ID)
+        self._init_links((self.nx,self.ny))
+        self._grid_links(conn_type,periodic)
 
-        # add connections
+    def _make_compartments(self):
+        posx, lx, cx = _cells(self.x_pos)
+        posy, ly, cy = _cells(self.y_pos)
+        volumes = {}
+        comps = []
         for i in range(self.nx):
             for j in range(self.ny):
-                if i > 0:
-                    # make connection to the left
-                    self.compartments[(i,j)].connect(self.compartments[(i-1,j)],conn_type)
-                if i < self.nx-1:
-                    # make connection to the right
-                    self.compartments[(i,j)].connect(self.compartments[(i+1,j)],conn_type)
-                if j > 0:
-                    # make connection to the bottom
-                    self.compartments[(i,j)].connect(self.compartments[(i,j-1)],conn_type)
-                if j < self.ny-1:
-                    # make connection to the top
-                    self.compartments[(i,j)].connect(self.compartments[(i,j+1)],conn_type)
-
-        if periodic[0]:
-            for j in range(self.ny):
-                self.compartments[(0,j)].connect(self.compartments[(self.nx-1,j)],conn_type)
-                self.compartments[(self.nx-1,j)].connect(self.compartments[(0,j)],conn_type)
-
-        if periodic[1]:
-            for i in range(self.nx):
-                self.compartments[(i,0)].connect(self.compartments[(i,self.ny-1)],conn_type)
-                self.compartments[(i,self.ny-1)].connect(self.compartments[(i,0)],conn_type)
+                key = (cx[i],cy[j])
+                if key not in volumes:
+                    volumes[key] = lx[i]*ly[j]
+                comps.append(Compartment2D((i,j), pos=[posx[i],posy[j]], array_ID=self.array_ID,
+                                           volume=volumes[key]))
+        return comps
         
     def stack(self,other_array,conn_type):
         """Stacks another 2D compartment array on top of this
@@ -193,10 +309,9 @@ class CompartmentArray2D(CompartmentArray):
         assert isinstance(conn_type, Connection), "conn_type must be of type Connection"
 
         # add connections between compartments
-        for i in range(self.nx):
-            for j in range(self.ny):
-                self.compartments[(i,j)].connect(other_array.compartments[(i,j)],conn_type)
-                other_array.compartments[(i,j)].connect(self.compartments[(i,j)],conn_type)
+        idx = np.arange(self.n_compartments)
+        self._add_link(idx,other_array,idx,conn_type)
+        other_array._add_link(idx,self,idx,conn_type)
         
 class CompartmentArray3D(CompartmentArray):
     """Uses a 3D array of cubic compartments, which are connected
@@ -239,62 +354,29 @@ class CompartmentArray3D(CompartmentArray):
         self.box_len = [x_pos[-1]-x_pos[0],y_pos[-1]-y_pos[0],z_pos[-1]-z_pos[0]]
         self.periodic = periodic
 
-        # initialize compartment dictionary
-        self.compartments = {}
-        for i in range(len(x_pos)-1):
-            lx = x_pos[i+1]-x_pos[i]
-            posx = (x_pos[i],x_pos[i+1])
-            for j in range(len(y_pos)-1):
-                ly = y_pos[j+1]-y_pos[j]
-                posy = (y_pos[j],y_pos[j+1])
-                for k in range(len(z_pos)-1):
-                    lz = z_pos[k+1]-z_pos[k]
-                    posz = (z_pos[k],z_pos[k+1])
-                    sa = {'xy' : lx*ly, 'yz' : ly*lz, 'xz' : lx*lz}
-                    self.compartments[(i,j,k)] = Compartment3D((i,j,k),
-                                                             pos=[posx,posy,posz],
-                                                             array_ID=self.array_ID,
-                                                             surface_area=sa)
-        # add connections
+        self._init_links((self.nx,self.ny,self.nz))
+        self._grid_links(conn_type,periodic)
+
+    def _make_compartments(self):
+        posx, lx, cx = _cells(self.x_pos)
+        posy, ly, cy = _cells(self.y_pos)
+        posz, lz, cz = _cells(self.z_pos)
+        sizes = {}
+        comps = []
         for i in range(self.nx):
             for j in range(self.ny):
                 for k in range(self.nz):
-                    if i > 0:
-                        # make connection to the left
-                        self.compartments[(i,j,k)].connect(self.compartments[(i-1,j,k)],conn_type)
-                    if i < self.nx-1:
-                        # make connection to the right
-                        self.compartments[(i,j,k)].connect(self.compartments[(i+1,j,k)],conn_type)
-                    if j > 0:
-                        # make connection to the bottom
-                        self.compartments[(i,j,k)].connect(self.compartments[(i,j-1,k)],conn_type)
-                    if j < self.ny-1:
-                        # make connection to the top
-                        self.compartments[(i,j,k)].connect(self.compartments[(i,j+1,k)],conn_type)
-                    if k > 0:
-                        # make connection to the bottom
-                        self.compartments[(i,j,k)].connect(self.compartments[(i,j,k-1)],conn_type)
-                    if k < self.nz-1:
-                        # make connection to the top
-                        self.compartments[(i,j,k)].connect(self.compartments[(i,j,k+1)],conn_type)
-
-        if periodic[0]:
-            for j in range(self.ny):
-                for k in range(self.nz):
-                    self.compartments[(0,j,k)].connect(self.compartments[(self.nx-1,j,k)],conn_type)
-                    self.compartments[(self.nx-1,j,k)].connect(self.compartments[(0,j,k)],conn_type)
-
-        if periodic[1]:
-            for i in range(self.nx):
-                for k in range(self.nz):
-                    self.compartments[(i,0,k)].connect(self.compartments[(i,self.ny-1,k)],conn_type)
-                    self.compartments[(i,self.ny-1,k)].connect(self.compartments[(i,0,k)],conn_type)
-
-        if periodic[2]:
-            for i in range(self.nx):
-                for j in range(self.ny):
-                    self.compartments[(i,j,0)].connect(self.compartments[(i,j,self.nz-1)],conn_type)
-                    self.compartments[(i,j,self.nz-1)].connect(self.compartments[(i,j,0)],conn_type)
+                    key = (cx[i],cy[j],cz[k])
+                    if key not in sizes:
+                        sa = {'xy' : lx[i]*ly[j], 'yz' : ly[j]*lz[k], 'xz' : lx[i]*lz[k]}
+                        sizes[key] = (sa,lx[i]*ly[j]*lz[k])
+                    sa, volume = sizes[key]
+                    comps.append(Compartment3D((i,j,k),
+                                               pos=[posx[i],posy[j],posz[k]],
+                                               array_ID=self.array_ID,
+                                               surface_area=dict(sa),
+                                               volume=volume))
+        return comps
 
     def join3D(self,other_array,conn_type,append_side=None):
         """Joins a 3D compartment array to this
@@ -332,40 +414,18 @@ class CompartmentArray3D(CompartmentArray):
 
         assert isinstance(conn_type, Connection), "conn_type must be of type Connection"
 
-        # add connections between compartments
-        if append_side[0] == 'x':
-            if append_side[1] == '-':
-                xind1 = 0
-                xind2 = other_array.nx-1
-            else:
-                xind1 = self.nx-1
-                xind2 = 0
-            for j in range(self.ny):
-                for k in range(self.nz):
-                    self.compartments[(xind1,j,k)].connect(other_array.compartments[(xind2,j,k)],conn_type)
-                    other_array.compartments[(xind2,j,k)].connect(self.compartments[(xind1,j,k)],conn_type)
-        elif append_side[0] == 'y':
-            if append_side[1] == '-':
-                yind1 = 0
-                yind2 = other_array.ny-1
-            else:
-                yind1 = self.ny-1
-                yind2 = 0
-            for i in range(self.nx):
-                for k in range(self.nz):
-                    self.compartments[(i,yind1,k)].connect(other_array.compartments[(i,yind2,k)],conn_type)
-                    other_array.compartments[(i,yind2,k)].connect(self.compartments[(i,yind1,k)],conn_type)
-        elif append_side[0] == 'z':
-            if append_side[1] == '-':
-                zind1 = 0
-                zind2 = other_array.nz-1
-            else:
-                zind1 = self.nz-1
-                zind2 = 0
-            for i in range(self.nx):
-                for j in range(self.ny):
-                    self.compartments[(i,j,zind1)].connect(other_array.compartments[(i,j,zind2)],conn_type)
-                    other_array.compartments[(i,j,zind2)].connect(self.compartments[(i,j,zind1)],conn_type)
+        # the indexes of the compartments on the two faces, which are
+        # in the same order
+        axis = 'xyz'.index(append_side[0])
+        if append_side[1] == '-':
+            ind1 = 0
+            ind2 = other_array.shape[axis]-1
+        else:
+            ind1 = self.shape[axis]-1
+            ind2 = 0
+        face_self = np.arange(self.n_compartments).reshape(self.shape).take([ind1],axis=axis)
+        face_other = np.arange(other_array.n_compartments).reshape(other_array.shape).take([ind2],axis=axis)
 
-        
-        
+        # add connections between compartments
+        self._add_link(face_self,other_array,face_other,conn_type)
+        other_array._add_link(face_other,self,face_self,conn_type)
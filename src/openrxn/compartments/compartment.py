@@ -14,6 +14,9 @@ class Compartment(object):
     pos is array-like, where the length of the array denotes the 
     dimensionality of the space.
 
+    volume is optional; Compartment1D/2D/3D compute it from pos if it
+    is not given.
+
     self.reactions is a list of reactions that occur in this compartment
 
     self.connections is a list of compartment IDs that this compartment
@@ -84,11 +87,11 @@ class Compartment(object):
             new_aID = self.array_ID
 
         if hasattr(self,'surface_area'):
-            new_comp = type(self)(newID, pos=self.pos, array_ID=new_aID, surface_area=self.surface_area)
+            new_comp = type(self)(newID, pos=self.pos, array_ID=new_aID, surface_area=self.surface_area,
+                                  volume=self.volume)
         else:
-            new_comp = type(self)(newID, pos=self.pos, array_ID=new_aID)
+            new_comp = type(self)(newID, pos=self.pos, array_ID=new_aID, volume=self.volume)
             
-        new_comp.volume = self.volume
         new_comp.connections = self.connections
         new_comp.reactions = self.reactions
 
@@ -100,8 +103,9 @@ class Compartment1D(Compartment):
         super().__init__(*args, **kwargs)
 
         assert len(self.pos)==1, "Error! position must be of length 1 for Compartment1D objects"
-        self.volume = (self.pos[0][1]-self.pos[0][0])
-        self.volume.to(unit.nm)
+        if self.volume is None:
+            self.volume = (self.pos[0][1]-self.pos[0][0])
+            self.volume.to(unit.nm)
 
 class Compartment2D(Compartment):
 
@@ -109,8 +113,9 @@ class Compartment2D(Compartment):
         super().__init__(*args, **kwargs)
 
         assert len(self.pos)==2, "Error! position must be of length 2 for Compartment2D objects"
-        self.volume = (self.pos[0][1]-self.pos[0][0])*(self.pos[1][1]-self.pos[1][0])
-        self.volume.to(unit.nm**2)
+        if self.volume is None:
+            self.volume = (self.pos[0][1]-self.pos[0][0])*(self.pos[1][1]-self.pos[1][0])
+            self.volume.to(unit.nm**2)
 
 class Compartment3D(Compartment):
     """
@@ -124,8 +129,9 @@ class Compartment3D(Compartment):
 
         self.surface_area = surface_area
         assert len(self.pos)==3, "Error! position must be of length 3 for Compartment3D objects"
-        self.volume = (self.pos[0][1]-self.pos[0][0])*(self.pos[1][1]-self.pos[1][0])*(self.pos[2][1]-self.pos[2][0])
-        self.volume.to(unit.nm**3)
+        if self.volume is None:
+            self.volume = (self.pos[0][1]-self.pos[0][0])*(self.pos[1][1]-self.pos[1][0])*(self.pos[2][1]-self.pos[2][0])
+            self.volume.to(unit.nm**3)
 
 class Reservoir(Compartment):
     """
@@ -144,10 +150,7 @@ class Reservoir(Compartment):
             concs[key].ito(1/unit.nm**3)
 
             ## define a concentration function and attach it
-            def tmp_conc_func(t):
-                return concs[key].ito(1/unit.nm**3)
-            
-            self.conc_funcs[key] = tmp_conc_func
+            self.conc_funcs[key] = ConstantConc(concs[key])
 
         # add keys from conc_funcs into self.conc_funcs
         for key in conc_funcs.keys():
@@ -172,3 +175,13 @@ class Reservoir(Compartment):
         new_comp = Reservoir(newID, array_ID=new_aID, conc_funcs=self.conc_funcs)
             
         return new_comp
+
+class ConstantConc(object):
+    """A concentration function that returns the same
+    concentration at all times."""
+
+    def __init__(self, conc):
+        self.conc = conc
+
+    def __call__(self, t):
+        return self.conc
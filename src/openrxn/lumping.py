@@ -0,0 +1,378 @@
+"""Lumping merges groups of compartments of a FlatModel into single
+compartments, to build smaller (coarse-grained) models, e.g. for fast
+screening runs:
+
+partition = block_partition(flat_model, (4,4,2))
+lumped = LumpedModel(flat_model, partition)
+s = ODESystem(lumped.flat_model)
+s.state.q_val = lumped.restrict(full_state, s.state)
+s.run(10)
+q = lumped.project(s.state, full_state)
+
+A partition is a dictionary that maps each compartment ID of the
+FlatModel to the ID of its lump.  Partitions can be made by hand, by
+grouping blocks of the compartments of arrays (block_partition), or by
+splitting the graph of connections into k pieces (graph_partition).
+
+Each lump is treated as well mixed, so that the concentration of a
+species is the same in all of its compartments:
+
+- the volume of a lump is the sum of the volumes of its compartments
+- transport between two lumps is a DivByVConnection whose rates are
+  the sums of the conductances (rate in 1/s times the volume of the
+  source compartment, i.e. D*A/d for resolved Fick's connections) of
+  the connections between their compartments
+- a lump gets a copy of each reaction of its compartments, with rate
+  constants weighted by the fraction of the volume of the lump where
+  the reaction occurs (zero-order rates, which are per compartment,
+  are summed)
+- connections to Reservoirs are summed in the same way
+
+Reservoirs are never merged with other compartments.
+"""
+
+from openrxn.model import FlatModel
+from openrxn.compartments.compartment import Compartment, Compartment1D, Compartment2D, Compartment3D, Reservoir
+from openrxn.compartments.ID import makeID
+from openrxn.connections import DivByVConnection
+from openrxn import unit
+
+import numpy as np
+import copy
+
+def block_partition(flat_model, block):
+    """Returns a partition that groups the compartments of arrays in
+    blocks of the given size (an int, or a tuple with one size per
+    dimension of the array).  The compartment 'bulk-4_5_1' is in lump
+    'bulk-2_2_0' for block=(2,2,2).  Compartments that are not part
+    of an array are lumps of their own."""
+
+    partition = {}
+    for tag in flat_model.compartments:
+        idx = _array_index(tag)
+        if idx is None or isinstance(flat_model.compartments[tag],Reservoir):
+            partition[tag] = tag
+            continue
+        array_ID, idx = idx
+        size = np.broadcast_to(block,(len(idx),))
+        partition[tag] = makeID(array_ID,tuple(int(i//b) for i,b in zip(idx,size)))
+    return partition
+
+def _array_index(tag):
+    # the array ID and index of a compartment ID made by makeID
+    # (e.g. 'bulk-4_5_1'), or None
+    if not isinstance(tag,str) or '-' not in tag:
+        return None
+    array_ID, idx = tag.rsplit('-',1)
+    try:
+        return array_ID, [int(i) for i in idx.split('_')]
+    except ValueError:
+        return None
+
+def graph_partition(flat_model, k, prefix='lump'):
+    """Returns a partition of the compartments into k lumps of about
+    equal size, by recursive spectral bisection of the graph of
+    connections (each piece is split along the Fiedler vector of its
+    graph Laplacian).  Lumps are named prefix-0 ... prefix-(k-1), and
+    Reservoirs are lumps of their own."""
+    from scipy import sparse
+
+    names = flat_model.compartment_names()
+    res = np.array([isinstance(flat_model.compartments[c],Reservoir) for c in names],dtype=bool)
+    nodes = np.nonzero(~res)[0]
+    if k < 1 or k > len(nodes):
+        raise ValueError("Error! k must be between 1 and the number of compartments ({0})".format(len(nodes)))
+
+    src, dst = flat_model.edge_arrays()
+    keep = ~res[src] & ~res[dst] & (src != dst)
+    pos = np.full(len(names),-1)
+    pos[nodes] = np.arange(len(nodes))
+    n = len(nodes)
+    A = sparse.csr_matrix((np.ones(keep.sum()),(pos[src[keep]],pos[dst[keep]])),shape=(n,n))
+    A = ((A + A.T) > 0).astype(float).tocsr()
+
+    labels = np.zeros(n,dtype=int)
+    pieces = [(np.arange(n),k)]
+    next_label = 0
+    while len(pieces) > 0:
+        idx, kp = pieces.pop()
+        if kp == 1:
+            labels[idx] = next_label
+            next_label += 1
+            continue
+        order = np.lexsort((np.arange(len(idx)),_fiedler(A[idx][:,idx])))
+        k1 = kp//2
+        n1 = int(round(len(idx)*k1/kp))
+        n1 = min(max(n1,k1),len(idx)-(kp-k1))
+        pieces.append((idx[order[n1:]],kp-k1))
+        pieces.append((idx[order[:n1]],k1))
+
+    partition = {}
+    for i, c in enumerate(names):
+        partition[c] = c if res[i] else "{0}-{1}".format(prefix,labels[pos[i]])
+    return partition
+
+def _fiedler(A):
+    # the eigenvector of the second smallest eigenvalue of the graph
+    # Laplacian of A, with a fixed sign
+    from scipy import sparse
+    from scipy.sparse.linalg import eigsh
+
+    n = A.shape[0]
+    deg = np.asarray(A.sum(axis=1)).ravel()
+    L = sparse.diags(deg) - A
+    if n <= 500:
+        w, v = np.linalg.eigh(L.toarray())
+    else:
+        # shift-invert around a point just below the spectrum
+        v0 = np.linspace(-1,1,n)
+        w, v = eigsh(L.tocsc(),k=2,sigma=-1e-3*max(deg.mean(),1),which='LM',v0=v0)
+        order = np.argsort(w)
+        w, v = w[order], v[:,order]
+    f = v[:,1]
+    return -f if f[np.argmax(np.abs(f))] < 0 else f
+
+class LumpedModel(object):
+
+    def __init__(self, flat_model, partition):
+        """Builds flat_model, a FlatModel with one compartment per lump
+        of partition (a dictionary that maps each compartment ID of the
+        original flat_model to the ID of its lump)."""
+
+        self.original = flat_model
+        missing = [c for c in flat_model.compartments if c not in partition]
+        if len(missing) > 0:
+            raise ValueError("Error! Compartments are missing from the partition ({0})".format(missing[:5]))
+        self.partition = {c : makeID(None,partition[c]) for c in flat_model.compartments}
+
+        # lumps, in the order of their first compartment
+        self.lumps = {}
+        for c, lump in self.partition.items():
+            self.lumps.setdefault(lump,[]).append(c)
+        for lump, members in self.lumps.items():
+            if len(members) > 1 and any(isinstance(flat_model.compartments[c],Reservoir) for c in members):
+                raise ValueError("Error! Reservoirs can not be lumped with other compartments ({0})".format(lump))
+
+        self._units_cache = {}
+        self._volumes = {}
+        self._dims = {}
+        for c, comp in flat_model.compartments.items():
+            if isinstance(comp,Reservoir):
+                continue
+            if comp.volume is None:
+                raise ValueError("Error! Compartments need volumes to be lumped ({0})".format(c))
+            dim = comp.volume.dimensionality.get('[length]',0)
+            self._dims[c] = dim
+            self._volumes[c] = _magnitude(comp.volume,self._units(('volume',dim)))
+
+        self._lump_volumes = {lump : sum(self._volumes.get(c,0) for c in members)
+                              for lump, members in self.lumps.items()}
+        self._rate_cache = {}
+
+        self.flat_model = self._build()
+
+    def _lump_volume(self, lump):
+        return self._lump_volumes[lump]
+
+    def _rates(self, conn):
+        # the rate magnitudes of a connection (in nm^dim/s for
+        # DivByVConnections, 1/s otherwise), converted once per
+        # connection object since Pint conversions are slow
+        if id(conn) not in self._rate_cache:
+            if isinstance(conn,DivByVConnection):
+                k_units = self._units(('divbyv',conn.dim))
+            else:
+                k_units = self._units('rate')
+            self._rate_cache[id(conn)] = {s : (_magnitude(k0,k_units),_magnitude(k1,k_units))
+                                          for s,(k0,k1) in conn.species_rates.items()}
+        return self._rate_cache[id(conn)]
+
+    def _units(self, key):
+        if key not in self._units_cache:
+            if key == 'rate':
+                self._units_cache[key] = 1/unit.sec
+            elif key[0] == 'divbyv':
+                self._units_cache[key] = unit.nm**key[1]/unit.sec
+            else:
+                self._units_cache[key] = unit.nm**key[1]
+        return self._units_cache[key]
+
+    def _build(self):
+        model = self.original
+        comps = {}
+        for lump, members in self.lumps.items():
+            first = model.compartments[members[0]]
+            if isinstance(first,Reservoir):
+                if len(first.connections) > 0:
+                    raise ValueError("Error! Reservoirs with connections can not be lumped ({0})".format(lump))
+                comps[lump] = first
+                continue
+            dims = set(self._dims[c] for c in members)
+            if len(dims) > 1:
+                raise ValueError("Error! Compartments of different dimensions can not be lumped ({0})".format(lump))
+            dim = dims.pop()
+            comps[lump] = _lump_compartment(lump,[model.compartments[c] for c in members],
+                                            unit.Quantity(self._lump_volume(lump),unit.nm**dim))
+            comps[lump].reactions = self._lump_reactions(lump)
+
+        # conductances (in nm^dim/s) of the transport between the
+        # compartments of different lumps, as in ODESystem: the rate from
+        # i to j is the out rate of the connection of i to j, or the in
+        # rate of the connection of j to i if i has no connection to j
+        out_k = {}
+        in_k = {}
+        res_k = {}
+        for c_tag, c in model.compartments.items():
+            if isinstance(c,Reservoir):
+                continue
+            for other_lab, (other, conn) in c.connections.items():
+                divbyv = isinstance(conn,DivByVConnection)
+                to_res = isinstance(model.compartments[other_lab],Reservoir)
+                if to_res and not divbyv:
+                    raise ValueError("Error! Only DivByVConnections to Reservoirs can be lumped ({0})".format(c_tag))
+                for s, (k0, k1) in self._rates(conn).items():
+                    if to_res:
+                        key = (self.partition[c_tag],other_lab,s)
+                        k_res = res_k.get(key,(0,0))
+                        res_k[key] = (k_res[0] + k0,k_res[1] + k1)
+                        continue
+                    if divbyv:
+                        k_out, k_in = k0, k1
+                    else:
+                        k_out = k0*self._volumes[c_tag]
+                        k_in = k1*self._volumes[other_lab]
+                    out_k[(c_tag,other_lab,s)] = k_out
+                    in_k[(other_lab,c_tag,s)] = k_in
+        for key, k in in_k.items():
+            if key not in out_k:
+                out_k[key] = k
+
+        lump_k = {}
+        for (i, j, s), k in out_k.items():
+            I, J = self.partition[i], self.partition[j]
+            if I != J and k > 0:
+                lump_k[(I,J,s)] = lump_k.get((I,J,s),0) + k
+
+        rates = {}
+        for (I, J, s), k in lump_k.items():
+            rates.setdefault((I,J),{})[s] = (k,lump_k.get((J,I,s),0))
+            rates.setdefault((J,I),{})[s] = (lump_k.get((J,I,s),0),k)
+        for (I, J), species_rates in rates.items():
+            dim = self._dims[self.lumps[I][0]]
+            k_units = unit.nm**dim/unit.sec
+            conn = DivByVConnection({s : (unit.Quantity(k0,k_units),unit.Quantity(k1,k_units))
+                                     for s,(k0,k1) in species_rates.items()},dim=dim)
+            comps[I].connections[J] = (comps[J],conn)
+
+        res_rates = {}
+        for (I, R, s), k in res_k.items():
+            res_rates.setdefault((I,R),{})[s] = k
+        for (I, R), species_rates in res_rates.items():
+            dim = self._dims[self.lumps[I][0]]
+            k_units = unit.nm**dim/unit.sec
+            conn = DivByVConnection({s : (unit.Quantity(k0,k_units),unit.Quantity(k1,k_units))
+                                     for s,(k0,k1) in species_rates.items()},dim=dim)
+            comps[I].connections[R] = (comps[R],conn)
+
+        flat = FlatModel()
+        flat.add_compartments(comps.values())
+        return flat
+
+    def _lump_reactions(self, lump):
+        # one reaction per reaction ID of the compartments of a lump,
+        # with volume-weighted rate constants (summed for zero order)
+        members = self.lumps[lump]
+        V = self._lump_volume(lump)
+        reactions = {}
+        weights = {}
+        for c in members:
+            for r in self.original.compartments[c].reactions:
+                reactions.setdefault(r.ID,[]).append(r)
+                weights.setdefault(r.ID,[]).append(self._volumes[c]/V)
+
+        lumped = []
+        for ID, rxns in reactions.items():
+            w = weights[ID]
+            r = copy.copy(rxns[0])
+            if len(rxns) == len(members) and all(x is rxns[0] for x in rxns):
+                # the same reaction everywhere: only sources change
+                if len(r.reactants) > 0 and len(r.products) > 0:
+                    lumped.append(rxns[0])
+                    continue
+            r.kf = _lump_rate([x.kf for x in rxns],w,len(r.reactants) == 0)
+            r.kr = _lump_rate([x.kr for x in rxns],w,len(r.products) == 0)
+            lumped.append(r)
+        return lumped
+
+    def _entries(self, state, lumped_state):
+        # the lumped entry of each entry of state, and its volume fraction
+        lump_of = np.array([self.partition[c] for c in state.compartment_names])
+        idx = lumped_state.index.lookup(lump_of[state.compartment_codes],state.species)
+        frac = np.array([self._volumes[c]/self._lump_volume(self.partition[c]) if c in self._volumes else 1.0
+                         for c in state.compartment_names])
+        return idx, frac[state.compartment_codes]
+
+    def restrict(self, state, lumped_state, q=None):
+        """Returns the quantities of the entries of lumped_state (a State
+        of flat_model), which are the sums of the quantities q (default:
+        state.q_val) of the entries of state (a State of the original
+        model).  q can also be an array of frames, e.g. a trajectory,
+        with the entries along the last axis."""
+
+        if q is None:
+            q = state.q_val
+        idx, frac = self._entries(state,lumped_state)
+        q = np.asarray(q)
+        out = np.zeros(q.shape[:-1] + (lumped_state.size,))
+        np.add.at(out,(Ellipsis,idx),q)
+        return out
+
+    def project(self, lumped_state, state, q=None):
+        """Returns the quantities of the entries of state (a State of the
+        original model), given the quantities q (default:
+        lumped_state.q_val) of lumped_state.  The quantity of a lump is
+        split between its compartments in proportion to their volumes,
+        so that concentrations are uniform within each lump.  q can also
+        be an array of frames, with the entries along the last axis."""
+
+        if q is None:
+            q = lumped_state.q_val
+        idx, frac = self._entries(state,lumped_state)
+        return np.asarray(q)[...,idx]*frac
+
+def _magnitude(x, to_units):
+    # connections and arrays already store their values in these units
+    if x.units == to_units:
+        return x.magnitude
+    return x.to(to_units).magnitude
+
+def _lump_compartment(ID, members, volume):
+    # a compartment that spans the bounding box of its members (when
+    # they all have positions of the same dimension)
+    classes = {1 : Compartment1D, 2 : Compartment2D, 3 : Compartment3D}
+    dims = set(len(c.pos) for c in members)
+    if len(dims) == 1:
+        dim = dims.pop()
+        if dim in classes and all(isinstance(c,classes[dim]) for c in members):
+            nm = unit.nm
+            pos = []
+            for a in range(dim):
+                lo = [c.pos[a][0] for c in members]
+                hi = [c.pos[a][1] for c in members]
+                pos.append((lo[int(np.argmin([_magnitude(x,nm) for x in lo]))],
+                            hi[int(np.argmax([_magnitude(x,nm) for x in hi]))]))
+            return classes[dim](ID,pos=pos,volume=volume)
+    return Compartment(ID,volume=volume)
+
+def _lump_rate(rates, weights, zero_order):
+    # volume-weighted sum of rate constants (or the plain sum for
+    # zero-order reactions, whose rates are per compartment)
+    if zero_order:
+        total = rates[0]
+        for k in rates[1:]:
+            total = total + k
+        return total
+    total = rates[0]*weights[0]
+    for k, w in zip(rates[1:],weights[1:]):
+        total = total + k*w
+    return total
@@ -4,13 +4,13 @@ reactions one at a time, or a new model can be defined
 using a template, and then edited.
 """
 
-from openrxn.compartments.compartment import Compartment
+from openrxn.compartments.compartment import Compartment, Reservoir
 from openrxn.reactions import Reaction
 from openrxn.compartments.ID import makeID
-from openrxn.connections import FicksConnection, ResConnection
+from openrxn.connections import FicksConnection, ResConnection, DivByVConnection
+from openrxn import unit
 
 import numpy as np
-import networkx as nx
 
 class Model(object):
     """Models can hold both compartments and compartment 
@@ -196,7 +196,11 @@ class FlatModel(object):
     joined together with underscores.  (e.g. bulk-0_0_1)
 
     If arrays are not present then the identifiers are simply the 
-    compartment IDs."""
+    compartment IDs.
+
+    The connection topology and the transport rates can be exported 
+    as plain edge arrays (edge_arrays), as scipy.sparse matrices 
+    (adjacency_matrix, laplacian) or as a networkx graph (to_graph)."""
 
     def __init__(self):
         self.compartments = {}
@@ -242,32 +246,181 @@ class FlatModel(object):
             assert c in self.compartments, "Error! compartment {0} is not in Model".format(c)
             self.compartments[c].add_rxn_to_compartment(rxn)
     
+    def compartment_names(self):
+        """Returns a list of the compartment IDs, in the order that is 
+        used by the edge arrays and matrices below."""
+        return list(self.compartments.keys())
+
+    def edge_arrays(self, species=None):
+        """Returns the connections as plain arrays, with compartments
+        given by their position in compartment_names().
+
+        If species is None, returns (src, dst), with one element for
+        each connection (from src to dst) of each compartment.
+
+        If species is given, returns (src, dst, rates), with one 
+        element for each pair of compartments with a transport rate 
+        of that species from src to dst, in 1/s (DivByVConnection 
+        rates are divided by the volume of src, as in ODESystem).  
+        The rate from src to dst is the out rate of the connection of
+        src to dst, or, if there is no such connection, the in rate of 
+        the connection of dst to src.  Transport out of Reservoirs does 
+        not depend on the state, and is not included."""
+
+        names, src, dst, conns = self._connection_lists()
+        if species is None:
+            return src, dst
+
+        n = len(names)
+        k_out, k_in = self._transport_rates(names,src,dst,conns,species)
+        out_keys = src*n + dst
+        has_out = k_out > 0
+
+        # in rates that are not given by a connection in the other direction
+        reservoir = np.array([isinstance(self.compartments[c],Reservoir) for c in names],dtype=bool)
+        use_in = (k_in > 0) & ~np.isin(dst*n + src,out_keys[has_out]) & ~reservoir[dst]
+
+        rev_src, rev_dst = dst[use_in], src[use_in]
+        all_src = np.concatenate((src[has_out],rev_src))
+        all_dst = np.concatenate((dst[has_out],rev_dst))
+        rates = np.concatenate((k_out[has_out],k_in[use_in]))
+
+        # one element per pair of compartments
+        keys, first = np.unique(all_src*n + all_dst,return_index=True)
+        return all_src[first], all_dst[first], rates[first]
+
+    def adjacency_matrix(self, species=None):
+        """Returns a scipy.sparse CSR matrix A, where A[i,j] is 1 if 
+        compartment i has a connection to compartment j (species=None),
+        or the transport rate of species from i to j in 1/s (see 
+        edge_arrays)."""
+        from scipy import sparse
+
+        n = len(self.compartments)
+        if species is None:
+            src, dst = self.edge_arrays()
+            data = np.ones(len(src))
+        else:
+            src, dst, data = self.edge_arrays(species)
+        A = sparse.csr_matrix((data,(src,dst)),shape=(n,n))
+        A.sum_duplicates()
+        return A
+
+    def laplacian(self, species):
+        """Returns the transport operator of a species as a scipy.sparse
+        CSR matrix L, such that dq/dt = L q is the rate of change of the 
+        quantities q of that species in each compartment due to transport
+        (compartments are in the order of compartment_names()).  The 
+        columns of L sum to zero."""
+        from scipy import sparse
+
+        A = self.adjacency_matrix(species)
+        out_rate = np.asarray(A.sum(axis=1)).ravel()
+        return (A.T - sparse.diags(out_rate)).tocsr()
+
+    def transported_species(self):
+        """Returns a sorted list of the species that have connections."""
+        species = set()
+        seen = set()
+        for c in self.compartments.values():
+            for other, conn in c.connections.values():
+                if id(conn) not in seen:
+                    seen.add(id(conn))
+                    species.update(conn.species_rates.keys())
+        return sorted(species)
+
+    def _connection_lists(self):
+        # the connections of all compartments, with compartments given
+        # by their position in compartment_names()
+        names = self.compartment_names()
+        code = {c:i for i,c in enumerate(names)}
+        src = []
+        dst = []
+        conns = []
+        for i, c in enumerate(self.compartments.values()):
+            for other_lab, conn in c.connections.items():
+                src.append(i)
+                dst.append(code[other_lab])
+                conns.append(conn)
+        return names, np.array(src,dtype=int), np.array(dst,dtype=int), conns
+
+    def _transport_rates(self, names, src, dst, conns, species):
+        # the out and in rates (in 1/s) of a species along each 
+        # connection.  Rates are converted once per connection object
+        # (which are shared, e.g. within arrays) and volumes once per 
+        # compartment, since Pint operations are slow.
+        k_out = np.zeros(len(conns))
+        k_in = np.zeros(len(conns))
+        rate_cache = {}
+        vol_cache = {}
+        units_cache = {}
+
+        def magnitude(x, to_units):
+            # connections already store their rates in these units
+            if x.units == to_units:
+                return x.magnitude
+            return x.to(to_units).magnitude
+
+        def volume(i, dim):
+            if (i,dim) not in vol_cache:
+                v = self.compartments[names[i]].volume
+                vol_cache[(i,dim)] = np.nan if v is None else magnitude(v,units_cache[dim])
+            return vol_cache[(i,dim)]
+
+        for e, (other, conn) in enumerate(conns):
+            if species not in conn.species_rates:
+                continue
+            if id(conn) not in rate_cache:
+                if isinstance(conn,DivByVConnection):
+                    if conn.dim not in units_cache:
+                        units_cache[conn.dim] = unit.nm**conn.dim
+                        units_cache[('rate',conn.dim)] = unit.nm**conn.dim/unit.sec
+                    to_units = units_cache[('rate',conn.dim)]
+                else:
+                    if 'rate' not in units_cache:
+                        units_cache['rate'] = 1/unit.sec
+                    to_units = units_cache['rate']
+                k = conn.species_rates[species]
+                rate_cache[id(conn)] = (magnitude(k[0],to_units),magnitude(k[1],to_units))
+            k0, k1 = rate_cache[id(conn)]
+            if isinstance(conn,DivByVConnection):
+                k0 = k0/volume(src[e],conn.dim)
+                k1 = k1/volume(dst[e],conn.dim)
+            k_out[e] = k0
+            k_in[e] = k1
+        return k_out, k_in
+
     def to_graph(self,scale=10):
         """Exports a networkX.DiGraph where the nodes are 
-        compartments and the edges are connections."""
+        compartments and the edges are connections.  The edges hold
+        the out rate of each species of the connection (as a 
+        magnitude).  The graph is built in bulk from the edge lists."""
 
-        graph = nx.DiGraph()
+        # networkx is only needed here
+        import networkx as nx
 
-        # add all the nodes
-        for c_name, c in self.compartments.items():
-            graph.add_node(c_name)
-            graph.node[c_name]['viz'] = {}
+        names, src, dst, conns = self._connection_lists()
 
-            x = scale*0.5*(c.pos[0][0] + c.pos[0][1]).magnitude
-            y = scale*0.5*(c.pos[1][0] + c.pos[1][1]).magnitude
-            z = scale*0.5*(c.pos[2][0] + c.pos[2][1]).magnitude
-            vis_x,vis_y = self._project_xy((x,y,z))
-            
-            graph.node[c_name]['viz']['position'] = {'x': float(vis_x), 'y': float(vis_y)}
-
-        # build an edges list
-        edges = []
+        nodes = []
         for c_name, c in self.compartments.items():
-            for e_name, conn in c.connections.items():
-                new_rates_dict = {}
-                for spec, tup in conn[1].species_rates.items():
-                    new_rates_dict[spec] = tup[0].magnitude
-                edges.append((c_name,e_name,new_rates_dict))
+            centers = [0.0,0.0,0.0]
+            for i, (lo, hi) in enumerate(c.pos):
+                # the same as (lo + hi).magnitude, without Pint arithmetic
+                hi = hi.magnitude if hi.units == lo.units else hi.to(lo.units).magnitude
+                centers[i] = scale*0.5*(lo.magnitude + hi)
+            vis_x,vis_y = self._project_xy(centers)
+            nodes.append((c_name,{'viz' : {'position' : {'x': float(vis_x), 'y': float(vis_y)}}}))
+
+        # rate dictionaries are built once per connection object
+        attr_cache = {}
+        edges = []
+        for i, j, (other, conn) in zip(src,dst,conns):
+            if id(conn) not in attr_cache:
+                attr_cache[id(conn)] = {spec : tup[0].magnitude for spec, tup in conn.species_rates.items()}
+            edges.append((names[i],names[j],dict(attr_cache[id(conn)])))
+
+        graph = nx.DiGraph()
+        graph.add_nodes_from(nodes)
         graph.add_edges_from(edges)
 
         return graph
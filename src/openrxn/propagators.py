@@ -1,6 +1,6 @@
 import numpy as np
 
-def Gillespie(processes,update_list,time_range,y0):
+def Gillespie(processes,update_list,time_range,y0,events=[],stats=None):
     """A propagator function that moves the state vector (y)
     forward in time.
 
@@ -26,10 +26,26 @@ def Gillespie(processes,update_list,time_range,y0):
 
     y0 :         the initial value of the state vector
 
+    events :     a list of Event objects (see openrxn.systems.events).
+                 The value of each event is updated incrementally
+                 after reactions that change one of its quantities.
+                 The propagator stops after the reaction that triggers
+                 a terminal event.
+
+    stats :      if a dictionary is given, the number of reactions
+                 executed ('ssa_events') and of propensities that were
+                 recomputed ('propensity_updates') are stored in it.
+
     Returns:
 
     y_final :    the final value of the state vector
-    t_final :    the actual final time
+    t_final :    the actual final time.  This is equal to time_range[1]
+                 unless a terminal event occurred; the reaction that
+                 would occur after time_range[1] is discarded, which
+                 (as the waiting times are memoryless) does not bias
+                 the next call.
+    t_events :   a list with the times of each event
+    terminated : whether a terminal event occurred
     """
 
     t = time_range[0]
@@ -46,34 +62,74 @@ def Gillespie(processes,update_list,time_range,y0):
             for j in range(num):
                 r[i] *= max(0,y[idx]-j)
 
-    while t < time_range[1]:
+    # the events that each quantity is involved in, with its weight
+    event_list = {}
+    for k, e in enumerate(events):
+        for idx, w in zip(e.selection_idxs,e.weights):
+            event_list.setdefault(idx,[]).append((k,w))
+    event_vals = [e.value(y) for e in events]
+    t_events = [[] for e in events]
+    terminated = False
+    n_events = 0
+    n_updates = 0
+
+    while t < time_range[1] and not terminated:
         # keep track of processes that will need to be updated
         to_update = []
         
+        rsum = r.sum()
+        if rsum <= 0:
+            # no more reactions can occur
+            t = time_range[1]
+            break
+
         # save 1/rsum since multiplication is faster
-        oorsum = 1/r.sum()
-        
+        oorsum = 1/rsum
+
+        # time of the next reaction (a is in (0,1])
+        a = 1 - np.random.random()
+        tau = -np.log(a)*oorsum
+        if t + tau > time_range[1]:
+            t = time_range[1]
+            break
+        t += tau
+
         # choose a reaction to execute
         i = np.random.choice(range(n),p=r*oorsum)
 
-        # update y
+        # update y, and the values of the events
+        changed = {}
         for idx, d in processes[i][2]:
             y[idx] += d
             to_update += update_list[idx]
+            for k, w in event_list.get(idx,[]):
+                if k not in changed:
+                    changed[k] = event_vals[k]
+                event_vals[k] += w*d
 
-        # update t
-        a = np.random.random()
-        t += -np.log(a)*oorsum
+        for k, old in changed.items():
+            if events[k].crossed(old,event_vals[k]):
+                t_events[k].append(t)
+                if events[k].terminal:
+                    terminated = True
+
+        n_events += 1
+        to_update = set(to_update)
+        n_updates += len(to_update)
 
         # update only the necessary r values
-        for i in set(to_update):
+        for i in to_update:
             r[i] = processes[i][0]
             for idx, num in processes[i][1]:
                 # for a two-body reaction:  r = k*y*(y-1)
                 for j in range(num):
                     r[i] *= max(0,y[idx]-j)
 
-    return y, t
+    if stats is not None:
+        stats['ssa_events'] = n_events
+        stats['propensity_updates'] = n_updates
+
+    return y, t, t_events, terminated
 
         
 
@@ -16,7 +16,6 @@ that govern the number count updates if that reaction is chosen.
 
 from openrxn import unit
 from openrxn.systems.state import State
-from openrxn.systems.deriv import DerivFuncBuilder
 from openrxn.systems.system import System
 from openrxn.propagators import Gillespie
 from openrxn.compartments.compartment import Reservoir
@@ -29,20 +28,36 @@ EPSILON = 1e-8
 
 class GillespieSystem(System):
 
+    integer_q = True
+
     def __init__(self, *args, **kwargs):
 
         super().__init__(*args,**kwargs)
-        self.processes, self.process_update_list = self._build_processes()
+        with self._phase('build'):
+            self.processes, self.process_update_list = self._build_processes()
 
     def propagate(self,t_interval,**kwargs):
         """
         Interfaces with openrxn.propagators.Gillespie()
+
+        Returns a dictionary with the final state vector ('y'), the 
+        final time ('final_t'), the times of the events in self.events
+        ('t_events') and a status that is 1 if a terminal event 
+        occurred (following scipy's solve_ivp), and 0 otherwise.
         """
 
-        new_q, final_t = Gillespie(self.processes,self.process_update_list,t_interval,self.state.q_val)
+        stats = {} if self.profiler is not None else None
+        new_q, final_t, t_events, terminated = Gillespie(self.processes,self.process_update_list,
+                                                         t_interval,self.state.q_val,self.events,
+                                                         stats=stats)
         self.state.q_val = new_q
+        self._record_events(t_events)
+        if stats is not None:
+            for name, n in stats.items():
+                self.profiler.count(name,n)
 
-        return (new_q, final_t)
+        return {'y' : new_q, 'final_t' : final_t, 't_events' : t_events,
+                'status' : 1 if terminated else 0}
 
     def _build_processes(self):
         """
@@ -120,7 +135,7 @@ class GillespieSystem(System):
                     # add "out" diffusion process
                     # Note: volumes must be defined if diffusion processes are occurring
                     #
-                    if isinstance(conn,DivByVConnection):
+                    if isinstance(conn[1],DivByVConnection):
                         processes.append((self._cast_rate(conn[1].species_rates[s][0]/c.volume),
                                           [(self.state.index[c.ID][s],1)],
                                           [(self.state.index[c.ID][s],-1), (self.state.index[other_lab][s],1)]))
@@ -143,7 +158,7 @@ class GillespieSystem(System):
                                      
         return processes, process_update_list
 
-    def set_q(self,idxs,Q):
+    def set_q(self,idxs,Q,sample='round'):
         """Set the state.q_val array at the specified indexes
         to the value Q.
 
@@ -151,16 +166,16 @@ class GillespieSystem(System):
         List of indexes to set.
 
         Q  : Quantity 
-        Must be a unitless integer.
-        """
+        A number of molecules (unitless), or an amount or concentration
+        that is converted to numbers of molecules using the compartment
+        volumes.  Q can also be an array with one value per index.
 
-        if hasattr(Q,'units'):
-            if Q.units != unit.dimensionless:
-                raise ValueError("Quantity values for Gillespie systems must be dimensionless")
-            else:
-                Q = Q.magnitude
+        sample : 'round' or 'poisson'
+        Whether the numbers of molecules are rounded to the nearest 
+        integer, or sampled from a Poisson distribution (see set_q_array).
+        """
 
-        self.state.q_val[idxs] = Q
+        self.set_q_array(Q,idxs,sample)
 
     def _cast_rate(self,rate):
         # checks rates to make sure they are in the correct units (1/s), and then
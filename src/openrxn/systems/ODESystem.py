@@ -4,25 +4,40 @@ scipy's solve_idp function."""
 
 from openrxn import unit
 from openrxn.systems.state import State
-from openrxn.systems.deriv import DerivFuncBuilder
+from openrxn.systems.deriv import MassActionNetwork
+from openrxn.systems.conservation import ConservationLaws
 from openrxn.systems.system import System
+from openrxn.systems.spectral import SpectralDiffusion
+from openrxn.systems.exponential import SplitIntegrator, METHODS as SPLIT_METHODS
+from openrxn.systems.krylov import KrylovBDF
 from openrxn.compartments.compartment import Reservoir
 from openrxn.connections import DivByVConnection
 
 from scipy.integrate import solve_ivp
+from scipy.optimize import OptimizeResult
+from scipy import sparse
+from scipy.sparse.linalg import splu, spilu, gmres, LinearOperator
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import logging
 
 EPSILON = 1e-8
 
+# solve_ivp methods that make use of a (sparse) Jacobian
+IMPLICIT_METHODS = ['BDF','Radau']
+
 class ODESystem(System):
 
     def __init__(self, *args, **kwargs):
 
         super().__init__(*args,**kwargs)
-        self.NA = 6.022e23
-        
-        self.dqdt = self._build_dqdt()
+
+        with self._phase('build'):
+            self.dqdt = self._build_dqdt()
+        self._conservation = None
+        self._spectral = None
+        self._split = None
+        self._krylov = None
 
     def set_q(self,idxs,Q):
         """Set the state.q_val array at the specified indexes
@@ -35,179 +50,780 @@ class ODESystem(System):
         If unitless, assumed to be number counts of species
         If mol/L is passed, it uses compartment values to
         convert to mol.
+
+        Q can also be an array with one value per index (see 
+        set_q_array, set_q_function and set_q_dataframe for bulk 
+        initialization).
         """
 
-        mult_volume = False
-        mult_na = False
-        if hasattr(Q,'units'):
-            if Q.units == unit.mol/unit.L:
-                mult_volume = True
-                mult_na = True
-            elif Q.units == unit.mol:
-                mult_na = True
-            elif Q.units != unit.dimensionless:
-                raise ValueError("Quantity values should be either mol, mol/L or dimensionless")
-        else:
-            Q *= unit.dimensionless
- 
-        for i in idxs:
-            if mult_volume:
-                tmp = self.model.compartments[self.state.compartment[i]].volume * Q
-            else:
-                tmp = Q
-            if mult_na:
-                tmp *= self.NA
+        self.set_q_array(Q,idxs)
 
-            # removing units for q_val array (cast in units of numbers of molecules)
-            self.state.q_val[i] = tmp.magnitude
-        
     def _build_dqdt(self):
-        """Uses a model to build a list of derivative functions, with 
-        indices that are consistent with the state vector.  self.dqdt[i], 
-        calculates the rate of change of self.q_val[i], which holds the 
-        amount of quantity i (a particular species in a particular compartment)
-        in mol.
-
-        Formulates each derivative equation as:
-        
-        dq[i]/dt =  sum_{j in sources}  k_j * prod_{k} q_k * n_per_ij
-                  - sum_{j in sinks}    k_j * prod_{k} q_k * n_per_ij
+        """Uses a model to build a MassActionNetwork, with indices that
+        are consistent with the state vector.  self.dqdt.rhs(q,t) 
+        calculates the rate of change of all of the quantities in the 
+        state vector (a particular species in a particular compartment).
 
-        To construct the derivative function, it passes a list of 
-        sources, where the elements of the list are:
+        Each reaction in each compartment is added as a process (one for
+        each direction), with the rate constant divided by a volume factor
+        when more than one reactant is involved:
 
-        (k_j, [q_k0, q_k1...], n_per_ij)
+        flux_j = k_j * prod_{k} q_k
 
-        and a similar list of sinks.  The quantity n_per_ij is the number of 
-        species i that are produced (or consumed) by reaction j.
-        The rates passed are in units such that k_j * prod_{k} q_k has units 
-        of s^-1.
+        Transport along connections is added as first order processes.  
+        When the "out" process of one compartment matches the "in" process 
+        of its neighbor they are combined into a single transfer process, 
+        otherwise they are kept as separate sink and source processes.
 
-        There is a special list of sources that come from Reservoir compartments,
-        whose concentrations are not part of the state vector, but instead 
+        Transport from Reservoir compartments, whose concentrations are 
+        not part of the state vector, are added as a list of sources that 
         vary deterministically as a function of time.  The elements of 
         source_reservoir lists are formatted as:
 
-        (k_j, conc_func, n_per_ij)
+        (index, k_j, conc_func)
 
         where conc_func is a link to the concentration function, which returns
         the concentration of the reservoir, given time as an input.
 
-        Inputs:
-        
-        state : openrxn.systems.state.State object
-        model : openrxn.model.FlatModel object
+        The forward and reverse rate constants of each Reaction are 
+        registered as parameters (e.g. 'binding.kf'), in the units
+        of the Reaction, which can be varied with run_batch.
+
+        Processes are tagged as 'reaction' or 'transport' (see 
+        self.dqdt.kinds), so that transport can be split off (e.g. by
+        method='spectral' in propagate).
         """
-        dqdt = []
-        for i in range(self.state.size):
-            # collect source and sink terms for this species in this compartment
-
-            c = self.model.compartments[self.state.compartment[i]]
-            s = self.state.species[i]
-
-            sources = []
-            sources_reservoir = []
-            sinks = []
-            
-            # look through the reactions in this compartment for ones that
-            # involve this species
+        processes = []
+        process_params = []
+        process_kinds = []
+        sources_reservoir = []
+        out_flux = {}
+        in_flux = {}
+
+        self.param_names = []
+        self.param_units = []
+        param_values = []
+
+        for c in self.model.compartments.values():
+            # add reactions
             for r in c.reactions:
-                if s in r.reactant_IDs:
-                    s_idx = r.reactant_IDs.index(s)
-                    if r.kf > 0:
-                        # append forward reaction to sinks
-                        q_list = []
-                        n_r = 0
-                        for j,x in enumerate(r.reactants):
-                            q_list += [self.state.index[c.ID][x.ID]]*r.stoich_r[j]
-                            n_r += r.stoich_r[j]
-                        if n_r - 1 > 0 and c.volume is not None:
-                            vol_fac = (c.volume/unit.mol)**(n_r-1)
-                            rate = r.kf/vol_fac
-                        else:
-                            rate = r.kf
-                        sinks.append((rate, q_list, r.stoich_r[s_idx]))
-                    if r.kr > 0:
-                        # append reverse reaction to sources
-                        q_list = []
-                        n_p = 0
-                        for j,x in enumerate(r.products):
-                            q_list += [self.state.index[c.ID][x.ID]]*r.stoich_p[j]
-                            n_p += r.stoich_p[j]
-                        if n_p - 1 > 0 and c.volume is not None:
-                            vol_fac = (c.volume/unit.mol)**(n_p-1)
-                            rate = r.kr/vol_fac
-                        else:
-                            rate = r.kr
-                        sources.append((rate, q_list, r.stoich_r[s_idx]))
-                    
-                if s in r.product_IDs:
-                    s_idx = r.product_IDs.index(s)
-                    if r.kf > 0:
-                        # append forward reaction to sources
-                        q_list = []
-                        n_r = 0
-                        for j,x in enumerate(r.reactants):
-                            q_list += [self.state.index[c.ID][x.ID]]*r.stoich_r[j]
-                            n_r += r.stoich_r[j]
-                        if n_r - 1 > 0 and c.volume is not None:
-                            vol_fac = (c.volume/unit.mol)**(n_r-1)
-                            rate = r.kf/vol_fac
-                        else:
-                            rate = r.kf
-                        sources.append((rate, q_list, r.stoich_p[s_idx]))
-
-                    if r.kr > 0:
-                        # append reverse reaction to sinks
-                        q_list = []
-                        n_p = 0
-                        for j,x in enumerate(r.products):
-                            q_list += [self.state.index[c.ID][x.ID]]*r.stoich_p[j]
-                            n_p += r.stoich_p[j]
-                        if n_p - 1 > 0 and c.volume is not None:
-                            vol_fac = (c.volume/unit.mol)**(n_p-1)
-                            rate = r.kr/vol_fac
-                        else:
-                            rate = r.kr
-                        sinks.append((rate, q_list, r.stoich_p[s_idx]))
-
-            # look through connections for those that involve this species
+                for direction in ['kf','kr']:
+                    k = getattr(r,direction)
+                    if not k > 0:
+                        continue
+                    if direction == 'kf':
+                        reactants, stoich_r = r.reactants, r.stoich_r
+                        products, stoich_p = r.products, r.stoich_p
+                    else:
+                        reactants, stoich_r = r.products, r.stoich_p
+                        products, stoich_p = r.reactants, r.stoich_r
+
+                    q_list = []
+                    delta_list = []
+                    n_r = 0
+                    for j,x in enumerate(reactants):
+                        q_list.append((self.state.index[c.ID][x.ID],stoich_r[j]))
+                        delta_list.append((self.state.index[c.ID][x.ID],-stoich_r[j]))
+                        n_r += stoich_r[j]
+                    for j,x in enumerate(products):
+                        delta_list.append((self.state.index[c.ID][x.ID],stoich_p[j]))
+
+                    if n_r - 1 > 0 and c.volume is not None:
+                        vol_fac = (c.volume/unit.mol)**(n_r-1)
+                        rate = k/vol_fac
+                    else:
+                        rate = k
+
+                    processes.append((self._cast_rate(rate),q_list,delta_list))
+                    process_params.append(self._register_param(r.ID + '.' + direction,k,param_values))
+                    process_kinds.append('reaction')
+
+            # add transport processes
             for other_lab, conn in c.connections.items():
-                if s in conn[1].species_rates:
-                                  
-                    # add "out" diffusion process
-                    if isinstance(conn,DivByVConnection):
-                        sinks.append((conn[1].species_rates[s][0]/c.volume, [i], 1))
+                for s in conn[1].species_rates.keys():
+                    i = self.state.index[c.ID][s]
+                    other = self.model.compartments[other_lab]
+                    if isinstance(other,Reservoir):
+                        j = None
+                    else:
+                        j = self.state.index[other_lab][s]
+
+                    # "out" diffusion process
+                    if isinstance(conn[1],DivByVConnection):
+                        out_flux[(i,j)] = self._cast_rate(conn[1].species_rates[s][0]/c.volume)
                     else:
-                        sinks.append((conn[1].species_rates[s][0], [i], 1))
+                        out_flux[(i,j)] = self._cast_rate(conn[1].species_rates[s][0])
 
-                    # add "in" diffusion process
-                    if isinstance(self.model.compartments[other_lab],Reservoir):
-                        sources_reservoir.append((conn[1].species_rates[s][1],
-                                        self.model.compartments[other_lab].conc_funcs[s],
-                                        1))
+                    # "in" diffusion process
+                    if j is None:
+                        sources_reservoir.append((i,self._cast_res_rate(conn[1].species_rates[s][1]),
+                                                  other.conc_funcs[s]))
+                    elif isinstance(conn[1],DivByVConnection):
+                        in_flux[(j,i)] = self._cast_rate(conn[1].species_rates[s][1]/conn[0].volume)
                     else:
-                        if isinstance(conn,DivByVConnection):
-                            sources.append((conn[1].species_rates[s][1]/conn[0].volume,
-                                            [self.state.index[other_lab][s]],
-                                            1))
-                        else:
-                            sources.append((conn[1].species_rates[s][1],
-                                            [self.state.index[other_lab][s]],
-                                            1))
-                    
-            dqdt.append(DerivFuncBuilder(sources, sinks, sources_reservoir))
-
-        return dqdt
-                            
+                        in_flux[(j,i)] = self._cast_rate(conn[1].species_rates[s][1])
+
+        for (i,j), k in out_flux.items():
+            if j is not None and (i,j) in in_flux and np.isclose(in_flux[(i,j)],k,rtol=EPSILON,atol=0):
+                in_flux.pop((i,j))
+                processes.append((k,[(i,1)],[(i,-1),(j,1)]))
+            else:
+                processes.append((k,[(i,1)],[(i,-1)]))
+            process_params.append(None)
+            process_kinds.append('transport')
+
+        for (j,i), k in in_flux.items():
+            processes.append((k,[(j,1)],[(i,1)]))
+            process_params.append(None)
+            process_kinds.append('transport')
+
+        # remove processes that can never occur
+        keep = [p[0] > 0 for p in processes]
+        processes = [p for p,flag in zip(processes,keep) if flag]
+        process_params = [p for p,flag in zip(process_params,keep) if flag]
+        process_kinds = [p for p,flag in zip(process_kinds,keep) if flag]
+
+        return MassActionNetwork(self.state.size, processes, sources_reservoir,
+                                 process_params=process_params, param_values=param_values,
+                                 process_kinds=process_kinds)
+
+    def _register_param(self, name, k, param_values):
+        # returns the index of a rate constant parameter, adding it
+        # to the parameter lists if it is new
+        if name in self.param_names:
+            idx = self.param_names.index(name)
+            if self.param_units[idx] == k.units and np.isclose(param_values[idx],k.magnitude):
+                return idx
+            name = "{0}_{1}".format(name,len(self.param_names))
+        self.param_names.append(name)
+        self.param_units.append(k.units)
+        param_values.append(k.magnitude)
+        return len(self.param_names) - 1
+
+    def _cast_rate(self,rate):
+        # strips units from a rate constant, after converting it to 1/s
+        return rate.to(1/unit.sec).magnitude
+
+    def _cast_res_rate(self,rate):
+        # reservoir rates are multiplied by a concentration (in 1/nm^3)
+        if rate.dimensionality == (1/unit.sec).dimensionality:
+            return rate.to(1/unit.sec).magnitude
+        return rate.to(unit.nm**3/unit.sec).magnitude
+
     def _dQ_dt(self,t,Q):
-        return np.array([builder.deriv_func(Q,t) for builder in self.dqdt])
-    
-    def propagate(self,t_interval,**kwargs):
+        return self.dqdt.rhs(Q,t)
+
+    def _jac(self,t,Q):
+        return self.dqdt.jacobian(Q)
+
+    def _params_from(self, params, param_names=None):
+        # builds a full (P, n_params) array of parameter values, using
+        # the reference values for parameters that are not specified
+        params = np.atleast_2d(np.asarray(params,dtype=float))
+        if param_names is None:
+            if params.shape[1] != self.dqdt.n_params:
+                raise ValueError("Error! Expected {0} parameter values, got {1}".format(self.dqdt.n_params,params.shape[1]))
+            return params
+
+        full = np.tile(self.dqdt.param_values,(params.shape[0],1))
+        for col,name in enumerate(param_names):
+            if name not in self.param_names:
+                raise ValueError("Error! Unknown parameter ({0}).  Available parameters: {1}".format(name,self.param_names))
+            full[:,self.param_names.index(name)] = params[:,col]
+        return full
+
+    def propagate(self,t_interval,reduce_conserved=False,**kwargs):
         """For ODE systems, propagate directly calls the scipy
-        solve_ivp function.  state.q_val is also updated."""
+        solve_ivp function.  state.q_val is also updated.
+
+        For implicit methods, the analytic sparse Jacobian is
+        passed to solve_ivp unless another jac is given.  For LSODA,
+        the Jacobian is passed in banded form if its bandwidth (see 
+        State for orderings that reduce it) is less than half of the
+        size of the system.
+
+        If reduce_conserved is True, only the independent quantities
+        are integrated (see conservation_laws), and the dependent
+        quantities are rebuilt in the returned result.
+
+        The events attached to the system (self.events) are passed to
+        solve_ivp as event functions, unless events are given in kwargs.
+
+        method='spectral' propagates the transport on periodic lattices
+        exactly in Fourier space (see spectral_diffusion), and the other
+        processes (e.g. reactions) with solve_ivp, using Strang splitting 
+        with time steps of at most dt (which is then required, unless 
+        there are no other processes):
+
+        s.run(10, method='spectral', dt=0.01, reaction_method='BDF')
+
+        Other keyword arguments are passed to solve_ivp for the steps of
+        the other processes.
+
+        The methods 'ETD1', 'ETDRK2', 'IMEX' and 'IMEX2' take fixed steps
+        of at most dt, and treat the (linear) transport exactly or 
+        implicitly, and the reactions explicitly, so that dt is limited
+        by the reactions rather than by the grid spacing (see
+        openrxn.systems.exponential):
+
+        s.run(10, method='ETDRK2', dt=0.05)
+
+        For the ETD methods, phi='expm_multiply' can be given to use 
+        scipy's expm_multiply instead of contour integrals.
+
+        method='krylov' uses an implicit BDF integrator whose Newton 
+        systems are solved with preconditioned GMRES and matrix-free 
+        Jacobian-vector products, so that its memory grows with the size
+        of the state instead of the fill-in of LU decompositions (for very
+        large grids, see openrxn.systems.krylov):
+
+        s.run(10, method='krylov', preconditioner='ilu', rtol=1e-4)
+
+        preconditioner is one of 'block-jacobi' (blocks of the Jacobian
+        per compartment, the default), 'ilu', 'multigrid' (ILU or 
+        algebraic multigrid of the transport operator, followed by the 
+        blocks of the reactions) or None.  krylov_rtol, restart, 
+        krylov_maxiter, drop_tol and fill_factor are passed to 
+        KrylovBDF, and rtol, atol, t_eval, first_step and max_step are
+        used as in solve_ivp.  Without t_eval, the result only holds the
+        first and last states, unless save_steps=True."""
+
+        if kwargs.get('method') == 'spectral':
+            kwargs.pop('method')
+            return self._propagate_spectral(t_interval,**kwargs)
+        if kwargs.get('method') == 'krylov':
+            kwargs.pop('method')
+            return self._propagate_krylov(t_interval,**kwargs)
+        if kwargs.get('method') in SPLIT_METHODS:
+            return self._propagate_split(t_interval,**kwargs)
+        if reduce_conserved:
+            return self._propagate_reduced(t_interval,**kwargs)
+
+        if kwargs.get('method') in IMPLICIT_METHODS and 'jac' not in kwargs:
+            kwargs['jac'] = self._jac
+        elif kwargs.get('method') == 'LSODA' and 'jac' not in kwargs and 'lband' not in kwargs:
+            lband, uband = self.dqdt.bandwidth()
+            if lband + uband + 1 < self.state.size/2:
+                kwargs['lband'] = lband
+                kwargs['uband'] = uband
+                kwargs['jac'] = lambda t,Q: self.dqdt.banded_jacobian(Q,lband,uband)
+
+        own_events = len(self.events) > 0 and 'events' not in kwargs
+        if own_events:
+            kwargs['events'] = [e.ode_function() for e in self.events]
 
         result = solve_ivp(self._dQ_dt,t_interval,self.state.q_val,**kwargs)
         self.state.q_val = result.y[:,-1]
+
+        if own_events:
+            self._finish_events(result)
+        elif 'events' in kwargs:
+            # events that are passed to solve_ivp directly are not 
+            # recorded, but a terminal one still ends the run there
+            self._finish_events(result,record=False)
+        if self.profiler is not None:
+            self._count_solver_work(result,'t_eval' in kwargs)
         
         return result
+
+    def spectral_diffusion(self):
+        """Returns the SpectralDiffusion of the system, which holds the
+        periodic lattices whose transport is propagated in Fourier space
+        by method='spectral' (see openrxn.systems.spectral).  It is 
+        built once, on first use."""
+
+        if self._spectral is None:
+            with self._phase('build'):
+                spectral = SpectralDiffusion(self.dqdt,self.state)
+                self._spectral = (spectral,spectral.rest())
+                for species, sites, lam in spectral.grids:
+                    logging.info("Spectral transport of {0} on a {1} lattice".format(species,sites.shape))
+        return self._spectral[0]
+
+    def _propagate_spectral(self,t_interval,dt=None,reaction_method='BDF',**kwargs):
+        # Strang splitting: half steps of spectral transport around
+        # full steps of the other processes (consecutive half steps
+        # are merged)
+        if len(self.events) > 0:
+            raise ValueError("Error! Events are not supported by the spectral method")
+        spectral = self.spectral_diffusion()
+        rest = self._spectral[1]
+        t0, t1 = t_interval
+        q0 = self.state.q_val
+        work = {'nfev' : 0, 'njev' : 0, 'nlu' : 0}
+
+        if rest.n_processes == 0 and len(rest.res_funcs) == 0:
+            n_steps = 1
+            q = spectral.propagate(q0,t1-t0)
+        else:
+            if dt is None:
+                raise ValueError("Error! The spectral method needs a splitting time step (dt)")
+            n_steps = max(int(np.ceil((t1-t0)/dt - EPSILON)),1)
+            h = (t1-t0)/n_steps
+            if reaction_method in IMPLICIT_METHODS and 'jac' not in kwargs:
+                kwargs['jac'] = lambda t,Q: rest.jacobian(Q)
+
+            q = spectral.propagate(q0,h/2)
+            for step in range(n_steps):
+                t = t0 + step*h
+                result = solve_ivp(lambda t,Q: rest.rhs(Q,t),(t,t+h),q,method=reaction_method,**kwargs)
+                if not result.success:
+                    logging.warning("Reaction step failed at t = {0}: {1}".format(t,result.message))
+                for key in work:
+                    work[key] += getattr(result,key)
+                q = result.y[:,-1]
+                q = spectral.propagate(q,h if step < n_steps-1 else h/2)
+
+        self.state.q_val = q
+        result = OptimizeResult(t=np.array([t0,t1]),y=np.stack((q0,q),axis=1),status=0,success=True,
+                                message="Spectral splitting finished",n_steps=n_steps,**work)
+        if self.profiler is not None:
+            self._count_solver_work(result,False)
+            self.profiler.count('split_steps',n_steps)
+        return result
+
+    def _propagate_split(self,t_interval,method,dt=None,phi='contour'):
+        # fixed steps of an exponential or IMEX integrator, whose
+        # transport operator and LU decompositions are kept between calls
+        if len(self.events) > 0:
+            raise ValueError("Error! Events are not supported by the {0} method".format(method))
+        if dt is None:
+            raise ValueError("Error! The {0} method needs a time step (dt)".format(method))
+        if self._split is None or self._split.method != method or self._split.phi != phi:
+            with self._phase('build'):
+                self._split = SplitIntegrator(self.dqdt,method,phi)
+        integrator = self._split
+        counts = dict(integrator.counts)
+
+        t0, t1 = t_interval
+        n_steps = max(int(np.ceil((t1-t0)/dt - EPSILON)),1)
+        h = (t1-t0)/n_steps
+        q0 = self.state.q_val
+        q = q0
+        for step in range(n_steps):
+            q = integrator.step(q,t0 + step*h,h)
+        self.state.q_val = q
+
+        work = {key : integrator.counts[key] - counts[key] for key in counts}
+        result = OptimizeResult(t=np.array([t0,t1]),y=np.stack((q0,q),axis=1),status=0,success=True,
+                                message="{0} finished".format(method),n_steps=n_steps,njev=0,**work)
+        if self.profiler is not None:
+            self._count_solver_work(result,False)
+            self.profiler.count('split_steps',n_steps)
+        return result
+
+    def _propagate_krylov(self,t_interval,preconditioner='block-jacobi',t_eval=None,rtol=1e-3,atol=1e-6,
+                          first_step=None,max_step=np.inf,save_steps=False,**kwargs):
+        # the integrator (and its preconditioner structure) is kept 
+        # between calls with the same options
+        if len(self.events) > 0:
+            raise ValueError("Error! Events are not supported by the krylov method")
+        options = dict(kwargs,preconditioner=preconditioner)
+        if self._krylov is None or self._krylov[0] != options:
+            with self._phase('build'):
+                self._krylov = (options,KrylovBDF(self.dqdt,self.state.compartment_codes,**options))
+        integrator = self._krylov[1]
+
+        result = integrator.integrate(self.state.q_val,t_interval,t_eval=t_eval,rtol=rtol,atol=atol,
+                                      first_step=first_step,max_step=max_step,save_steps=save_steps)
+        if not result.success:
+            logging.warning("Krylov BDF integration failed at t = {0}: {1}".format(result.t[-1],result.message))
+        if result.y.shape[1] > 0:
+            self.state.q_val = result.y[:,-1]
+        if self.profiler is not None:
+            self._count_solver_work(result,True)
+            self.profiler.count('ode_steps',result.n_steps)
+            self.profiler.count('linear_iterations',result.nli)
+        return result
+
+    def _count_solver_work(self,result,has_t_eval):
+        self.profiler.count('rhs_evals',result.nfev)
+        self.profiler.count('jac_evals',result.njev)
+        self.profiler.count('lu_decompositions',result.nlu)
+        if not has_t_eval:
+            self.profiler.count('ode_steps',len(result.t)-1)
+
+    def _finish_events(self,result,transform=None,record=True):
+        # records the event times, and if a terminal event occurred,
+        # sets the state (and final_t) to those at the event, since
+        # result.y does not end at the event if t_eval was given
+        if record:
+            self._record_events(result.t_events)
+        if result.status == 1:
+            t_stop = max(te[-1] for te in result.t_events if len(te) > 0)
+            for te, ye in zip(result.t_events,result.y_events):
+                if len(te) > 0 and te[-1] == t_stop:
+                    y_stop = ye[-1]
+            if transform is not None:
+                y_stop = transform(y_stop)
+            self.state.q_val = y_stop
+            result['final_t'] = t_stop
+
+    def _propagate_reduced(self,t_interval,**kwargs):
+        # integrates only the independent quantities, and rebuilds 
+        # the dependent ones using the conserved totals
+        laws = self.conservation_laws()
+        totals = laws.totals(self.state.q_val)
+
+        def f(t,q_ind):
+            return laws.reduced_rhs(self.dqdt,q_ind,t,totals)
+
+        if kwargs.get('method') in IMPLICIT_METHODS and 'jac' not in kwargs:
+            kwargs['jac'] = lambda t,q_ind: laws.reduced_jacobian(self.dqdt,q_ind,totals)
+
+        expand = lambda q_ind: laws.expand(q_ind,totals)
+        own_events = len(self.events) > 0 and 'events' not in kwargs
+        if own_events:
+            kwargs['events'] = [e.ode_function(expand) for e in self.events]
+
+        result = solve_ivp(f,t_interval,laws.reduce(self.state.q_val),**kwargs)
+        result.y = laws.expand(result.y,totals)
+        self.state.q_val = result.y[:,-1]
+
+        if own_events:
+            self._finish_events(result,expand)
+        elif 'events' in kwargs:
+            self._finish_events(result,expand,record=False)
+        if self.profiler is not None:
+            self._count_solver_work(result,'t_eval' in kwargs)
+
+        return result
+
+    def run_batch(self, params, total_time, param_names=None, t_eval=None,
+                  n_workers=None, chunk_size=None, **kwargs):
+        """Integrates the system for a batch of parameter sets, all 
+        starting from the current state vector (state.q_val).
+
+        params : array-like, shape (P, n_params)
+        Each row is a set of rate constants, in the units of the
+        corresponding Reaction (see self.param_names and self.param_units).
+        If param_names is given, the columns of params correspond to 
+        these parameters, and all others are kept at their reference 
+        values.
+
+        t_eval : array-like
+        The times at which the quantities are returned.  By default
+        these are the checkpoints of the reporters that are attached 
+        to the system (together with 0 and total_time).
+
+        The P variants are integrated together as one block-diagonal 
+        system, sharing the sparsity pattern of the Jacobian.  If n_workers
+        is larger than one, the batch is split into chunks (of size 
+        chunk_size) which are integrated in parallel using a process pool.
+        This requires the reservoir concentration functions to be picklable.
+
+        Other keyword arguments are passed to solve_ivp.
+
+        Returns a dictionary with keys:
+        't' : array of times, shape (T,)
+        'y' : array of quantities, shape (P, size, T)
+        'params' : array of parameter values, shape (P, n_params)
+        'success' : boolean array, shape (P,)
+
+        If the integration of a chunk fails, the quantities of that 
+        chunk at the times that were not reached are set to NaN.
+        """
+
+        params = self._params_from(params,param_names)
+        K = self.dqdt.rate_constants(params)
+        P = K.shape[0]
+
+        if t_eval is None:
+            t_eval = self._checkpoints(total_time)
+        t_eval = np.asarray(t_eval,dtype=float)
+
+        if n_workers is None or n_workers < 2:
+            n_workers = 1
+        if chunk_size is None:
+            chunk_size = int(np.ceil(P/n_workers))
+        chunks = [(b,min(b+chunk_size,P)) for b in range(0,P,chunk_size)]
+
+        t_span = (0,total_time)
+        args = [(self.dqdt,self.state.q_val,K[b0:b1],t_span,t_eval,kwargs) for b0,b1 in chunks]
+        if n_workers == 1:
+            outputs = [_integrate_block(*a) for a in args]
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers) as pool:
+                outputs = list(pool.map(_integrate_block,*zip(*args)))
+
+        y = np.full((P,self.state.size,len(t_eval)),np.nan)
+        success = np.zeros(P,dtype=bool)
+        for (b0,b1), (y_chunk, flag) in zip(chunks,outputs):
+            y[b0:b1,:,:y_chunk.shape[2]] = y_chunk
+            success[b0:b1] = flag
+            if not flag:
+                logging.warning("Integration failed for batch members {0} to {1}".format(b0,b1-1))
+
+        return {'t': t_eval, 'y': y, 'params': params, 'success': success}
+
+    def run_sensitivity(self, total_time, param_names=None, t_eval=None,
+                        reduce_conserved=False, **kwargs):
+        """Integrates the system from the current state vector
+        (state.q_val), together with the forward sensitivity equations:
+
+        dS/dt = J * S + df/dtheta
+
+        where S = dq/dtheta is the (size, n_params) matrix of sensitivities
+        of the quantities with respect to the rate constant parameters, J is 
+        the analytic Jacobian of the system, and df/dtheta holds the derivatives 
+        of dq/dt with respect to the parameters.  The initial quantities are 
+        assumed to be independent of the parameters.
+
+        param_names : list of str
+        The parameters to compute sensitivities for (default: all, see 
+        self.param_names).  Derivatives are per unit of the corresponding
+        Reaction rate constant (see self.param_units).
+
+        t_eval : array-like
+        The times at which the results are returned.  By default these 
+        are the checkpoints of the reporters that are attached to the 
+        system (together with 0 and total_time).
+
+        If reduce_conserved is True, the state and sensitivity equations
+        are only integrated for the independent quantities (see
+        conservation_laws).
+
+        Other keyword arguments are passed to solve_ivp.  state.q_val is 
+        not updated.
+
+        Returns a dictionary with keys:
+        't' : array of times, shape (T,)
+        'y' : array of quantities, shape (size, T)
+        'sens' : array of sensitivities, shape (size, n_selected, T)
+        'param_names' : list of the selected parameters
+        """
+
+        if param_names is None:
+            param_names = list(self.param_names)
+        for name in param_names:
+            if name not in self.param_names:
+                raise ValueError("Error! Unknown parameter ({0}).  Available parameters: {1}".format(name,self.param_names))
+        sel = [self.param_names.index(name) for name in param_names]
+        n_sel = len(sel)
+
+        if t_eval is None:
+            t_eval = self._checkpoints(total_time)
+        t_eval = np.asarray(t_eval,dtype=float)
+
+        if reduce_conserved:
+            laws = self.conservation_laws()
+            totals = laws.totals(self.state.q_val)
+            ind = laws.independent
+            expand = lambda q: laws.expand(q,totals)
+            jac = lambda q: laws.reduced_jacobian(self.dqdt,q,totals)
+            q0 = laws.reduce(self.state.q_val)
+        else:
+            ind = slice(None)
+            expand = lambda q: q
+            jac = lambda q: self.dqdt.jacobian(q)
+            q0 = self.state.q_val
+        n = len(q0)
+
+        # the augmented state holds q, followed by one block of
+        # sensitivities for each selected parameter
+        def f(t,z):
+            q = expand(z[:n])
+            S = z[n:].reshape(n_sel,n)
+            dS = jac(z[:n]).dot(S.T).T + self.dqdt.param_jacobian(q)[ind][:,sel].toarray().T
+            return np.concatenate((self.dqdt.rhs(q,t)[ind],dS.ravel()))
+
+        if kwargs.get('method') in IMPLICIT_METHODS and 'jac' not in kwargs:
+            # the coupling of the sensitivities back to q is left out
+            # of the Newton iteration matrix
+            eye = sparse.identity(n_sel+1,format='csr')
+            kwargs['jac'] = lambda t,z: sparse.kron(eye,jac(z[:n]),format='csr')
+
+        z0 = np.concatenate((q0,np.zeros(n_sel*n)))
+        result = solve_ivp(f,(0,total_time),z0,t_eval=t_eval,**kwargs)
+        if not result.success:
+            logging.warning("Sensitivity integration failed: {0}".format(result.message))
+
+        y = expand(result.y[:n])
+        sens = result.y[n:].reshape(n_sel,n,-1)
+        if reduce_conserved:
+            sens = np.stack([laws.expand_derivative(sens[p]) for p in range(n_sel)])
+        sens = sens.transpose(1,0,2)
+
+        return {'t': result.t, 'y': y, 'sens': sens, 'param_names': param_names}
+
+    def find_steady_state(self, q0=None, t=0, tol=1e-10, max_iter=50, method='newton',
+                          ptc=True, ptc_max_iter=500, update_state=True):
+        """Finds a fixed point of the system (dq/dt = 0) directly,
+        instead of propagating the system to equilibrium.
+
+        q0 : array-like
+        The initial guess (default: state.q_val).  Conserved totals 
+        (e.g. the total amount of receptor in A + R <-> AR) are taken
+        from q0, and replace the corresponding rows of the Newton system.
+        Quantities that are connected to a Reservoir are not conserved.
+
+        t : float
+        The time at which the reservoir concentrations are evaluated.
+
+        tol : float
+        Convergence is reached when the largest Newton step is smaller
+        than tol times the largest quantity.
+
+        method : str
+        Either 'newton', which solves the linear systems with a sparse LU
+        decomposition of the analytic Jacobian, or 'krylov', which uses 
+        GMRES with an incomplete LU preconditioner.
+
+        ptc : bool
+        If the Newton iteration fails, fall back to pseudo-transient 
+        continuation, which takes implicit Euler steps of increasing size
+        before switching back to Newton.
+
+        Returns a dictionary with keys:
+        'q' : the fixed point
+        'converged' : whether the iteration converged
+        'residual' : the largest absolute value of dq/dt at 'q'
+        'n_iter' : the total number of iterations
+        'method' : the method that was used to converge
+
+        If update_state is True and the iteration converged, state.q_val 
+        is set to the fixed point.
+        """
+
+        if method not in ['newton','krylov']:
+            raise ValueError("Error! method must be either 'newton' or 'krylov' ({0})".format(method))
+        if q0 is None:
+            q0 = self.state.q_val
+        q0 = np.array(q0,dtype=float)
+
+        laws = self.conservation_laws()
+        L = laws.L
+        dep = laws.dependent
+        keep = np.ones(self.state.size)
+        keep[dep] = 0
+        keep = sparse.diags(keep)
+        place = sparse.csr_matrix((np.ones(len(dep)),(dep,np.arange(len(dep)))),
+                                  shape=(self.state.size,len(dep)))
+        L_rows = place.dot(L)
+        totals = L.dot(q0)
+
+        def F(q):
+            res = self.dqdt.rhs(q,t)
+            res[dep] = L.dot(q) - totals
+            return res
+
+        def J(q):
+            return (keep.dot(self.dqdt.jacobian(q)) + L_rows).tocsc()
+
+        q, converged, n_iter = self._newton(F,J,q0,tol,max_iter,method)
+        used = method
+        if not converged and ptc:
+            logging.info("Newton iteration did not converge, using pseudo-transient continuation")
+            q, converged, n_ptc = self._ptc(q0,t,tol,ptc_max_iter,method)
+            n_iter += n_ptc
+            used = 'ptc'
+            if converged:
+                q, converged, n_newton = self._newton(F,J,q,tol,max_iter,method)
+                n_iter += n_newton
+
+        if not converged:
+            logging.warning("Steady state search did not converge after {0} iterations".format(n_iter))
+        elif update_state:
+            self.state.q_val = q
+
+        return {'q': q,
+                'converged': converged,
+                'residual': np.abs(self.dqdt.rhs(q,t)).max(initial=0),
+                'n_iter': n_iter,
+                'method': used}
+
+    def conservation_laws(self):
+        """Returns the ConservationLaws of the system, which are
+        computed once from the stoichiometry of self.dqdt."""
+
+        if self._conservation is None:
+            self._conservation = ConservationLaws(self.dqdt)
+        return self._conservation
+
+    def _linear_solve(self, A, b, method):
+        if method == 'newton':
+            return splu(A).solve(b)
+        ilu = spilu(A)
+        M = LinearOperator(A.shape,ilu.solve)
+        x, info = gmres(A,b,M=M,atol=0)
+        if info != 0:
+            raise RuntimeError("GMRES did not converge ({0})".format(info))
+        return x
+
+    def _newton(self, F, J, q, tol, max_iter, method):
+        # damped Newton iteration, with backtracking on the norm of F
+        q = q.copy()
+        res = F(q)
+        for it in range(max_iter):
+            try:
+                dq = self._linear_solve(J(q),-res,method)
+            except (RuntimeError,ValueError) as e:
+                logging.info("Newton linear solve failed: {0}".format(e))
+                return q, False, it
+            if not np.all(np.isfinite(dq)):
+                return q, False, it
+
+            step = 1.0
+            norm = np.linalg.norm(res)
+            while step > 1e-4:
+                q_new = q + step*dq
+                res_new = F(q_new)
+                if np.linalg.norm(res_new) <= (1 - 1e-4*step)*norm or norm == 0:
+                    break
+                step *= 0.5
+            q = q_new
+            res = res_new
+            if np.abs(step*dq).max(initial=0) <= tol*max(np.abs(q).max(initial=0),EPSILON):
+                return q, True, it+1
+        return q, False, max_iter
+
+    def _ptc(self, q, t, tol, max_iter, method='newton', delta=None):
+        # pseudo-transient continuation: implicit Euler steps with
+        # a step size that grows as the residual decreases (switched
+        # evolution relaxation, growing at least by a factor of two 
+        # while the residual is not increasing).  Conservation laws are
+        # satisfied automatically, as L * J = 0.  The linear systems are
+        # solved as in the Newton iteration (see _linear_solve).
+        q = q.copy()
+        res = self.dqdt.rhs(q,t)
+        norm = np.linalg.norm(res)
+        if delta is None:
+            delta = 1/max(np.abs(self.dqdt.jacobian(q).diagonal()).max(initial=0),EPSILON)
+        eye = sparse.identity(self.state.size,format='csc')
+        for it in range(max_iter):
+            A = (eye/delta - self.dqdt.jacobian(q)).tocsc()
+            try:
+                dq = self._linear_solve(A,res,method)
+            except (RuntimeError,ValueError) as e:
+                logging.info("Pseudo-transient linear solve failed: {0}".format(e))
+                return q, False, it
+            q = q + dq
+            res_new = self.dqdt.rhs(q,t)
+            norm_new = np.linalg.norm(res_new)
+            if np.abs(dq).max(initial=0) <= tol*max(np.abs(q).max(initial=0),EPSILON) and norm_new <= norm:
+                return q, True, it+1
+            if norm_new <= norm:
+                delta *= min(max(norm/max(norm_new,EPSILON*EPSILON),2),100)
+            else:
+                delta *= max(norm/norm_new,0.1)
+            res = res_new
+            norm = norm_new
+        return q, False, max_iter
+
+def _integrate_block(network, q0, K, t_span, t_eval, kwargs):
+    # integrates a stacked, block-diagonal system with one block per 
+    # row of K.  Defined at the module level so that it can be used 
+    # with a process pool.
+
+    P = K.shape[0]
+    N = network.size
+
+    def f(t,y):
+        return network.rhs(y.reshape(P,N),t,K).ravel()
+
+    kwargs = dict(kwargs)
+    if kwargs.get('method') in IMPLICIT_METHODS and 'jac' not in kwargs:
+        kwargs['jac'] = lambda t,y: network.jacobian(y.reshape(P,N),K)
+
+    result = solve_ivp(f,t_span,np.tile(q0,P),t_eval=t_eval,**kwargs)
+    return result.y.reshape(P,N,-1), result.success
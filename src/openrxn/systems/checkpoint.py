@@ -0,0 +1,65 @@
+"""Checkpoints hold everything that is needed to continue a run
+(see System.run and System.resume):
+
+- the System itself, pickled after the end of a propagation interval,
+  which includes the state vector (state.q_val), the built engine
+  (e.g. the MassActionNetwork or the Gillespie processes), the
+  reporters with their buffers, and the events
+- the position of the run: the propagation intervals, the index of
+  the next one, and the keyword arguments of the engine
+- the state of numpy's global random number generator, which is used
+  by the Gillespie engine
+
+Checkpoints are written atomically: the data is written to a
+temporary file in the same directory, which is then renamed, so that
+a crash during a write leaves the previous checkpoint intact.
+
+Checkpoints are only written at the boundaries of the propagation
+intervals, so that the engines do not need to store any internal
+state (the Gillespie propensities are recomputed from the state
+vector at the start of each interval, and the waiting times are
+memoryless).  A resumed run therefore makes the same sequence of
+propagate calls, with the same random numbers, as a run that was
+not interrupted.
+"""
+
+from openrxn import unit
+
+import numpy as np
+import pickle
+import os
+
+VERSION = 1
+
+def write_checkpoint(path, system, run_state):
+    """Atomically writes a checkpoint of system to path."""
+
+    data = {'version' : VERSION,
+            'time' : run_state['checkpoints'][run_state['next']-1],
+            'run' : run_state,
+            'rng' : np.random.get_state(),
+            'system' : system}
+
+    tmp = path + '.tmp'
+    try:
+        with open(tmp,'wb') as f:
+            pickle.dump(data,f,protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+    except (pickle.PicklingError,TypeError,AttributeError) as e:
+        os.remove(tmp)
+        raise ValueError("Error! The system can not be written to a checkpoint ({0})".format(e))
+    os.replace(tmp,path)
+
+def read_checkpoint(path):
+    """Returns the dictionary stored in a checkpoint file."""
+
+    # quantities are unpickled in Pint's application registry, which
+    # is set when openrxn.unit is built
+    unit._get_registry()
+
+    with open(path,'rb') as f:
+        data = pickle.load(f)
+    if data.get('version') != VERSION:
+        raise ValueError("Error! Unknown checkpoint version ({0})".format(data.get('version')))
+    return data
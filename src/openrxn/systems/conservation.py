@@ -0,0 +1,245 @@
+"""Conservation laws (or moieties) are linear combinations of
+quantities that do not change in time, such as the total amount
+of receptor in a system with the reversible binding reaction:
+
+A + R <-> AR
+
+These are found from the stoichiometry of a MassActionNetwork, as
+a basis of the left null space of the stoichiometry matrix:
+
+L * S = 0
+
+For each conservation law one "dependent" quantity is chosen, such
+that the rows of L are the identity at the dependent quantities.
+The dependent quantities can then be rebuilt from the independent
+ones and the conserved totals (T = L * q):
+
+q_dep = T - L_ind * q_ind
+
+which allows the ODE solvers to integrate the smaller set of
+independent quantities, and removes the singularity of the Jacobian
+for steady state calculations.
+
+Processes that transfer a quantity from one index to another (e.g.
+diffusion between compartments) force the coefficients of the two
+indices to be equal.  These are contracted first, so that the null
+space is computed for a much smaller matrix in reaction-diffusion
+models.  Quantities that exchange with a Reservoir are not conserved.
+
+The null space is found by a sparse Gauss-Jordan elimination of the
+equations L * S = 0, one process at a time, so that the cost follows
+the number of non-zeros of S rather than the cube of its size (a
+species that does not diffuse gives one class per compartment).
+"""
+
+from scipy import sparse
+import numpy as np
+
+EPSILON = 1e-10
+RANK_TOL = 1e-8
+
+class ConservationLaws(object):
+    """Finds the conservation laws of a MassActionNetwork.
+
+    self.L is a sparse (n_laws, size) matrix with the conservation
+    laws as rows.
+
+    self.dependent is an array of the dependent quantity for each
+    conservation law.
+
+    self.independent is an array of the remaining indices.
+    """
+
+    def __init__(self, network):
+
+        self.size = network.size
+
+        classes = self._transfer_classes(network)
+        n_classes = classes.max() + 1 if self.size > 0 else 0
+        E = sparse.csr_matrix((np.ones(self.size),(np.arange(self.size),classes)),
+                              shape=(self.size,n_classes))
+
+        # stoichiometry of the processes that are not simple transfers,
+        # summed over the members of each class
+        S_red = E.T.dot(network.stoich).tocsc()
+        nonzero = np.diff(S_red.indptr) > 0
+        S_red = S_red[:,nonzero]
+
+        # quantities that exchange with reservoirs are not conserved
+        if len(network.res_rows) > 0:
+            res_classes = np.unique(classes[network.res_rows])
+            R = sparse.csc_matrix((np.ones(len(res_classes)),(res_classes,np.arange(len(res_classes)))),
+                                  shape=(n_classes,len(res_classes)))
+            S_red = sparse.hstack((S_red,R),format='csc')
+
+        # the basis is in reduced row echelon form, so that the rows 
+        # describe moieties such as [R] + [AR].  The largest classes are
+        # preferred as pivots, so that e.g. the total amount of a species
+        # that diffuses everywhere is one of the conserved totals.
+        sizes = np.bincount(classes,minlength=n_classes)
+        order = np.argsort(-sizes,kind='stable')
+        L_red, pivots = self._null_space(S_red,order)
+        rounded = np.round(L_red.data)
+        close = np.abs(L_red.data - rounded) < EPSILON
+        L_red.data[close] = rounded[close]
+
+        self.L = sparse.csr_matrix(L_red.dot(E.T))
+        self.L.eliminate_zeros()
+
+        # the first member of each pivot class is the dependent quantity
+        first = np.full(n_classes,-1)
+        for i in range(self.size-1,-1,-1):
+            first[classes[i]] = i
+        self.dependent = first[pivots]
+        mask = np.ones(self.size,dtype=bool)
+        mask[self.dependent] = False
+        self.independent = np.nonzero(mask)[0]
+        self.n_laws = len(self.dependent)
+
+        self._L_ind = self.L[:,self.independent].tocsr()
+
+    def _transfer_classes(self, network):
+        # union-find over the pairs of indices that are connected by
+        # processes of the form  q_i -> q_j
+        parent = np.arange(self.size)
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        csc = network.stoich.tocsc()
+        for j in range(network.n_processes):
+            rows = csc.indices[csc.indptr[j]:csc.indptr[j+1]]
+            vals = csc.data[csc.indptr[j]:csc.indptr[j+1]]
+            if len(rows) == 2 and sorted(vals) == [-1,1]:
+                a, b = find(rows[0]), find(rows[1])
+                if a != b:
+                    parent[max(a,b)] = min(a,b)
+
+        roots = np.array([find(i) for i in range(self.size)],dtype=int)
+        return np.unique(roots,return_inverse=True)[1]
+
+    def _null_space(self, S, order):
+        # sparse Gauss-Jordan elimination of the equations y * S[:,j] = 0.
+        # Each equation expresses one variable (the latest one in order)
+        # in terms of the others, and the expressions of the bound 
+        # variables are kept in terms of the free ones.  The free 
+        # variables are then the pivots of the basis, with one row per 
+        # pivot: 1 at the pivot, and the coefficients of the pivot in the 
+        # expressions of the bound variables.
+        n = S.shape[0]
+        rank = np.empty(n,dtype=int)
+        rank[order] = np.arange(n)
+        bound = {}
+        users = {}
+        for j in range(S.shape[1]):
+            eq = {}
+            for i, a in zip(S.indices[S.indptr[j]:S.indptr[j+1]].tolist(),
+                            S.data[S.indptr[j]:S.indptr[j+1]].tolist()):
+                for f, b in bound.get(i,{i : 1.0}).items():
+                    eq[f] = eq.get(f,0) + a*b
+            eq = {f : a for f, a in eq.items() if np.abs(a) > RANK_TOL}
+            if len(eq) == 0:
+                continue
+
+            p = max(eq,key=lambda f: rank[f])
+            a = eq.pop(p)
+            expr = {f : -b/a for f, b in eq.items()}
+
+            # substitute the new bound variable in the other expressions
+            for u in users.pop(p,()):
+                e = bound[u]
+                c = e.pop(p)
+                for f, b in expr.items():
+                    val = e.get(f,0) + c*b
+                    if np.abs(val) < EPSILON:
+                        e.pop(f,None)
+                        users[f].discard(u)
+                    else:
+                        e[f] = val
+                        users.setdefault(f,set()).add(u)
+            bound[p] = expr
+            for f in expr:
+                users.setdefault(f,set()).add(p)
+
+        pivots = np.array([f for f in range(n) if f not in bound],dtype=int)
+        row_of = np.full(n,-1)
+        row_of[pivots] = np.arange(len(pivots))
+        rows = [row_of[pivots]]
+        cols = [pivots]
+        vals = [np.ones(len(pivots))]
+        for u, e in bound.items():
+            rows.append(row_of[list(e.keys())])
+            cols.append(np.full(len(e),u))
+            vals.append(np.array(list(e.values()),dtype=float))
+        L = sparse.csr_matrix((np.concatenate(vals),(np.concatenate(rows).astype(int),np.concatenate(cols))),
+                              shape=(len(pivots),n))
+        return L, pivots
+
+    def totals(self, q):
+        """Returns the conserved totals for the state vector q."""
+        return self.L.dot(q)
+
+    def reduce(self, q):
+        """Returns the independent quantities of q.  q can also be
+        an array of shape (size, T)."""
+        return q[self.independent]
+
+    def expand(self, q_ind, totals):
+        """Rebuilds the full state vector from the independent quantities
+        and the conserved totals.  q_ind can also be an array of
+        shape (n_independent, T)."""
+
+        q_ind = np.asarray(q_ind)
+        q = np.empty((self.size,) + q_ind.shape[1:])
+        q[self.independent] = q_ind
+        dep = self._L_ind.dot(q_ind)
+        if q_ind.ndim > 1:
+            q[self.dependent] = totals[:,None] - dep
+        else:
+            q[self.dependent] = totals - dep
+        return q
+
+    def expand_derivative(self, dq_ind):
+        """Rebuilds derivatives (e.g. sensitivities) of the full state
+        vector from those of the independent quantities, given that the
+        conserved totals are fixed."""
+
+        dq_ind = np.asarray(dq_ind)
+        dq = np.empty((self.size,) + dq_ind.shape[1:])
+        dq[self.independent] = dq_ind
+        dq[self.dependent] = -self._L_ind.dot(dq_ind)
+        return dq
+
+    def reduced_rhs(self, network, q_ind, t, totals, K=None):
+        """Returns the time derivative of the independent quantities."""
+        return network.rhs(self.expand(q_ind,totals),t,K)[self.independent]
+
+    def reduced_jacobian(self, network, q_ind, totals, K=None):
+        """Returns the Jacobian of the reduced system:
+
+        J_red = J_ii - J_id * L_ind
+        """
+        J = network.jacobian(self.expand(q_ind,totals),K)[self.independent]
+        return (J[:,self.independent] - J[:,self.dependent].dot(self._L_ind)).tocsr()
+
+    def describe(self, state):
+        """Returns a list of strings describing each conservation law
+        in terms of the species and compartments in state."""
+
+        species = state.species_names
+        compartments = state.compartment_names
+        laws = []
+        for r in range(self.n_laws):
+            row = self.L.getrow(r)
+            terms = []
+            for i, coef in zip(row.indices,row.data):
+                name = "{0}[{1}]".format(species[state.species_codes[i]],compartments[state.compartment_codes[i]])
+                if coef == 1:
+                    terms.append(name)
+                else:
+                    terms.append("{0:g} {1}".format(coef,name))
+            laws.append(" + ".join(terms))
+        return laws
@@ -5,9 +5,16 @@ by the integrator to move the system forward in time.
 
 Rate constants given to DerivFuncBuilder are assumed to be 
 in units of 1/s.  Units are stripped upon initialization.
+
+MassActionNetwork objects hold the same information for a whole
+system at once, as a sparse stoichiometry matrix and arrays of 
+rate constants, so that the derivatives (and their Jacobian) are 
+evaluated for all quantities in a few vectorized operations.
 """
 
 from openrxn import unit
+from scipy import sparse
+from scipy.sparse.linalg import LinearOperator
 import numpy as np
 
 class DerivFuncBuilder(object):
@@ -47,3 +54,303 @@ class DerivFuncBuilder(object):
         for tup in self.sources_reservoir:
             dqdt += tup[0] * tup[1](t)
         return dqdt
+
+class MassActionNetwork(object):
+    """
+    A vectorized representation of a set of mass-action processes.
+    Processes are given in the same format that is used by the 
+    Gillespie propagator:
+
+    (k, q_list, delta_list)
+
+    where k is a rate constant in 1/s, q_list is a list of tuples
+    (index, number) describing the quantities that are multiplied 
+    together to get the flux of the process (q[index]**number), and
+    delta_list is a list of tuples (index, delta) describing how the
+    quantities change per unit of flux.
+
+    The rate of change of the state vector is then:
+
+    dq/dt = S * v(q) + sources_reservoir(t)
+
+    where S is the (sparse) stoichiometry matrix with one column per 
+    process and v(q) is the vector of process fluxes.
+
+    sources_reservoir is a list of tuples (index, k, conc_func), where 
+    conc_func returns the concentration of a reservoir at time t.
+
+    Processes can optionally be tied to parameters.  process_params 
+    is a list (same length as processes) with the index of the parameter 
+    that each rate constant is proportional to (or None), and 
+    param_values holds the reference values of the parameters, for
+    which the rate constants in processes were computed.
+
+    All of the evaluation functions also accept a batch of state 
+    vectors with shape (P, size), together with a matching (P, n_processes)
+    array of rate constants.  In that case the Jacobian is returned as
+    a block-diagonal matrix with one block per batch member.
+
+    process_kinds optionally tags each process (e.g. 'reaction' or 
+    'transport'), so that the network can be split into parts that are
+    propagated differently (see subset).
+    """
+    def __init__(self, size, processes, sources_reservoir=[], process_params=None, param_values=[],
+                 process_kinds=None):
+
+        self.size = size
+        self.n_processes = len(processes)
+
+        self.k = np.array([p[0] for p in processes],dtype=float)
+
+        # pad the reactant index lists with an index that points
+        # to an extra element of the state vector that is always one
+        order = [sum([num for idx,num in p[1]]) for p in processes]
+        self.max_order = max(order + [1])
+        self.q_idx = np.full((self.n_processes,self.max_order),size,dtype=int)
+        for j,p in enumerate(processes):
+            col = 0
+            for idx,num in p[1]:
+                self.q_idx[j,col:col+num] = idx
+                col += num
+
+        # stoichiometry matrix
+        rows = [idx for p in processes for idx,d in p[2]]
+        cols = [j for j,p in enumerate(processes) for idx,d in p[2]]
+        vals = [d for p in processes for idx,d in p[2]]
+        self.stoich = sparse.csr_matrix((np.array(vals,dtype=float),(rows,cols)),
+                                        shape=(size,self.n_processes))
+        self.stoich.sum_duplicates()
+
+        # reservoir sources
+        self.res_rows = np.array([s[0] for s in sources_reservoir],dtype=int)
+        self.res_k = np.array([s[1] for s in sources_reservoir],dtype=float)
+        self.res_funcs = [s[2] for s in sources_reservoir]
+
+        # parameters
+        self.param_values = np.array(param_values,dtype=float)
+        self.n_params = len(self.param_values)
+        if process_params is None:
+            process_params = [None]*self.n_processes
+        self.param_idx = np.array([-1 if p is None else p for p in process_params],dtype=int)
+        has_param = self.param_idx >= 0
+        self.k_scale = np.zeros(self.n_processes)
+        self.k_scale[has_param] = self.k[has_param]/self.param_values[self.param_idx[has_param]]
+
+        if process_kinds is None:
+            process_kinds = ['reaction']*self.n_processes
+        self.kinds = np.array(process_kinds,dtype=str).reshape(self.n_processes)
+
+        self._build_jacobian_structure()
+        self._block_structures = {}
+
+    def subset(self, mask, reservoir_sources=True):
+        """Returns a MassActionNetwork on the same state vector, with
+        the processes selected by mask (a boolean array, e.g. 
+        network.kinds == 'reaction'), and optionally without the 
+        reservoir sources."""
+
+        csc = self.stoich.tocsc()
+        processes = []
+        process_params = []
+        for j in np.nonzero(mask)[0]:
+            idx, num = np.unique(self.q_idx[j][self.q_idx[j] < self.size],return_counts=True)
+            delta = zip(csc.indices[csc.indptr[j]:csc.indptr[j+1]].tolist(),
+                        csc.data[csc.indptr[j]:csc.indptr[j+1]].tolist())
+            processes.append((self.k[j],list(zip(idx.tolist(),num.tolist())),list(delta)))
+            process_params.append(None if self.param_idx[j] < 0 else int(self.param_idx[j]))
+
+        sources = []
+        if reservoir_sources:
+            sources = list(zip(self.res_rows,self.res_k,self.res_funcs))
+        return MassActionNetwork(self.size, processes, sources, process_params=process_params,
+                                 param_values=self.param_values, process_kinds=self.kinds[mask])
+
+    def _build_jacobian_structure(self):
+        # Each non-zero element of the Jacobian is a sum over
+        # (process, slot) pairs, where a slot is one of the factors
+        # in the flux of the process.  Here we compute the sparsity
+        # pattern once, together with a (nnz x n_slots) matrix that maps
+        # the flux derivatives of every slot onto the Jacobian data array.
+
+        slot_j, slot_p = np.nonzero(self.q_idx < self.size)
+        self.slot_j = slot_j
+        self.slot_p = slot_p
+        slot_col = self.q_idx[slot_j,slot_p]
+
+        csc = self.stoich.tocsc()
+        trip_slot = []
+        trip_row = []
+        trip_coef = []
+        for s in range(len(slot_j)):
+            j = slot_j[s]
+            start, end = csc.indptr[j], csc.indptr[j+1]
+            trip_slot.append(np.full(end-start,s))
+            trip_row.append(csc.indices[start:end])
+            trip_coef.append(csc.data[start:end])
+
+        if len(trip_slot) > 0:
+            trip_slot = np.concatenate(trip_slot)
+            trip_row = np.concatenate(trip_row)
+            trip_coef = np.concatenate(trip_coef)
+        else:
+            trip_slot = np.zeros(0,dtype=int)
+            trip_row = np.zeros(0,dtype=int)
+            trip_coef = np.zeros(0)
+        trip_col = slot_col[trip_slot]
+
+        keys = trip_row*self.size + trip_col
+        ukeys, trip_pos = np.unique(keys,return_inverse=True)
+        self.jac_indices = ukeys % self.size
+        jac_rows = ukeys // self.size
+        self.jac_indptr = np.searchsorted(jac_rows,np.arange(self.size+1))
+        self.jac_nnz = len(ukeys)
+        self._jac_map = sparse.csr_matrix((trip_coef,(trip_pos,trip_slot)),
+                                          shape=(self.jac_nnz,len(slot_j)))
+
+    def rate_constants(self, params=None):
+        """Returns the rate constants of each process for a given set
+        of parameter values.  params is either an array of length n_params, 
+        or an array of shape (P, n_params) for a batch of parameter sets,
+        in which case the returned array has shape (P, n_processes).  If 
+        params is None, the reference rate constants are returned."""
+
+        if params is None:
+            return self.k
+        params = np.asarray(params,dtype=float)
+        has_param = self.param_idx >= 0
+        K = np.broadcast_to(self.k,params.shape[:-1] + (self.n_processes,)).copy()
+        K[...,has_param] = params[...,self.param_idx[has_param]]*self.k_scale[has_param]
+        return K
+
+    def _factors(self, Q):
+        # returns the quantities multiplied together for each process, with
+        # shape (..., n_processes, max_order)
+        Q_ext = np.concatenate((Q,np.ones(Q.shape[:-1] + (1,))),axis=-1)
+        return Q_ext[...,self.q_idx]
+
+    def fluxes(self, Q, K=None):
+        """Returns the flux of each process."""
+        if K is None:
+            K = self.k
+        return K*np.prod(self._factors(Q),axis=-1)
+
+    def reservoir_sources(self, t):
+        """Returns the rate of change of each quantity due to
+        the reservoir sources at time t."""
+
+        src = np.zeros(self.size)
+        for i,f in enumerate(self.res_funcs):
+            conc = f(t)
+            if hasattr(conc,'units'):
+                conc = conc.to(1/unit.nm**3).magnitude
+            src[self.res_rows[i]] += self.res_k[i]*conc
+        return src
+
+    def rhs(self, Q, t=0, K=None):
+        """Returns dq/dt.  Q is either a state vector, or a
+        (P, size) array of state vectors."""
+
+        v = self.fluxes(Q,K)
+        if v.ndim == 1:
+            dqdt = self.stoich.dot(v)
+        else:
+            dqdt = self.stoich.dot(v.T).T
+        if len(self.res_funcs) > 0:
+            dqdt = dqdt + self.reservoir_sources(t)
+        return dqdt
+
+    def param_jacobian(self, Q):
+        """Returns the derivatives of dq/dt with respect to the 
+        parameters, as a sparse (size, n_params) matrix.  As the rate
+        constants are proportional to the parameters, this does not
+        depend on the parameter values."""
+
+        has_param = np.nonzero(self.param_idx >= 0)[0]
+        prod = np.prod(self._factors(Q)[has_param],axis=-1)
+        dv = sparse.csr_matrix((self.k_scale[has_param]*prod,(has_param,self.param_idx[has_param])),
+                               shape=(self.n_processes,self.n_params))
+        return self.stoich.dot(dv)
+
+    def _slot_derivatives(self, Q, K=None):
+        # derivative of the flux of each process with respect to
+        # the quantity in each of its slots
+        if K is None:
+            K = self.k
+        F = self._factors(Q)
+        d = np.empty(F.shape[:-2] + (len(self.slot_j),))
+        for p in range(self.max_order):
+            mask = self.slot_p == p
+            if not mask.any():
+                continue
+            tmp = F.copy()
+            tmp[...,p] = 1
+            prod = K*np.prod(tmp,axis=-1)
+            d[...,mask] = prod[...,self.slot_j[mask]]
+        return d
+
+    def jacobian_data(self, Q, K=None):
+        """Returns the data array of the Jacobian, in the order of the 
+        shared sparsity pattern (jac_indices, jac_indptr).  For a batch 
+        of state vectors the returned array has shape (P, jac_nnz)."""
+
+        d = self._slot_derivatives(Q,K)
+        if d.ndim == 1:
+            return self._jac_map.dot(d)
+        return self._jac_map.dot(d.T).T
+
+    def jacobian_operator(self, Q, K=None):
+        """Returns the Jacobian at Q as a scipy LinearOperator, whose
+        products with vectors are computed from the flux derivatives
+        of each process without forming the Jacobian:
+
+        J v = S * (dv/dq v)
+
+        The operator holds one number per (process, slot) pair."""
+
+        d = self._slot_derivatives(Q,K)
+        cols = self.q_idx[self.slot_j,self.slot_p]
+
+        def matvec(v):
+            dv = np.bincount(self.slot_j,weights=d*np.ravel(v)[cols],minlength=self.n_processes)
+            return self.stoich.dot(dv)
+
+        return LinearOperator((self.size,self.size),matvec=matvec,dtype=float)
+
+    def bandwidth(self):
+        """Returns the lower and upper bandwidth (lband, uband) of
+        the Jacobian, which depends on the ordering of the state."""
+
+        rows = np.repeat(np.arange(self.size),np.diff(self.jac_indptr))
+        diff = rows - self.jac_indices
+        return int(max(diff.max(initial=0),0)), int(max(-diff.min(initial=0),0))
+
+    def banded_jacobian(self, Q, lband, uband, K=None):
+        """Returns the Jacobian in the packed banded format that is used
+        by LSODA (and scipy.linalg.solve_banded):
+
+        jac_packed[uband + i - j, j] = jac[i, j]
+        """
+
+        rows = np.repeat(np.arange(self.size),np.diff(self.jac_indptr))
+        packed = np.zeros((lband+uband+1,self.size))
+        packed[uband+rows-self.jac_indices,self.jac_indices] = self.jacobian_data(Q,K)
+        return packed
+
+    def jacobian(self, Q, K=None):
+        """Returns the Jacobian d(dq/dt)/dq as a sparse CSR matrix.  For
+        a batch of state vectors this is a block-diagonal matrix."""
+
+        data = self.jacobian_data(Q,K)
+        if data.ndim == 1:
+            return sparse.csr_matrix((data,self.jac_indices,self.jac_indptr),
+                                     shape=(self.size,self.size))
+
+        P = data.shape[0]
+        if P not in self._block_structures:
+            indices = (self.jac_indices[None,:] + self.size*np.arange(P)[:,None]).ravel()
+            indptr = np.concatenate([self.jac_indptr[:-1] + b*self.jac_nnz for b in range(P)] +
+                                    [[P*self.jac_nnz]])
+            self._block_structures[P] = (indices,indptr)
+        indices, indptr = self._block_structures[P]
+        return sparse.csr_matrix((data.ravel(),indices,indptr),
+                                 shape=(P*self.size,P*self.size))
@@ -0,0 +1,90 @@
+"""Events are conditions on the state vector that are checked while
+a system is running.  An event is defined by a linear combination of
+a selection of quantities, compared with a threshold:
+
+value(q) = sum_i weights[i] * q[selection_idxs[i]] - threshold
+
+The event occurs when value(q) crosses zero.  Terminal events stop
+the run (System.run returns early, and system.stop_time is set),
+while the times of all events are recorded in event.times.
+
+e.g. to stop when the total amount of A in the bottom layer exceeds
+100 molecules:
+
+sel = s.state.select(species='A', slab=('z', 0, 1))
+s.add_event(Event(sel, 100, direction=1, name='A_bottom'))
+
+For ODESystems these are passed to solve_ivp as event functions, and
+for GillespieSystems they are checked after each reaction that changes
+one of the selected quantities.
+"""
+
+import numpy as np
+
+class Event(object):
+    """
+    selection_idxs : list of int
+    The indexes of the quantities in the linear combination.
+
+    threshold : float
+    The value that the linear combination is compared with.
+
+    weights : list of float
+    The weight of each selected quantity (default: all ones, which
+    compares the sum of the quantities with the threshold).
+
+    direction : int
+    If positive (negative), the event only occurs when the linear
+    combination increases (decreases) through the threshold.  If zero,
+    both directions are recorded.
+
+    terminal : bool
+    Whether the run should stop when the event occurs.
+    """
+
+    def __init__(self, selection_idxs, threshold, weights=None, direction=0, terminal=True, name=None):
+        self.selection_idxs = np.asarray(selection_idxs,dtype=int).ravel()
+        if weights is None:
+            self.weights = np.ones(len(self.selection_idxs))
+        else:
+            self.weights = np.asarray(weights,dtype=float).ravel()
+            if len(self.weights) != len(self.selection_idxs):
+                raise ValueError("Error! weights must have the same length as selection_idxs")
+        self.threshold = threshold
+        self.direction = direction
+        self.terminal = terminal
+        self.name = name
+        self.times = []
+
+    def value(self, q):
+        """Returns the linear combination minus the threshold."""
+        return np.dot(self.weights,q[self.selection_idxs]) - self.threshold
+
+    def crossed(self, old_value, new_value):
+        """Returns whether a change from old_value to new_value is
+        an occurrence of this event."""
+        if self.direction >= 0 and old_value < 0 and new_value >= 0:
+            return True
+        if self.direction <= 0 and old_value > 0 and new_value <= 0:
+            return True
+        return False
+
+    def ode_function(self, transform=None):
+        """Returns an event function for scipy's solve_ivp.  If given,
+        transform(y) is used to obtain the full state vector from the
+        integrated variables."""
+
+        def f(t, y):
+            if transform is not None:
+                y = transform(y)
+            return self.value(y)
+        f.terminal = self.terminal
+        f.direction = self.direction
+        return f
+
+    def first_time(self):
+        """Returns the first time that the event occurred (e.g. a first
+        passage time), or None."""
+        if len(self.times) == 0:
+            return None
+        return self.times[0]
@@ -0,0 +1,198 @@
+"""Split integrators for reaction-transport systems, which treat the
+linear transport operator implicitly or exactly, and the reactions
+explicitly:
+
+dq/dt = L q + N(q,t)
+
+where L is the (sparse) matrix of the first-order transport processes
+of a MassActionNetwork (see process_kinds) and N holds the other
+processes (reactions and Reservoir sources).  The step size is then set
+by the reactions, and not by the fastest transport rates of the grid.
+
+Exponential time differencing (ETD) methods use the exact propagator
+of L, through the actions of the phi functions of h*L:
+
+'ETD1'   : q1 = exp(hL) q + h phi1(hL) N(q)
+'ETDRK2' : a  = exp(hL) q + h phi1(hL) N(q)
+           q1 = a + h phi2(hL) (N(a) - N(q))
+
+The actions of the phi functions are computed as contour integrals
+of the resolvent of h*L (phi='contour', the default):
+
+phi_k(hL) v = 1/(2 pi i) int exp(z) z^-k (z I - hL)^-1 v dz
+
+on a Talbot contour that encloses the spectrum of h*L, which lies in
+the left half plane, and the origin (Weideman and Trefethen, Math.
+Comp. 76, 2007; the polynomial part of phi_k(z) = (exp(z) - sum_(j<k)
+z^j/j!)/z^k does not contribute to the integral, and exp(z) z^-k
+decays quickly along the contour, unlike phi_k(z)).
+The quadrature uses N_CONTOUR points, of which only half need a linear
+solve (by conjugate symmetry), and the sparse LU decompositions of
+z_j I - hL are cached for each step size, so that the cost of a step
+does not grow with the norm of h*L.  Alternatively (phi='expm_multiply'),
+the combinations of phi actions are computed with scipy's expm_multiply
+on an augmented matrix (Al-Mohy and Higham, SIAM J. Sci. Comput. 33,
+2011), whose cost is proportional to the norm of h*L.
+
+Implicit-explicit (IMEX) methods solve linear systems with I - c*h*L,
+whose sparse LU decompositions are cached for each step size:
+
+'IMEX'   : (I - hL) q1 = q + h N(q)           (first order)
+'IMEX2'  : ARS(2,2,2), an L-stable second order method with two
+           solves per step (Ascher, Ruuth and Spiteri, 1997)
+"""
+
+from scipy import sparse
+from scipy.sparse.linalg import splu, expm_multiply
+import numpy as np
+
+METHODS = ['ETD1','ETDRK2','IMEX','IMEX2']
+
+# the diagonal coefficient of ARS(2,2,2)
+GAMMA = 1 - 1/np.sqrt(2)
+
+# the number of quadrature points on the Talbot contour
+N_CONTOUR = 24
+
+def transport_operator(network):
+    """Returns the matrix L (sparse CSR) of the first-order transport
+    processes of network, and a MassActionNetwork with the other
+    processes."""
+
+    T = np.nonzero(network.kinds == 'transport')[0]
+    first_order = network.q_idx[T,0] < network.size
+    if network.max_order > 1:
+        first_order &= np.all(network.q_idx[T,1:] == network.size,axis=1)
+    T = T[first_order]
+
+    select = sparse.csr_matrix((np.ones(len(T)),(np.arange(len(T)),network.q_idx[T,0])),
+                               shape=(len(T),network.size))
+    L = (network.stoich[:,T].dot(sparse.diags(network.k[T])).dot(select)).tocsr()
+    L.sum_duplicates()
+
+    mask = np.ones(network.n_processes,dtype=bool)
+    mask[T] = False
+    return L, network.subset(mask)
+
+def phi_actions(L, h, vectors):
+    """Returns sum_k h^k phi_k(h L) vectors[k], for k = 0 ... p, where
+    phi_0(z) = exp(z) and phi_k(z) = (phi_(k-1)(z) - 1/(k-1)!)/z."""
+
+    n = L.shape[0]
+    p = len(vectors) - 1
+    if p == 0:
+        return expm_multiply(h*L,vectors[0])
+
+    # [[L, W], [0, J]] with W = [w_p ... w_1] and J a shift matrix
+    W = sparse.csr_matrix(np.column_stack(vectors[:0:-1]))
+    J = sparse.diags(np.ones(p-1),1,shape=(p,p))
+    A = sparse.bmat([[L,W],[None,J]],format='csr')
+    v = np.concatenate((vectors[0],np.zeros(p)))
+    v[-1] = 1
+    return expm_multiply(h*A,v)[:n]
+
+def talbot_contour(n=N_CONTOUR):
+    """Returns the points z_j in the upper half of the Talbot contour
+    with n points, and their weights w_j, such that
+
+    f(A) v = 2 Re sum_j w_j f(z_j) (z_j I - A)^-1 v
+
+    for real A and v, and functions f that are analytic inside the
+    contour (or, for f(z) = exp(z) z^-k, phi_k(A) v)."""
+
+    theta = -np.pi + (np.arange(n) + 0.5)*2*np.pi/n
+    theta = theta[theta > 0]
+    a = 0.6407*theta
+    z = n*(0.5017*theta/np.tan(a) - 0.6122 + 0.2645j*theta)
+    dz = n*(0.5017/np.tan(a) - 0.5017*a/np.sin(a)**2 + 0.2645j)
+    return z, dz/(1j*n)
+
+def _step_key(h):
+    # step sizes that only differ by rounding (e.g. (t1 - t0)/n_steps
+    # for consecutive report intervals) share their LU decompositions
+    return float('{0:.10e}'.format(h))
+
+class SplitIntegrator(object):
+
+    def __init__(self, network, method, phi='contour'):
+        """Integrates the processes of network with one of METHODS.
+        phi is either 'contour' or 'expm_multiply' (see above)."""
+
+        if method not in METHODS:
+            raise ValueError("Error! method must be one of {0} ({1})".format(METHODS,method))
+        if phi not in ['contour','expm_multiply']:
+            raise ValueError("Error! phi must be either 'contour' or 'expm_multiply' ({0})".format(phi))
+        self.method = method
+        self.phi = phi
+        self.L, self.rest = transport_operator(network)
+        self.size = network.size
+        self._lu = {}
+        self._resolvents = {}
+        self.counts = {'nfev' : 0, 'nlu' : 0}
+
+    def phi_actions(self, h, vectors):
+        """Returns sum_k h^k phi_k(h L) vectors[k] (see phi_actions)."""
+
+        if self.phi == 'expm_multiply':
+            return phi_actions(self.L,h,vectors)
+
+        z, w = talbot_contour()
+        key = _step_key(h)
+        if key not in self._resolvents:
+            # the LU decompositions of z_j I - hL for the last two step
+            # sizes (e.g. the steps of a run and a shorter last step)
+            if len(self._resolvents) >= 2:
+                self._resolvents.pop(next(iter(self._resolvents)))
+            self._resolvents[key] = [splu((zj*sparse.identity(self.size,format='csc') - h*self.L).tocsc())
+                                     for zj in z]
+            self.counts['nlu'] += len(z)
+        used = [(k,v) for k,v in enumerate(vectors) if np.any(v)]
+        total = np.zeros(self.size,dtype=complex)
+        for zj, wj, lu in zip(z,w,self._resolvents[key]):
+            b = np.zeros(self.size,dtype=complex)
+            for k, v in used:
+                b += h**k*np.exp(zj)/zj**k*v
+            total += wj*lu.solve(b)
+        return 2*total.real
+
+    def N(self, q, t):
+        self.counts['nfev'] += 1
+        return self.rest.rhs(q,t)
+
+    def _solve(self, c, b):
+        # solves (I - c L) x = b, with a cached LU decomposition
+        key = _step_key(c)
+        if key not in self._lu:
+            if len(self._lu) >= 4:
+                self._lu.pop(next(iter(self._lu)))
+            A = (sparse.identity(self.size,format='csc') - c*self.L).tocsc()
+            self._lu[key] = splu(A)
+            self.counts['nlu'] += 1
+        return self._lu[key].solve(b)
+
+    def step(self, q, t, h):
+        """Returns the quantities after one step of size h from (q, t)."""
+
+        Nq = self.N(q,t)
+        if self.method == 'ETD1':
+            return self.phi_actions(h,[q,Nq])
+        if self.method == 'ETDRK2':
+            a = self.phi_actions(h,[q,Nq])
+            zero = np.zeros(self.size)
+            return a + self.phi_actions(h,[zero,zero,(self.N(a,t+h) - Nq)/h])
+        if self.method == 'IMEX':
+            return self._solve(h,q + h*Nq)
+
+        # ARS(2,2,2)
+        delta = 1 - 1/(2*GAMMA)
+        Q1 = self._solve(GAMMA*h,q + GAMMA*h*Nq)
+        NQ1 = self.N(Q1,t + GAMMA*h)
+        b = q + h*(delta*Nq + (1-delta)*NQ1) + (1-GAMMA)*h*self.L.dot(Q1)
+        return self._solve(GAMMA*h,b)
+
+    def __getstate__(self):
+        # LU decompositions can not be pickled (e.g. in checkpoints)
+        state = self.__dict__.copy()
+        state['_lu'] = {}
+        state['_resolvents'] = {}
+        return state
@@ -0,0 +1,434 @@
+"""Matrix-free Newton-Krylov BDF integration, for systems whose sparse
+LU decompositions do not fit in memory (e.g. CompartmentArray3D models
+with millions of state entries, where the fill-in of the LU
+decompositions of the implicit solve_ivp methods grows much faster
+than the state).
+
+KrylovBDF uses the variable order (1 to MAX_ORDER), quasi-constant
+step size BDF formulas (NDF) of scipy's BDF method (Shampine and
+Reichelt, SIAM J. Sci. Comput. 18, 1997), and the same step size,
+order and Newton convergence controls.  The Newton systems of each
+step:
+
+(I - c J) dq = r
+
+are solved with restarted GMRES, using the Jacobian-vector products of
+MassActionNetwork.jacobian_operator, so that the Jacobian is never
+formed.  As in scipy's BDF, the Jacobian is only updated when the
+Newton iteration fails to converge, and the preconditioner is rebuilt
+when c or the Jacobian changes.
+
+Preconditioners (P ~ I - c J):
+
+'block-jacobi' : the inverses of the diagonal blocks of I - c J that
+                 couple the species of each compartment (the default)
+'ilu'          : an incomplete LU decomposition of I - c J, with the
+                 sparse Jacobian (whose non-zeros, mostly those of the
+                 diffusion operator, grow with the state), and a fill-in
+                 that is limited by fill_factor
+'multigrid'    : an algebraic multigrid V-cycle of I - c L, where L is
+                 the transport operator (see
+                 exponential.transport_operator), followed by the
+                 block-Jacobi inverse of the other processes (needs pyamg)
+None           : no preconditioner
+
+The memory that is used then grows with the size of the state and
+the number of processes: the integrator holds MAX_ORDER + 3 difference
+vectors, restart + 2 Krylov vectors, the flux derivatives and the
+blocks of the preconditioner.
+"""
+
+from openrxn.systems.exponential import transport_operator
+
+from scipy import sparse
+from scipy.optimize import OptimizeResult
+from scipy.sparse.linalg import gmres, spilu, LinearOperator
+import numpy as np
+
+PRECONDITIONERS = ['block-jacobi','ilu','multigrid',None]
+
+MAX_ORDER = 5
+NEWTON_MAXITER = 4
+MIN_FACTOR = 0.2
+MAX_FACTOR = 10
+
+# NDF coefficients (as in scipy's BDF)
+KAPPA = np.array([0,-0.1850,-1/9,-0.0823,-0.0415,0])
+GAMMA = np.hstack((0,np.cumsum(1/np.arange(1,MAX_ORDER+1))))
+ALPHA = (1 - KAPPA)*GAMMA
+ERROR_CONST = KAPPA*GAMMA + 1/np.arange(1,MAX_ORDER+2)
+
+def _rms(x):
+    return np.linalg.norm(x)/np.sqrt(x.size)
+
+def _change_D(D, order, factor):
+    # rescales the differences array in place for a new step size
+    # (h -> factor*h)
+    def R(f):
+        I = np.arange(1,order+1)[:,None]
+        J = np.arange(1,order+1)
+        M = np.zeros((order+1,order+1))
+        M[1:,1:] = (I - 1 - f*J)/I
+        M[0] = 1
+        return np.cumprod(M,axis=0)
+    RU = R(factor).dot(R(1))
+    D[:order+1] = RU.T.dot(D[:order+1])
+
+class BlockJacobi(object):
+
+    def __init__(self, network, groups):
+        """Inverts the diagonal blocks of I - c J that couple the
+        entries of network with the same group (e.g. the compartment
+        codes of a State), as a batch of dense matrices."""
+
+        self.network = network
+        block = np.unique(groups,return_inverse=True)[1].ravel()
+        counts = np.bincount(block,minlength=1)
+        starts = np.concatenate(([0],np.cumsum(counts)))
+        order = np.argsort(block,kind='stable')
+        self.block = block
+        self.local = np.empty(len(block),dtype=int)
+        self.local[order] = np.arange(len(block)) - starts[block[order]]
+        self.shape = (len(counts),max(counts.max(initial=1),1))
+
+        # the entries of the Jacobian inside the blocks
+        rows = np.repeat(np.arange(network.size),np.diff(network.jac_indptr))
+        cols = network.jac_indices
+        self.inside = np.nonzero(block[rows] == block[cols])[0]
+        self.rows = rows[self.inside]
+        self.cols = cols[self.inside]
+        self.data = None
+        self.inv = None
+
+    def set_jacobian(self, q):
+        self.data = self.network.jacobian_data(q)[self.inside]
+
+    def factor(self, c):
+        n_blocks, m = self.shape
+        A = np.zeros((n_blocks,m,m))
+        A[:,np.arange(m),np.arange(m)] = 1
+        A[self.block[self.rows],self.local[self.rows],self.local[self.cols]] -= c*self.data
+        self.inv = np.linalg.inv(A)
+
+    def solve(self, v):
+        V = np.zeros(self.shape)
+        V[self.block,self.local] = v
+        return np.einsum('bij,bj->bi',self.inv,V)[self.block,self.local]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['data'] = None
+        state['inv'] = None
+        return state
+
+class KrylovBDF(object):
+
+    def __init__(self, network, groups, preconditioner='block-jacobi', krylov_rtol=1e-2,
+                 restart=20, krylov_maxiter=10, drop_tol=1e-4, fill_factor=4):
+        """Integrates the processes of network with BDF formulas and
+        Newton-Krylov solves (see above).
+
+        groups : array
+        The group (e.g. compartment code) of each entry of the state,
+        which sets the blocks of the block-Jacobi preconditioner.
+
+        preconditioner : one of PRECONDITIONERS.
+
+        krylov_rtol : float
+        The GMRES iterations of each Newton iteration stop when the
+        residual is reduced by this factor.
+
+        restart, krylov_maxiter : int
+        The number of GMRES iterations between restarts, and the
+        maximum number of restarts.
+
+        drop_tol, fill_factor : float
+        Passed to spilu for the 'ilu' preconditioner."""
+
+        if preconditioner not in PRECONDITIONERS:
+            raise ValueError("Error! preconditioner must be one of {0} ({1})".format(PRECONDITIONERS,preconditioner))
+        self.network = network
+        self.size = network.size
+        self.preconditioner = preconditioner
+        self.krylov_rtol = krylov_rtol
+        self.restart = restart
+        self.krylov_maxiter = krylov_maxiter
+        self.drop_tol = drop_tol
+        self.fill_factor = fill_factor
+        self.counts = {'nfev' : 0, 'njev' : 0, 'nlu' : 0, 'nli' : 0}
+
+        self.L = None
+        self._blocks = None
+        if preconditioner == 'multigrid':
+            # pyamg is only needed here
+            try:
+                import pyamg
+            except ImportError:
+                raise ImportError("Error! The multigrid preconditioner needs pyamg")
+            self.L, local = transport_operator(network)
+            if local.n_processes > 0:
+                self._blocks = BlockJacobi(local,groups)
+        elif preconditioner == 'block-jacobi':
+            self._blocks = BlockJacobi(network,groups)
+
+        self._J = None
+        self._jac = None
+        self._c = None
+        self._transport = None
+        self._ilu = None
+
+    def fun(self, t, q):
+        self.counts['nfev'] += 1
+        return self.network.rhs(q,t)
+
+    def _set_jacobian(self, q):
+        self.counts['njev'] += 1
+        self._J = self.network.jacobian_operator(q)
+        if self._blocks is not None:
+            self._blocks.set_jacobian(q)
+        if self.preconditioner == 'ilu':
+            self._jac = self.network.jacobian(q)
+        self._c = None
+
+    def _factor(self, c):
+        # builds the preconditioner of I - c J
+        self.counts['nlu'] += 1
+        self._c = c
+        if self._blocks is not None:
+            self._blocks.factor(c)
+        if self.preconditioner == 'ilu':
+            A = (sparse.identity(self.size,format='csc') - c*self._jac).tocsc()
+            self._ilu = spilu(A,drop_tol=self.drop_tol,fill_factor=self.fill_factor)
+        elif self.preconditioner == 'multigrid' and (self._transport is None or self._transport[0] != c):
+            # the V-cycle only depends on c
+            import pyamg
+            A = (sparse.identity(self.size,format='csr') - c*self.L).tocsr()
+            ml = pyamg.smoothed_aggregation_solver(A,symmetry='nonsymmetric')
+            self._transport = (c,ml.aspreconditioner(cycle='V'))
+
+    def _precondition(self, v):
+        if self._ilu is not None:
+            return self._ilu.solve(v)
+        if self._transport is not None:
+            v = self._transport[1].matvec(v)
+        if self._blocks is not None:
+            v = self._blocks.solve(v)
+        return v
+
+    def _linear_solve(self, c, b):
+        # solves (I - c J) x = b with preconditioned GMRES, and returns
+        # (x, whether GMRES converged)
+        J = self._J
+        A = LinearOperator((self.size,self.size),matvec=lambda v: np.ravel(v) - c*J.matvec(v),dtype=float)
+        M = None
+        if self.preconditioner is not None:
+            M = LinearOperator((self.size,self.size),matvec=lambda v: self._precondition(np.ravel(v)),dtype=float)
+
+        def count(r):
+            self.counts['nli'] += 1
+        x, info = gmres(A,b,rtol=self.krylov_rtol,atol=0,restart=self.restart,maxiter=self.krylov_maxiter,
+                        M=M,callback=count,callback_type='pr_norm')
+        return x, info == 0
+
+    def _newton(self, t_new, q_predict, c, psi, scale, tol):
+        # the Newton iteration of scipy's BDF (solve_bdf_system)
+        d = 0
+        q = q_predict.copy()
+        dq_norm_old = None
+        converged = False
+        for k in range(NEWTON_MAXITER):
+            f = self.fun(t_new,q)
+            if not np.all(np.isfinite(f)):
+                break
+            dq, ok = self._linear_solve(c,c*f - psi - d)
+            if not ok:
+                break
+            dq_norm = _rms(dq/scale)
+            rate = None if dq_norm_old is None else dq_norm/dq_norm_old
+            if rate is not None and (rate >= 1 or rate**(NEWTON_MAXITER - k)/(1 - rate)*dq_norm > tol):
+                break
+            q += dq
+            d += dq
+            if dq_norm == 0 or (rate is not None and rate/(1 - rate)*dq_norm < tol):
+                converged = True
+                break
+            dq_norm_old = dq_norm
+        return converged, k+1, q, d
+
+    def _initial_step(self, t0, q0, f0, t1, rtol, atol, max_step):
+        # as scipy's select_initial_step, for a first order method
+        scale = atol + np.abs(q0)*rtol
+        d0 = _rms(q0/scale)
+        d1 = _rms(f0/scale)
+        h0 = 1e-6 if d0 < 1e-5 or d1 < 1e-5 else 0.01*d0/d1
+        h0 = min(h0,t1 - t0)
+        f1 = self.fun(t0 + h0,q0 + h0*f0)
+        d2 = _rms((f1 - f0)/scale)/h0
+        if d1 <= 1e-15 and d2 <= 1e-15:
+            h1 = max(1e-6,h0*1e-3)
+        else:
+            h1 = (0.01/max(d1,d2))**0.5
+        return min(100*h0,h1,t1 - t0,max_step)
+
+    def integrate(self, q0, t_span, t_eval=None, rtol=1e-3, atol=1e-6, first_step=None, max_step=np.inf,
+                  save_steps=False):
+        """Integrates from q0 over t_span = (t0, t1), with t1 > t0.  The
+        result is an OptimizeResult with the same fields as those of
+        solve_ivp (t, y, status, message, success, nfev, njev, nlu),
+        where nlu counts the preconditioner builds, and nli the total
+        number of GMRES iterations.
+
+        Without t_eval, only the first and the last states are returned,
+        unless save_steps is True (then the state after every step is
+        kept, which uses memory in proportion to the number of steps)."""
+
+        t0, t1 = t_span
+        if t1 <= t0:
+            raise ValueError("Error! KrylovBDF only integrates forward in time ({0})".format(t_span))
+        counts = dict(self.counts)
+        q = np.array(q0,dtype=float)
+        t = t0
+        if t_eval is not None:
+            t_eval = np.asarray(t_eval,dtype=float)
+            ts = list(t_eval[t_eval == t0])
+            ys = [q.copy() for te in ts]
+        else:
+            ts, ys = [t0], [q.copy()]
+
+        f = self.fun(t,q)
+        if first_step is None:
+            h_abs = self._initial_step(t,q,f,t1,rtol,atol,max_step)
+        else:
+            h_abs = first_step
+        newton_tol = max(10*np.finfo(float).eps/rtol,min(0.03,rtol**0.5))
+
+        D = np.empty((MAX_ORDER+3,self.size))
+        D[0] = q
+        D[1] = f*h_abs
+        order = 1
+        n_equal_steps = 0
+        n_steps = 0
+        status, message = 0, "The solver successfully reached the end of the integration interval."
+
+        self._set_jacobian(q)
+        while t < t1:
+            min_step = 10*np.abs(np.nextafter(t,np.inf) - t)
+            if h_abs > max_step:
+                _change_D(D,order,max_step/h_abs)
+                h_abs = max_step
+                n_equal_steps = 0
+            elif h_abs < min_step:
+                _change_D(D,order,min_step/h_abs)
+                h_abs = min_step
+                n_equal_steps = 0
+
+            current_jac = False
+            step_accepted = False
+            while not step_accepted:
+                if h_abs < min_step:
+                    break
+                t_new = t + h_abs
+                if t_new > t1:
+                    _change_D(D,order,(t1 - t)/h_abs)
+                    t_new = t1
+                    n_equal_steps = 0
+                h = t_new - t
+                h_abs = h
+
+                q_predict = np.sum(D[:order+1],axis=0)
+                scale = atol + rtol*np.abs(q_predict)
+                psi = D[1:order+1].T.dot(GAMMA[1:order+1])/ALPHA[order]
+                c = h/ALPHA[order]
+
+                converged = False
+                while not converged:
+                    if self._c != c:
+                        self._factor(c)
+                    converged, n_iter, q_new, d = self._newton(t_new,q_predict,c,psi,scale,newton_tol)
+                    if not converged:
+                        if current_jac:
+                            break
+                        self._set_jacobian(q_predict)
+                        current_jac = True
+
+                if not converged:
+                    _change_D(D,order,0.5)
+                    h_abs *= 0.5
+                    n_equal_steps = 0
+                    continue
+
+                safety = 0.9*(2*NEWTON_MAXITER + 1)/(2*NEWTON_MAXITER + n_iter)
+                scale = atol + rtol*np.abs(q_new)
+                error_norm = _rms(ERROR_CONST[order]*d/scale)
+                if error_norm > 1:
+                    factor = max(MIN_FACTOR,safety*error_norm**(-1/(order+1)))
+                    _change_D(D,order,factor)
+                    h_abs *= factor
+                    n_equal_steps = 0
+                else:
+                    step_accepted = True
+
+            if not step_accepted:
+                status, message = -1, "Required step size is less than spacing between numbers."
+                break
+
+            t_old = t
+            t = t_new
+            q = q_new
+            n_steps += 1
+            n_equal_steps += 1
+
+            # D^(j+1) q_n = D^j q_n - D^j q_(n-1), where d = D^(order+1) q_n
+            D[order+2] = d - D[order+1]
+            D[order+1] = d
+            for i in reversed(range(order+1)):
+                D[i] += D[i+1]
+
+            if n_equal_steps >= order + 1:
+                error_m_norm = np.inf
+                error_p_norm = np.inf
+                if order > 1:
+                    error_m_norm = _rms(ERROR_CONST[order-1]*D[order]/scale)
+                if order < MAX_ORDER:
+                    error_p_norm = _rms(ERROR_CONST[order+1]*D[order+2]/scale)
+                error_norms = np.array([error_m_norm,error_norm,error_p_norm])
+                with np.errstate(divide='ignore'):
+                    factors = error_norms**(-1/np.arange(order,order+3))
+                order += int(np.argmax(factors)) - 1
+                factor = min(MAX_FACTOR,safety*np.max(factors))
+                _change_D(D,order,factor)
+                h_abs *= factor
+                n_equal_steps = 0
+
+            if t_eval is None:
+                if save_steps:
+                    ts.append(t)
+                    ys.append(q.copy())
+            else:
+                # the interpolating polynomial of the step
+                for te in t_eval[(t_eval > t_old) & (t_eval <= t)]:
+                    ts.append(te)
+                    ys.append(self._interpolate(te,t,h_abs,order,D))
+
+        if t_eval is None and not save_steps:
+            ts.append(t)
+            ys.append(q)
+        work = {key : self.counts[key] - counts[key] for key in counts}
+        return OptimizeResult(t=np.array(ts),y=np.array(ys).reshape(len(ys),self.size).T,
+                              status=status,message=message,success=status >= 0,
+                              n_steps=n_steps,**work)
+
+    def _interpolate(self, te, t, h, order, D):
+        # as scipy's BdfDenseOutput
+        x = (te - (t - h*np.arange(order)))/(h*(1 + np.arange(order)))
+        return D[0] + D[1:order+1].T.dot(np.cumprod(x))
+
+    def __getstate__(self):
+        # the preconditioners and the Jacobian operator are rebuilt
+        state = self.__dict__.copy()
+        state['_J'] = None
+        state['_jac'] = None
+        state['_c'] = None
+        state['_transport'] = None
+        state['_ilu'] = None
+        return state
@@ -0,0 +1,110 @@
+"""A Profiler records where a run spends its time.  It is attached to
+a System with the profiler argument:
+
+prof = Profiler()
+with prof.phase('flatten'):
+    flat = model.flatten()
+s = ODESystem(flat, profiler=prof)
+s.run(100, method='BDF')
+print(prof.summary())
+
+The system times its own phases ('state_init', 'build', 'propagate',
+'report', and 'checkpoint' if checkpoints are written) and counts the work that was done by the engine:
+
+ODE systems:  'rhs_evals', 'jac_evals', 'lu_decompositions' and
+              'ode_steps' (only counted when t_eval is not given)
+
+Gillespie systems:  'ssa_events' (reactions executed) and
+                    'propensity_updates'
+
+Functions added with add_hook are called at the end of every phase,
+with the name of the phase, the elapsed time and the profiler.
+
+If no profiler is attached, the systems skip all of the above (the
+engines themselves are not instrumented).
+"""
+
+import contextlib
+import time
+import json
+
+NULL_PHASE = contextlib.nullcontext()
+
+class Profiler(object):
+
+    def __init__(self):
+        self.timers = {}
+        self.counters = {}
+        self.hooks = []
+
+    def phase(self, name):
+        """Returns a context manager that adds the time spent inside
+        it to the timer called name."""
+        return _Phase(self,name)
+
+    def add_time(self, name, elapsed):
+        if name in self.timers:
+            self.timers[name][0] += elapsed
+            self.timers[name][1] += 1
+        else:
+            self.timers[name] = [elapsed,1]
+
+        for h in self.hooks:
+            h(name,elapsed,self)
+
+    def count(self, name, n=1):
+        # stored as a python int, so that the summary can be written as JSON
+        self.counters[name] = self.counters.get(name,0) + int(n)
+
+    def add_hook(self, func):
+        """func(name, elapsed, profiler) is called at the end of every
+        phase."""
+        self.hooks.append(func)
+
+    def reset(self):
+        self.timers = {}
+        self.counters = {}
+
+    def rates(self):
+        """Returns the number of RHS evaluations and SSA events per
+        second spent in the 'propagate' phase."""
+
+        rates = {}
+        if 'propagate' in self.timers and self.timers['propagate'][0] > 0:
+            total = self.timers['propagate'][0]
+            if 'rhs_evals' in self.counters:
+                rates['rhs_evals_per_s'] = self.counters['rhs_evals']/total
+            if 'ssa_events' in self.counters:
+                rates['ssa_events_per_s'] = self.counters['ssa_events']/total
+        return rates
+
+    def summary(self):
+        """Returns a dictionary with the timers (total time, number of
+        calls and mean time of each phase), counters and rates."""
+
+        phases = {}
+        for name, (total, calls) in self.timers.items():
+            phases[name] = {'total' : total, 'calls' : calls, 'mean' : total/calls}
+
+        return {'phases' : phases,
+                'counters' : dict(self.counters),
+                'rates' : self.rates()}
+
+    def to_json(self, path):
+        """Writes the summary to a JSON file."""
+        with open(path,'w') as f:
+            json.dump(self.summary(),f,indent=2)
+
+class _Phase(object):
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.add_time(self.name,time.perf_counter() - self.start)
+        return False
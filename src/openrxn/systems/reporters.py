@@ -1,8 +1,29 @@
 """Reporters are attached to system objects and control
 what information is retained and attached to system.results
-during system dynamics."""
+during system dynamics.
+
+Reports are stored in preallocated numpy arrays that grow as 
+needed: an array of report times, and an array of values with
+one row per report.  These can be accessed without copying 
+through reporter.times() and reporter.values().
+
+A ReporterGroup evaluates many Sum, Avg, Selection, Max and 
+Min reporters together, with a single sparse matrix-vector 
+product and a few segmented reductions per report.
+
+ProfileReporters, SliceReporters and RadialReporters report
+sums (or means) of a species over spatial bins, using the positions
+of the State.  Bin membership is computed once, when the reporter
+is created.
+
+DiskReporters instead stream their reports to a directory of 
+chunked array files, which can be opened lazily with Trajectory."""
 
 import numpy as np
+import threading
+import queue
+import json
+import os
 
 class Reporter(object):
     """Base class for Reporters"""
@@ -17,7 +38,9 @@ class Reporter(object):
 
         """
         self.freq = freq
-        self._reports = []
+        self._n = 0
+        self._times = np.zeros(0)
+        self._values = None
 
     def report(self,current_time,current_state_vec):
         """Function for returning results that are attached
@@ -26,10 +49,63 @@ class Reporter(object):
 
         return NotImplementedError
 
+    def reserve(self,n):
+        """Makes sure that there is room for at least n reports
+        in total, to avoid growing the arrays during a run."""
+
+        if n <= len(self._times):
+            return
+        times = np.zeros(n)
+        times[:self._n] = self._times[:self._n]
+        self._times = times
+        if self._values is not None:
+            values = np.zeros((n,) + self._values.shape[1:],dtype=self._values.dtype)
+            values[:self._n] = self._values[:self._n]
+            self._values = values
+
+    def _append(self,current_time,value):
+        # adds a row to the storage arrays, doubling their size if needed
+        value = np.asarray(value)
+        if self._values is None:
+            self._values = np.zeros((len(self._times),) + value.shape,
+                                    dtype=np.result_type(value.dtype,float))
+        if self._n == len(self._times):
+            self.reserve(max(2*self._n,16))
+        self._times[self._n] = current_time
+        self._values[self._n] = value
+        self._n += 1
+
+    def times(self):
+        """Returns an array with the times of the reports.  This is a 
+        view of the storage array, which is not updated by later
+        reports."""
+
+        return self._times[:self._n]
+
+    def values(self):
+        """Returns an array with the reported values, with one
+        row per report.  This is a view of the storage array,
+        which is not updated by later reports."""
+
+        if self._values is None:
+            return np.zeros(0)
+        return self._values[:self._n]
+
+    def flush(self):
+        """Called by the System at the end of a run.  Reporters that
+        buffer their reports should write them out here."""
+
+        pass
+
+    def _to_report(self,value):
+        # converts a row of the values array to a report
+        return value
+
     def reports(self):
-        """Return the list of reports that have been collected."""
+        """Return the list of reports that have been collected, 
+        as dictionaries with keys 't' and 'report'."""
 
-        return self._reports
+        return [{'t': t, 'report': self._to_report(v)} for t,v in zip(self.times(),self.values())]
 
 class AllReporter(Reporter):
     """Reports the entire state_vec at some specified frequency."""
@@ -38,8 +114,7 @@ class AllReporter(Reporter):
         super().__init__(freq=freq)
 
     def report(self,current_time,current_state_vec):
-        self._reports.append({'t': current_time,
-                              'report': current_state_vec})
+        self._append(current_time,current_state_vec)
 
 class SelectionReporter(Reporter):
     """Reports a subsection of the full state_vec at some specified
@@ -55,8 +130,7 @@ class SelectionReporter(Reporter):
         super().__init__(freq=freq)
 
     def report(self,current_time,current_state_vec):
-        self._reports.append({'t': current_time,
-                              'report': current_state_vec[self.selection_idxs]})
+        self._append(current_time,current_state_vec[self.selection_idxs])
 
 class SumReporter(Reporter):
     """Reports the sum of values for a subselection of the 
@@ -72,8 +146,7 @@ class SumReporter(Reporter):
         super().__init__(freq=freq)
 
     def report(self,current_time,current_state_vec):
-        self._reports.append({'t': current_time,
-                              'report': np.sum(current_state_vec[self.selection_idxs])})
+        self._append(current_time,np.sum(current_state_vec[self.selection_idxs]))
 
 class AvgReporter(Reporter):
     """Reports the average of values for a subselection of the 
@@ -89,8 +162,7 @@ class AvgReporter(Reporter):
         super().__init__(freq=freq)
 
     def report(self,current_time,current_state_vec):
-        self._reports.append({'t': current_time,
-                              'report': np.sum(current_state_vec[self.selection_idxs])/len(self.selection_idxs)})
+        self._append(current_time,np.sum(current_state_vec[self.selection_idxs])/len(self.selection_idxs))
 
 class MaxReporter(Reporter):
     """Reports the maxmimum value over a subselection of the 
@@ -111,8 +183,10 @@ class MaxReporter(Reporter):
 
     def report(self,current_time,current_state_vec):
         tmp = current_state_vec[self.selection_idxs]
-        self._reports.append({'t': current_time,
-                              'report': (np.max(tmp),np.argmax(tmp))})
+        self._append(current_time,(np.max(tmp),np.argmax(tmp)))
+
+    def _to_report(self,value):
+        return (value[0],int(value[1]))
 
 class MinReporter(Reporter):
     """Reports the minimum value over a subselection of the 
@@ -133,6 +207,576 @@ class MinReporter(Reporter):
 
     def report(self,current_time,current_state_vec):
         tmp = current_state_vec[self.selection_idxs]
-        self._reports.append({'t': current_time,
-                              'report': (np.max(tmp),np.argmax(tmp))})
+        self._append(current_time,(np.min(tmp),np.argmin(tmp)))
+
+    def _to_report(self,value):
+        return (value[0],int(value[1]))
+
+
+class BinnedReporter(Reporter):
+    """Reports the sum (or mean) of the values in each of a set of
+    bins, for a subselection of the full state_vec at some specified
+    frequency.
+
+    selection_idxs : list of int
+    The indexes that are binned.
+
+    bin_idx : list of int
+    The bin of each index in selection_idxs.
+
+    shape : tuple of int
+    The shape of the array of bins (the number of bins is the 
+    product of the elements).
+
+    statistic : str
+    Either 'sum' or 'mean'.  Means of empty bins are reported as NaN.
+    """
+
+    def __init__(self, selection_idxs, bin_idx, shape, statistic='sum', freq=1):
+        super().__init__(freq=freq)
+        if statistic not in ['sum','mean']:
+            raise ValueError("Error! statistic must be either 'sum' or 'mean' ({0})".format(statistic))
+        self.selection_idxs = _indexes(selection_idxs).astype(int)
+        self.bin_idx = np.asarray(bin_idx,dtype=int)
+        self.shape = tuple(shape)
+        self.n_bins = int(np.prod(self.shape))
+        self.statistic = statistic
+        self.counts = np.bincount(self.bin_idx,minlength=self.n_bins).reshape(self.shape)
+
+    def report(self,current_time,current_state_vec):
+        sums = np.bincount(self.bin_idx,weights=current_state_vec[self.selection_idxs],
+                           minlength=self.n_bins).reshape(self.shape)
+        if self.statistic == 'mean':
+            with np.errstate(invalid='ignore',divide='ignore'):
+                sums = sums/self.counts
+        self._append(current_time,sums)
+
+def _indexes(selection_idxs):
+    # a flat array of indexes, for selections that are given either as
+    # indexes or as boolean masks over the state vector
+    idxs = np.asarray(selection_idxs)
+    if idxs.dtype == bool:
+        return np.flatnonzero(idxs)
+    return idxs.ravel()
+
+def _select_species(state, species, selection_idxs):
+    # returns the indexes in state of the given species (a species ID, a
+    # list of IDs, or None for all species), within selection_idxs
+    if species is None:
+        idxs = np.arange(state.size)
+    else:
+        idxs = state.select(species=species)
+    if selection_idxs is not None:
+        idxs = idxs[np.isin(idxs,_indexes(selection_idxs))]
+    return idxs
+
+def _positions(state, axis, idxs):
+    pos = getattr(state,axis + '_pos',None)
+    if pos is None or np.all(np.isnan(pos[idxs])):
+        raise ValueError("Error! The state has no positions along {0}".format(axis))
+    return pos[idxs].astype(float)
+
+def _magnitude(x, state_unit):
+    # strips the units of a position (or an array of positions), after
+    # converting to the units of the State
+    if hasattr(x,'units'):
+        return x.to(state_unit).magnitude
+    return x
+
+def _bin_edges(pos, bins, state_unit):
+    if np.ndim(bins) == 0 and not hasattr(bins,'units'):
+        return np.linspace(pos.min(),pos.max(),int(bins)+1)
+    return np.asarray(_magnitude(bins,state_unit),dtype=float)
+
+def _digitize(pos, edges):
+    # returns the bin of each position, and -1 for positions that are 
+    # outside of the edges (the last edge is included in the last bin)
+    b = np.searchsorted(edges,pos,side='right') - 1
+    b[pos == edges[-1]] = len(edges) - 2
+    b[(pos < edges[0]) | (pos > edges[-1])] = -1
+    return b
+
+AXES = ['x','y','z']
+
+class ProfileReporter(BinnedReporter):
+    """Reports a 1D profile of a species along an axis.
+
+    state : State
+    species : str, list of str or None (all species)
+    axis : 'x', 'y' or 'z'
+    bins : either a number of equal bins spanning the range of 
+           positions, or an array of bin edges (optionally with units)
+    selection_idxs : optionally restricts the reporter to these indexes
+
+    self.edges and self.centers hold the bin edges and centers.
+    """
+
+    def __init__(self, state, species=None, axis='z', bins=10, statistic='sum',
+                 selection_idxs=None, freq=1):
+        idxs = _select_species(state,species,selection_idxs)
+        a = AXES.index(axis)
+        pos = _positions(state,axis,idxs)
+        self.edges = _bin_edges(pos,bins,state.units[a])
+        self.centers = 0.5*(self.edges[1:] + self.edges[:-1])
+        b = _digitize(pos,self.edges)
+        keep = b >= 0
+        super().__init__(idxs[keep],b[keep],(len(self.edges)-1,),statistic=statistic,freq=freq)
+
+class SliceReporter(BinnedReporter):
+    """Reports a 2D map of a species, binned along two axes.  Use
+    selection_idxs to restrict the map to a slab along the third axis.
+
+    state : State
+    species : str, list of str or None (all species)
+    axes : tuple of two axes, e.g. ('x','y')
+    bins : tuple with, for each axis, either a number of bins or
+           an array of bin edges
+
+    Reports have shape (n_bins_0, n_bins_1).  self.edges is a list
+    with the bin edges along each axis.
+    """
+
+    def __init__(self, state, species=None, axes=('x','y'), bins=(10,10), statistic='sum',
+                 selection_idxs=None, freq=1):
+        idxs = _select_species(state,species,selection_idxs)
+        self.edges = []
+        bs = []
+        for axis, nb in zip(axes,bins):
+            pos = _positions(state,axis,idxs)
+            edges = _bin_edges(pos,nb,state.units[AXES.index(axis)])
+            self.edges.append(edges)
+            bs.append(_digitize(pos,edges))
+        keep = (bs[0] >= 0) & (bs[1] >= 0)
+        shape = (len(self.edges[0])-1,len(self.edges[1])-1)
+        bin_idx = bs[0][keep]*shape[1] + bs[1][keep]
+        super().__init__(idxs[keep],bin_idx,shape,statistic=statistic,freq=freq)
+
+class RadialReporter(BinnedReporter):
+    """Reports a species binned in spherical (or circular) shells
+    around a center point.
+
+    state : State
+    center : tuple of positions, one for each of the axes
+    species : str, list of str or None (all species)
+    axes : the axes used to compute distances (default: x, y and z)
+    bins : either a number of shells spanning the range of distances,
+           or an array of shell radii (optionally with units)
+
+    self.edges and self.centers hold the shell radii and mid-points.
+    """
+
+    def __init__(self, state, center, species=None, axes=('x','y','z'), bins=10, statistic='sum',
+                 selection_idxs=None, freq=1):
+        idxs = _select_species(state,species,selection_idxs)
+        r2 = np.zeros(len(idxs))
+        for axis, c in zip(axes,center):
+            a = AXES.index(axis)
+            r2 += (_positions(state,axis,idxs) - _magnitude(c,state.units[a]))**2
+        r = np.sqrt(r2)
+        self.edges = _bin_edges(r,bins,state.units[AXES.index(axes[0])])
+        self.centers = 0.5*(self.edges[1:] + self.edges[:-1])
+        b = _digitize(r,self.edges)
+        keep = b >= 0
+        super().__init__(idxs[keep],b[keep],(len(self.edges)-1,),statistic=statistic,freq=freq)
+
+class ReporterGroup(Reporter):
+    """Evaluates a group of reporters together.  The results are 
+    stored in the member reporters as usual, so the group (and not 
+    the members) should be attached to the system.
+
+    reporters : list of Reporter
+    All reporters must have the same frequency.
+
+    SumReporters, AvgReporters and SelectionReporters are compiled
+    into the rows of one sparse (n_rows x size) matrix, which is 
+    multiplied by the state vector once per report.  MaxReporters and
+    MinReporters are evaluated with segmented reductions over the 
+    concatenation of their selections.  Other reporters are called 
+    one at a time.
+    """
+
+    def __init__(self, reporters, freq=None):
+        freqs = set([r.freq for r in reporters])
+        if freq is None:
+            if len(freqs) != 1:
+                raise ValueError("Error! Reporters in a group must have the same frequency ({0})".format(freqs))
+            freq = freqs.pop()
+        elif freqs != set([freq]):
+            raise ValueError("Error! Reporters in a group must have the same frequency as the group ({0}) ({1})".format(freq,freqs))
+        super().__init__(freq=freq)
+
+        self.reporters = list(reporters)
+        self._linear = []
+        self._others = []
+        max_reps = []
+        min_reps = []
+
+        rows = []
+        cols = []
+        vals = []
+        n_rows = 0
+        for r in self.reporters:
+            if type(r) in [SumReporter,AvgReporter,SelectionReporter]:
+                idxs = _indexes(r.selection_idxs)
+                if type(r) is SelectionReporter:
+                    rows += list(n_rows + np.arange(len(idxs)))
+                    vals += [1.0]*len(idxs)
+                    self._linear.append((r,n_rows,n_rows+len(idxs),False))
+                    n_rows += len(idxs)
+                else:
+                    w = 1.0 if type(r) is SumReporter else 1.0/len(idxs)
+                    rows += [n_rows]*len(idxs)
+                    vals += [w]*len(idxs)
+                    self._linear.append((r,n_rows,n_rows+1,True))
+                    n_rows += 1
+                cols += list(idxs)
+            elif type(r) is MaxReporter:
+                max_reps.append(r)
+            elif type(r) is MinReporter:
+                min_reps.append(r)
+            else:
+                self._others.append(r)
+
+        self._n_rows = n_rows
+        self._rows = np.array(rows,dtype=int)
+        self._cols = np.array(cols,dtype=int)
+        self._vals = np.array(vals)
+        self._matrix = None
+
+        self._max = self._segments(max_reps)
+        self._min = self._segments(min_reps)
+
+    def _segments(self, reporters):
+        # concatenates the selections of a list of reporters
+        if len(reporters) == 0:
+            return None
+        sels = [_indexes(r.selection_idxs) for r in reporters]
+        lens = np.array([len(sel) for sel in sels])
+        if np.any(lens == 0):
+            raise ValueError("Error! Max and Min reporters need a non-empty selection")
+        starts = np.concatenate(([0],np.cumsum(lens)[:-1]))
+        seg_id = np.repeat(np.arange(len(sels)),lens)
+        return (reporters,np.concatenate(sels),starts,lens,seg_id)
+
+    def _segmented(self, segs, current_time, current_state_vec, ufunc):
+        reporters, idxs, starts, lens, seg_id = segs
+        vals = current_state_vec[idxs]
+        ext = ufunc.reduceat(vals,starts)
+        # position of the first element that equals the extremum in each
+        # segment (the first NaN, if the extremum is NaN, as np.argmax)
+        seg_ext = np.repeat(ext,lens)
+        hit = (vals == seg_ext) | (np.isnan(vals) & np.isnan(seg_ext))
+        pos = np.where(hit,np.arange(len(vals)),len(vals))
+        args = np.minimum.reduceat(pos,starts) - starts
+        for k,r in enumerate(reporters):
+            r._append(current_time,(ext[k],args[k]))
+
+    def report(self,current_time,current_state_vec):
+        if self._n_rows > 0:
+            if self._matrix is None or self._matrix.shape[1] != len(current_state_vec):
+                from scipy import sparse
+                self._matrix = sparse.csr_matrix((self._vals,(self._rows,self._cols)),
+                                                 shape=(self._n_rows,len(current_state_vec)))
+            y = self._matrix.dot(current_state_vec)
+            for r,start,end,scalar in self._linear:
+                if scalar:
+                    r._append(current_time,y[start])
+                else:
+                    r._append(current_time,y[start:end])
+
+        if self._max is not None:
+            self._segmented(self._max,current_time,current_state_vec,np.maximum)
+        if self._min is not None:
+            self._segmented(self._min,current_time,current_state_vec,np.minimum)
+
+        for r in self._others:
+            r.report(current_time,current_state_vec)
+
+    def reserve(self,n):
+        for r in self.reporters:
+            r.reserve(n)
+
+    def times(self):
+        if len(self.reporters) == 0:
+            return np.zeros(0)
+        return self.reporters[0].times()
+
+    def values(self):
+        """Returns a list with the values of each member reporter."""
+        return [r.values() for r in self.reporters]
+
+    def reports(self):
+        """Returns a list with the reports of each member reporter."""
+        return [r.reports() for r in self.reporters]
+
+    def flush(self):
+        for r in self.reporters:
+            r.flush()
+
+class DiskReporter(Reporter):
+    """Streams the full state_vec (or a subsection of it) to disk at
+    some specified frequency, without keeping the reports in memory.
+
+    path : str
+    A directory where the reports are written.  Frames are stored in
+    chunks of chunk_size reports, either as .npy files that are 
+    filled in place through memory maps, or (if compress is True) as 
+    compressed .npz files that are written when a chunk is complete.
+    A meta.json file describes the chunks that have been written.
+
+    selection_idxs : list of int
+    A list of indexes to report (default: all).  This needs to be 
+    compatible with the elements of the system.state.q_vec vector.
+
+    dtype : numpy dtype
+    The type used to store the values (e.g. np.float32 to halve the 
+    size of the files).
+
+    The files are written by a background thread, which receives the 
+    frames through a queue of at most max_queue frames.  The files are
+    complete after flush() (which is called at the end of System.run) 
+    or close().  The reports can be read with Trajectory(path).
+    """
+
+    def __init__(self, path, selection_idxs=None, freq=1, chunk_size=1000,
+                 compress=False, dtype=np.float64, max_queue=100):
+        super().__init__(freq=freq)
+        self.path = path
+        self.selection_idxs = selection_idxs
+        self.chunk_size = chunk_size
+        self.compress = compress
+        self.dtype = np.dtype(dtype)
+
+        os.makedirs(path,exist_ok=True)
+        self._chunks = []
+        self._chunk = None
+        self._chunk_times = None
+        self._chunk_n = 0
+        self._n_columns = None
+        self._error = None
+
+        self.max_queue = max_queue
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+
+    def report(self,current_time,current_state_vec):
+        if self._error is not None:
+            raise self._error
+        if self.selection_idxs is None:
+            frame = np.array(current_state_vec,dtype=self.dtype)
+        else:
+            frame = np.array(current_state_vec[self.selection_idxs],dtype=self.dtype)
+
+        if self._thread is None:
+            self._n_columns = len(frame)
+            self._thread = threading.Thread(target=self._writer,daemon=True)
+            self._thread.start()
+
+        if self._n == len(self._times):
+            self.reserve(max(2*self._n,16))
+        self._times[self._n] = current_time
+        self._n += 1
+
+        self._queue.put((current_time,frame))
+
+    def _writer(self):
+        # runs in the background thread
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                if item == 'flush':
+                    self._write_chunk(partial=True)
+                else:
+                    self._write_frame(*item)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _chunk_file(self, i):
+        if self.compress:
+            return "chunk_{0:05d}.npz".format(i)
+        return "chunk_{0:05d}.npy".format(i)
+
+    def _write_frame(self, t, frame):
+        if self._chunk is None:
+            i = len(self._chunks)
+            if self.compress:
+                self._chunk = np.zeros((self.chunk_size,self._n_columns),dtype=self.dtype)
+            else:
+                self._chunk = np.lib.format.open_memmap(os.path.join(self.path,self._chunk_file(i)),mode='w+',
+                                                        dtype=self.dtype,shape=(self.chunk_size,self._n_columns))
+            self._chunk_times = np.zeros(self.chunk_size)
+            self._chunk_n = 0
+
+        self._chunk[self._chunk_n] = frame
+        self._chunk_times[self._chunk_n] = t
+        self._chunk_n += 1
+
+        if self._chunk_n == self.chunk_size:
+            self._write_chunk(partial=False)
+
+    def _write_chunk(self, partial):
+        # writes the current chunk, and the meta data file
+        if self._chunk is None:
+            return
+        i = len(self._chunks)
+        fname = self._chunk_file(i)
+        n = self._chunk_n
+        if self.compress:
+            np.savez_compressed(os.path.join(self.path,fname),
+                                frames=self._chunk[:n],times=self._chunk_times[:n])
+        else:
+            self._chunk.flush()
+            np.save(os.path.join(self.path,"times_{0:05d}.npy".format(i)),self._chunk_times[:n])
+
+        info = {'file': fname, 'n_frames': n}
+        if partial:
+            self._write_meta(self._chunks + [info])
+        else:
+            self._chunks.append(info)
+            self._write_meta(self._chunks)
+            self._chunk = None
+
+    def _write_meta(self, chunks):
+        meta = {'n_columns': self._n_columns,
+                'dtype': self.dtype.str,
+                'chunk_size': self.chunk_size,
+                'compress': self.compress,
+                'chunks': chunks}
+        if self.selection_idxs is not None:
+            meta['selection_idxs'] = [int(i) for i in self.selection_idxs]
+        tmp = os.path.join(self.path,'meta.json.tmp')
+        with open(tmp,'w') as f:
+            json.dump(meta,f)
+        os.replace(tmp,os.path.join(self.path,'meta.json'))
+
+    def flush(self):
+        """Waits until all reports have been written to disk."""
+        if self._thread is None:
+            return
+        self._queue.put('flush')
+        self._queue.join()
+        if self._error is not None:
+            raise self._error
+
+    def close(self):
+        """Writes all reports and stops the background thread."""
+        if self._thread is None:
+            return
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def __getstate__(self):
+        # waits for the pending frames, and stores the current chunk
+        # as an array instead of the thread, queue and memory map (e.g.
+        # in checkpoints)
+        if self._thread is not None:
+            self._queue.join()
+        if self._error is not None:
+            raise self._error
+        state = self.__dict__.copy()
+        del state['_queue']
+        state['_thread'] = None
+        if self._chunk is not None:
+            state['_chunk'] = np.array(self._chunk)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._queue = queue.Queue(maxsize=self.max_queue)
+        if self._chunk is not None and not self.compress:
+            # reopen the memory map of the current chunk; frames that 
+            # were written after the state was saved are overwritten
+            chunk = np.lib.format.open_memmap(os.path.join(self.path,self._chunk_file(len(self._chunks))),
+                                              mode='w+',dtype=self.dtype,shape=self._chunk.shape)
+            chunk[:] = self._chunk
+            self._chunk = chunk
+        if self._n_columns is not None:
+            self._thread = threading.Thread(target=self._writer,daemon=True)
+            self._thread.start()
+
+    def trajectory(self):
+        """Returns a Trajectory object to read the reports."""
+        self.flush()
+        return Trajectory(self.path)
+
+    def values(self):
+        """Returns an array with all of the reported values.  Note that 
+        this loads all of the reports into memory, see trajectory() for
+        lazy access."""
+
+        if self._n == 0:
+            return np.zeros(0)
+        return self.trajectory()[:]
+
+class Trajectory(object):
+    """Reads the reports written by a DiskReporter.  Frames are 
+    loaded lazily, one chunk at a time; uncompressed chunks are
+    opened as read-only memory maps.
+
+    traj = Trajectory(path)
+    traj.times()     # array of all report times
+    traj[10]         # the 11th frame
+    traj[::100]      # every 100th frame, shape (T, n_columns)
+    for t, frames in traj.chunks(): ...
+    """
 
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path,'meta.json')) as f:
+            self.meta = json.load(f)
+        self.n_columns = self.meta['n_columns']
+        self._counts = np.array([c['n_frames'] for c in self.meta['chunks']],dtype=int)
+        self._starts = np.concatenate(([0],np.cumsum(self._counts)))
+        self._cache = {}
+
+    def __len__(self):
+        return int(self._starts[-1])
+
+    def _load(self, i):
+        # returns (times, frames) for chunk i
+        if i not in self._cache:
+            info = self.meta['chunks'][i]
+            n = info['n_frames']
+            fname = os.path.join(self.path,info['file'])
+            if self.meta['compress']:
+                with np.load(fname) as data:
+                    self._cache = {i: (data['times'],data['frames'])}
+            else:
+                times = np.load(os.path.join(self.path,"times_{0:05d}.npy".format(i)))
+                frames = np.load(fname,mmap_mode='r')[:n]
+                self._cache = {i: (times,frames)}
+        return self._cache[i]
+
+    def chunks(self):
+        """Iterates over the chunks, yielding tuples (times, frames)."""
+        for i in range(len(self._counts)):
+            yield self._load(i)
+
+    def times(self):
+        """Returns an array with the times of all reports."""
+        if len(self._counts) == 0:
+            return np.zeros(0)
+        return np.concatenate([self._load(i)[0] for i in range(len(self._counts))])
+
+    def __getitem__(self, idx):
+        if isinstance(idx,(int,np.integer)):
+            if idx < 0:
+                idx += len(self)
+            if idx < 0 or idx >= len(self):
+                raise IndexError("Error! Frame {0} is out of range ({1} frames)".format(idx,len(self)))
+            i = np.searchsorted(self._starts,idx,side='right') - 1
+            return np.array(self._load(i)[1][idx - self._starts[i]])
+
+        frames = np.arange(len(self))[idx]
+        out = np.zeros((len(frames),self.n_columns),dtype=np.dtype(self.meta['dtype']))
+        chunk_of = np.searchsorted(self._starts,frames,side='right') - 1
+        for i in np.unique(chunk_of):
+            mask = chunk_of == i
+            out[mask] = self._load(i)[1][frames[mask] - self._starts[i]]
+        return out
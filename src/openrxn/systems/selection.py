@@ -0,0 +1,227 @@
+"""A SelectionIndex answers selection queries on a State, without
+comparing the strings of every entry:
+
+sel = state.select(species='drug', slab=('z', 23, 25))
+
+is equivalent to
+
+sel = np.where(np.logical_and(state.species == 'drug',
+               np.logical_and(state.z_pos >= 23, state.z_pos <= 25)))[0]
+
+The index is built once per State (see state.selection) and holds:
+
+- inverted lists of the entries of each species and compartment code
+  of the State
+- the position of each compartment, sorted along each axis, so that
+  slab and box queries are binary searches
+- a k-d tree of the compartment positions (built on first use) for
+  sphere queries
+
+Spatial queries select compartments, which are expanded to their
+entries with the inverted lists.  Positions are in the units of the
+State (state.units), or can be given as Quantities.  The results are
+sorted arrays of indexes, which are cached, and should not be modified.
+"""
+
+import numpy as np
+
+AXES = ['x','y','z']
+
+class _InvertedList(object):
+    # the entries of each code, stored contiguously (as in a CSR matrix)
+
+    def __init__(self, codes, n_codes):
+        self.order = np.argsort(codes,kind='stable')
+        counts = np.bincount(codes,minlength=n_codes)
+        self.starts = np.concatenate(([0],np.cumsum(counts)))
+
+    def get(self, code):
+        return self.order[self.starts[code]:self.starts[code+1]]
+
+    def get_many(self, codes):
+        if len(codes) == 1:
+            return self.get(codes[0])
+        codes = np.asarray(codes,dtype=int)
+        lo = self.starts[codes]
+        n = self.starts[codes+1] - lo
+        # positions in self.order of all of the entries of the codes
+        pos = np.repeat(lo - np.cumsum(n) + n,n) + np.arange(n.sum())
+        return np.sort(self.order[pos])
+
+class SelectionIndex(object):
+
+    def __init__(self, state):
+        self.size = state.size
+        self.units = state.units
+
+        # the categorical codes of the state
+        self.species_names, self.species_codes = state.species_names, state.species_codes
+        self.compartment_names, self.compartment_codes = state.compartment_names, state.compartment_codes
+        self._species_lookup = {s:i for i,s in enumerate(self.species_names)}
+        self._compartment_lookup = {c:i for i,c in enumerate(self.compartment_names)}
+
+        self._by_species = _InvertedList(self.species_codes,len(self.species_names))
+        self._by_compartment = _InvertedList(self.compartment_codes,len(self.compartment_names))
+
+        # the position of each compartment (nan if it does not have one,
+        # or if it has no entries)
+        n_comp = len(self.compartment_names)
+        starts = self._by_compartment.starts
+        filled = np.nonzero(starts[1:] > starts[:-1])[0]
+        first = self._by_compartment.order[starts[filled]]
+        self.positions = np.full((n_comp,3),np.nan)
+        for a,axis in enumerate(AXES):
+            pos = getattr(state,axis + '_pos',None)
+            if pos is not None and len(first) > 0:
+                self.positions[filled,a] = np.asarray(pos[first],dtype=float)
+
+        # compartments sorted along each axis
+        self._sorted = []
+        for a in range(3):
+            valid = np.nonzero(~np.isnan(self.positions[:,a]))[0]
+            order = valid[np.argsort(self.positions[valid,a],kind='stable')]
+            self._sorted.append((order,self.positions[order,a]))
+
+        self._tree = None
+        self._tree_axes = None
+        self._cache = {}
+
+    def _code(self, lookup, name, kind):
+        if name not in lookup:
+            raise ValueError("Error! {0} {1} is not in the state".format(kind,name))
+        return lookup[name]
+
+    def species(self, species):
+        """Returns the entries of a species ID (or a list of IDs)."""
+        codes = [self._code(self._species_lookup,s,'species') for s in np.atleast_1d(species)]
+        return self._by_species.get_many(codes)
+
+    def compartments(self, compartments):
+        """Returns the entries of a compartment ID (or a list of IDs)."""
+        codes = [self._code(self._compartment_lookup,c,'compartment') for c in np.atleast_1d(compartments)]
+        return self._by_compartment.get_many(codes)
+
+    def _axis(self, axis):
+        if axis not in AXES:
+            raise ValueError("Error! axis must be one of 'x', 'y' or 'z' ({0})".format(axis))
+        return AXES.index(axis)
+
+    def _magnitude(self, x, a):
+        if hasattr(x,'units'):
+            return x.to(self.units[a]).magnitude
+        return x
+
+    def _slab_compartments(self, a, lo, hi):
+        # compartment codes with lo <= position <= hi along axis a
+        order, pos = self._sorted[a]
+        i = np.searchsorted(pos,self._magnitude(lo,a),side='left')
+        j = np.searchsorted(pos,self._magnitude(hi,a),side='right')
+        return order[i:j]
+
+    def _box_compartments(self, lo, hi):
+        # intersect the slabs of the bounded axes, starting from the 
+        # smallest one
+        slabs = []
+        for a in range(len(lo)):
+            if lo[a] is None and hi[a] is None:
+                continue
+            l = -np.inf if lo[a] is None else lo[a]
+            h = np.inf if hi[a] is None else hi[a]
+            slabs.append(self._slab_compartments(a,l,h))
+        if len(slabs) == 0:
+            return np.arange(len(self.compartment_names))
+        slabs.sort(key=len)
+        comps = slabs[0]
+        for s in slabs[1:]:
+            comps = comps[np.isin(comps,s)]
+        return comps
+
+    def _tree_query(self, center, radius):
+        if self._tree is None:
+            from scipy.spatial import cKDTree
+            axes = [a for a in range(3) if not np.all(np.isnan(self.positions[:,a]))]
+            valid = np.nonzero(~np.any(np.isnan(self.positions[:,axes]),axis=1))[0]
+            self._tree = cKDTree(self.positions[np.ix_(valid,axes)])
+            self._tree_axes = axes
+            self._tree_valid = valid
+        center = [self._magnitude(center[a],a) for a in self._tree_axes]
+        radius = self._magnitude(radius,self._tree_axes[0])
+        hits = self._tree.query_ball_point(center,radius)
+        return self._tree_valid[np.asarray(hits,dtype=int)]
+
+    def _expand(self, comps):
+        # the entries of a set of compartment codes
+        if len(comps) == 0:
+            return np.zeros(0,dtype=int)
+        return self._by_compartment.get_many(comps)
+
+    def slab(self, axis, lo, hi):
+        """Returns the entries with lo <= position <= hi along axis."""
+        return self._expand(self._slab_compartments(self._axis(axis),lo,hi))
+
+    def box(self, lo, hi):
+        """Returns the entries inside a box, given by its lower and
+        upper corners (use None for an unbounded axis)."""
+        return self._expand(self._box_compartments(lo,hi))
+
+    def sphere(self, center, radius):
+        """Returns the entries within radius of center."""
+        return self._expand(np.sort(self._tree_query(center,radius)))
+
+    def select(self, species=None, compartments=None, box=None, sphere=None, slab=None):
+        """Returns the (sorted) entries that satisfy all of the given
+        conditions:
+
+        species      : a species ID or a list of IDs
+        compartments : a compartment ID or a list of IDs
+        box          : (lo, hi) corners of a box
+        sphere       : (center, radius)
+        slab         : (axis, lo, hi)
+
+        The results are cached."""
+
+        key = _key((species,compartments,box,sphere,slab))
+        if key is not None and key in self._cache:
+            return self._cache[key]
+
+        sets = []
+        if species is not None:
+            sets.append(self.species(species))
+        if compartments is not None:
+            sets.append(self.compartments(compartments))
+        if box is not None:
+            sets.append(self.box(*box))
+        if sphere is not None:
+            sets.append(self.sphere(*sphere))
+        if slab is not None:
+            sets.append(self.slab(*slab))
+
+        if len(sets) == 0:
+            result = np.arange(self.size)
+        else:
+            sets.sort(key=len)
+            result = sets[0]
+            for s in sets[1:]:
+                result = result[np.isin(result,s,assume_unique=True)]
+
+        result = np.array(result,dtype=int)
+        result.setflags(write=False)
+        if key is not None:
+            self._cache[key] = result
+        return result
+
+def _key(args):
+    # a hashable version of the query arguments, or None if they can
+    # not be hashed (e.g. Quantities)
+    def freeze(x):
+        if isinstance(x,(list,tuple,np.ndarray)):
+            return tuple(freeze(y) for y in x)
+        if hasattr(x,'units'):
+            return (freeze(x.magnitude),str(x.units))
+        return x
+    try:
+        key = freeze(args)
+        hash(key)
+        return key
+    except TypeError:
+        return None
@@ -0,0 +1,186 @@
+"""Spectral propagation of transport on periodic lattices.
+
+The transport of a species on a periodic array of compartments with
+the same rates everywhere (e.g. a periodic CompartmentArray1D/2D/3D
+with uniform widths and an IsotropicConnection or FicksConnection) is
+a circulant linear operator, which is diagonal in Fourier space.  Its
+exact propagator over a time step dt is then:
+
+q(t + dt) = ifft( exp(lambda * dt) * fft(q(t)) )
+
+where lambda are the eigenvalues of the operator.  For a transfer
+rate k+ from each site to its neighbor along an axis (and k- to the
+previous one), with n sites along that axis:
+
+lambda(m) += k+ (exp(-2 pi i m/n) - 1) + k- (exp(2 pi i m/n) - 1)
+
+SpectralDiffusion finds these lattices from the transport processes of
+a MassActionNetwork (see process_kinds), without using the model:
+the entries of a species are placed on a lattice by the positions of
+their compartments, and the lattice is used if every site has one
+transfer process to its neighbor in each direction along each axis,
+with the same rate constant everywhere (the wrap-around transfers
+make it periodic).  The transfers of these lattices are removed from
+the network, and the remaining processes (reactions, transport of
+other species, Reservoirs) are returned by rest(), to be propagated
+separately (see ODESystem.propagate with method='spectral').
+"""
+
+import numpy as np
+
+class SpectralDiffusion(object):
+
+    def __init__(self, network, state):
+        """Finds the periodic lattices of each species of state in the
+        transport processes of network."""
+
+        self.size = network.size
+        self.network = network
+        self.grids = []
+        self.handled = np.zeros(network.n_processes,dtype=bool)
+        self._factors = {}
+
+        src, dst, k, proc = _transfers(network)
+        pos = np.full((state.size,3),np.nan)
+        for a, axis in enumerate(['x','y','z']):
+            p = getattr(state,axis + '_pos',None)
+            if p is not None:
+                pos[:,a] = p
+
+        for code, species in enumerate(state.species_names):
+            entries = np.nonzero((state.species_codes == code) & ~np.all(np.isnan(pos),axis=1))[0]
+            grid = _lattice(entries,pos[entries])
+            if grid is None:
+                continue
+            sites, coords = grid
+
+            # the transfers between the entries of the lattice
+            site_of = np.full(self.size,-1)
+            site_of[entries] = np.arange(len(entries))
+            on = (site_of[src] >= 0) & (site_of[dst] >= 0)
+            lam = _eigenvalues(sites.shape,coords[site_of[src[on]]],coords[site_of[dst[on]]],k[on])
+            if lam is None:
+                continue
+            self.grids.append((species,sites,lam))
+            self.handled[proc[on]] = True
+
+    def rest(self):
+        """Returns a MassActionNetwork with the processes that are not
+        propagated spectrally."""
+        return self.network.subset(~self.handled)
+
+    def propagate(self, q, dt):
+        """Returns the quantities q after transport along the lattices
+        for a time dt (the other entries of q are unchanged)."""
+
+        q = q.copy()
+        for g, (species, sites, lam) in enumerate(self.grids):
+            key = (g,dt)
+            if key not in self._factors:
+                # only the factors of the last two time steps are kept
+                # (e.g. a half step and a full step of a splitting)
+                if len(self._factors) >= 2*len(self.grids):
+                    self._factors.pop(next(iter(self._factors)))
+                self._factors[key] = np.exp(lam*dt)
+            factor = self._factors[key]
+            x = q[sites]
+            if np.isrealobj(factor):
+                q[sites] = np.fft.irfftn(factor*np.fft.rfftn(x),s=x.shape)
+            else:
+                q[sites] = np.fft.ifftn(factor*np.fft.fftn(x)).real
+        return q
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_factors'] = {}
+        return state
+
+def _transfers(network):
+    # the transport processes that move one unit from i to j at a
+    # rate k*q[i]: returns (i, j, k, process index)
+    csc = network.stoich.tocsc()
+    nnz = np.diff(csc.indptr)
+    first_order = (network.q_idx[:,0] < network.size)
+    if network.max_order > 1:
+        first_order &= np.all(network.q_idx[:,1:] == network.size,axis=1)
+    cand = np.nonzero((network.kinds == 'transport') & first_order & (nnz == 2))[0]
+
+    src = network.q_idx[cand,0]
+    rows = csc.indices[csc.indptr[cand][:,None] + np.arange(2)]
+    vals = csc.data[csc.indptr[cand][:,None] + np.arange(2)]
+    dst = np.where(rows[:,0] == src,rows[:,1],rows[:,0])
+    v_src = np.where(rows[:,0] == src,vals[:,0],vals[:,1])
+    v_dst = np.where(rows[:,0] == src,vals[:,1],vals[:,0])
+    ok = (v_src == -1) & (v_dst == 1) & (dst != src)
+    return src[ok], dst[ok], network.k[cand[ok]], cand[ok]
+
+def _levels(x):
+    # groups equal values (up to rounding) and returns their rank
+    order = np.argsort(x,kind='stable')
+    xs = x[order]
+    tol = 1e-9*max(np.abs(xs).max(initial=0),1.0)
+    rank = np.empty(len(x),dtype=int)
+    rank[order] = np.concatenate(([0],np.cumsum(np.diff(xs) > tol)))
+    return rank
+
+def _lattice(entries, pos):
+    # places entries on a full lattice using their positions: returns
+    # the entries as an array with the shape of the lattice, and the
+    # lattice coordinates of each entry (or None)
+    if len(entries) < 2:
+        return None
+    axes = [a for a in range(3) if not np.all(np.isnan(pos[:,a]))]
+    if np.any(np.isnan(pos[:,axes])):
+        return None
+
+    coords = np.stack([_levels(pos[:,a]) for a in axes],axis=1)
+    shape = tuple(int(c) for c in coords.max(axis=0) + 1)
+    if int(np.prod(shape)) != len(entries):
+        return None
+    flat = np.ravel_multi_index(tuple(coords.T),shape)
+    if len(np.unique(flat)) != len(entries):
+        return None
+
+    sites = np.empty(len(entries),dtype=int)
+    sites[flat] = entries
+    return sites.reshape(shape), coords
+
+def _eigenvalues(shape, c_src, c_dst, k):
+    # the eigenvalues of a circulant transport operator (or None if
+    # the transfers do not form one)
+    n_sites = int(np.prod(shape))
+    if len(k) == 0:
+        return None
+    n = np.array(shape)
+    offset = (c_dst - c_src) % n
+    moved = offset != 0
+    if np.any(moved.sum(axis=1) != 1):
+        return None
+    axis = np.argmax(moved,axis=1)
+    step = offset[np.arange(len(k)),axis]
+
+    lam = np.zeros(shape,dtype=complex)
+    for a in range(len(shape)):
+        for direction in [1,-1]:
+            sel = (axis == a) & (step == direction % n[a])
+            if direction == -1 and n[a] == 2:
+                # the previous site is also the next one
+                continue
+            if not sel.any():
+                continue
+            if sel.sum() != n_sites or len(np.unique(c_src[sel],axis=0)) != n_sites:
+                return None
+            if np.ptp(k[sel]) > 1e-12*np.abs(k[sel]).max():
+                return None
+            m = np.arange(n[a])
+            phase = np.exp(-direction*2j*np.pi*m/n[a]) - 1
+            shp = [1]*len(shape)
+            shp[a] = n[a]
+            lam = lam + k[sel].mean()*phase.reshape(shp)
+    if np.any((step != 1) & (step != n[axis] - 1)):
+        return None
+
+    if np.allclose(lam.imag,0,atol=1e-12*np.abs(lam).max(initial=1)):
+        # a symmetric operator: only the half spectrum of rfftn is needed
+        return np.ascontiguousarray(lam.real[...,:shape[-1]//2+1])
+    return lam
@@ -15,6 +15,15 @@ state.x_pos is a numpy array of x_positions of the compartment centers
 state.y_pos is a numpy array of y_positions of the compartment centers
 state.z_pos is a numpy array of z_positions of the compartment centers
 
+The species and compartments are stored compactly, as integer codes
+(state.species_codes, state.compartment_codes) into small tables of
+names (state.species_names, state.compartment_names), and the string
+arrays above are built from these when they are accessed.  Positions
+are nan along the dimensions that a compartment does not have.
+
+The order of the entries is deterministic, and set by the ordering
+argument (see State.__init__).
+
 Note that species values for a given compartment will only be created
 if there is either:
 1) a Reaction in that compartment which involves that Species
@@ -24,102 +33,306 @@ When initializing the state, an index is constructed to easily
 determine an index given a compartment and a species:
 
 index = state.index[compID][specID]
+
+(see StateIndex), and state.select() can be used for selections
+(see openrxn.systems.selection).
 """
 
 from openrxn import unit
 from openrxn.model import FlatModel
+from openrxn.systems.selection import SelectionIndex
 import numpy as np
-import pandas as pd
+
+class StateIndex(object):
+    """Finds the index of a (compartment, species) pair in the state
+    vector, with the same interface as a dictionary of dictionaries:
+
+    i = state.index[compID][specID]
+
+    The pairs are stored as sorted integer keys, so that lookups are
+    binary searches."""
+
+    def __init__(self, compartment_names, compartment_codes, species_names, species_codes):
+        self._compartments = {c:k for k,c in enumerate(compartment_names)}
+        self._species = {s:k for k,s in enumerate(species_names)}
+        self._compartment_names = compartment_names
+        self._species_names = species_names
+        self._n_species = max(len(species_names),1)
+
+        keys = compartment_codes.astype(np.int64)*self._n_species + species_codes
+        self._order = np.argsort(keys,kind='stable')
+        self._keys = keys[self._order]
+        # the species codes of each compartment are self._row_species[lo:hi],
+        # with lo, hi = self._starts[c], self._starts[c+1]
+        self._row_species = np.asarray(species_codes)[self._order]
+        self._starts = np.searchsorted(self._keys,np.arange(len(compartment_names)+1)*self._n_species)
+
+    def __getitem__(self, c):
+        if c not in self._compartments:
+            raise KeyError(c)
+        return _CompartmentIndex(self,self._compartments[c])
+
+    def __contains__(self, c):
+        return c in self._compartments
+
+    def __iter__(self):
+        return iter(self._compartments)
+
+    def __len__(self):
+        return len(self._compartments)
+
+    def keys(self):
+        return self._compartments.keys()
+
+    def items(self):
+        return [(c,self[c]) for c in self._compartments]
+
+    def lookup(self, compartments, species):
+        """Returns an array with the index of each (compartment, species)
+        pair, given two sequences of IDs."""
+
+        try:
+            keys = np.array([self._compartments[c]*self._n_species + self._species[s]
+                             for c,s in zip(compartments,species)],dtype=np.int64)
+        except KeyError as e:
+            raise KeyError("{0} is not in the state".format(e))
+        pos = np.minimum(np.searchsorted(self._keys,keys),len(self._keys)-1)
+        if len(keys) > 0 and np.any(self._keys[pos] != keys):
+            bad = np.nonzero(self._keys[pos] != keys)[0][0]
+            raise KeyError("{0} is not in the state".format((compartments[bad],species[bad])))
+        return self._order[pos]
+
+class _CompartmentIndex(object):
+    # the entries of one compartment in a StateIndex
+
+    def __init__(self, index, code):
+        self._index = index
+        self._code = code
+        self._lo = int(index._starts[code])
+        self._hi = int(index._starts[code+1])
+        self._row = None
+
+    def _find(self, s):
+        idx = self._index
+        code = idx._species.get(s)
+        if code is None:
+            return None
+        # compartments hold few species, so a python list is faster
+        # than a binary search here
+        if self._row is None:
+            self._row = idx._row_species[self._lo:self._hi].tolist()
+        try:
+            pos = self._row.index(code)
+        except ValueError:
+            return None
+        return int(idx._order[self._lo + pos])
+
+    def __getitem__(self, s):
+        i = self._find(s)
+        if i is None:
+            raise KeyError(s)
+        return i
+
+    def __contains__(self, s):
+        return self._find(s) is not None
+
+    def get(self, s, default=None):
+        i = self._find(s)
+        return default if i is None else i
+
+    def keys(self):
+        idx = self._index
+        return [str(idx._species_names[k]) for k in idx._row_species[self._lo:self._hi]]
+
+    def values(self):
+        return self._index._order[self._lo:self._hi].tolist()
+
+    def items(self):
+        return list(zip(self.keys(),self.values()))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return self._hi - self._lo
 
 class State(object):
-    def __init__(self, model=None, dataframe=None, units=[unit.nanometer]*3):
+    def __init__(self, model=None, dataframe=None, units=None, ordering='compartment',
+                 position_dtype=np.float64):
         """State objects can be initialized using either a 
         FlatModel or a dataframe object.  At minimum, the 
         dataframe needs to have "species" and "compartment" 
-        columns."""
+        columns.
+
+        When initialized from a FlatModel, the ordering argument
+        controls the layout of the state vector:
+
+        'compartment' : the species of a compartment are adjacent, with
+                        compartments in the order of the model
+        'species'     : all entries of a given species are adjacent
+        'rcm'         : reverse Cuthill-McKee ordering of the graph of 
+                        connections, which minimizes the bandwidth of 
+                        the Jacobian
+
+        In all cases, species are sorted by ID within a compartment.
+        The ordering that was used is stored in state.ordering.
 
-        self.index = {}
+        units are the units of the x, y and z positions (default: nm),
+        and position_dtype is their dtype (np.float32 halves their 
+        memory)."""
+
+        self.position_dtype = position_dtype
+        if units is None:
+            units = [unit.nanometer]*3
         self.units = units
+        self.ordering = None
         
         if model is not None: 
             assert isinstance(model,FlatModel), "Error! A state object needs a FlatModel to initialize."
-            self._init_from_model(model)
+            self._init_from_model(model,ordering)
         elif dataframe is not None:
             if 'species' not in dataframe.columns or 'compartment' not in dataframe.columns:
                 raise ValueError("Error! dataframe must contain columns for 'species' and 'compartment'")
             self._init_from_df(dataframe)        
         
-        self.size = len(self.compartment)
+        self.index = StateIndex(self.compartment_names,self.compartment_codes,
+                                self.species_names,self.species_codes)
+        self.size = len(self.compartment_codes)
         self.q_val = np.zeros((self.size))
+        self._selection = None
 
-    def _init_from_model(self, model):
-        
-        big_species_list = []
-        big_comp_list = []
-        big_x_list = []
-        big_y_list = []
-        big_z_list = []
+    @property
+    def species(self):
+        """The species ID of each entry.  This builds a new array on
+        every access: for single entries, use 
+        species_names[species_codes[i]] instead."""
+        return self.species_names[self.species_codes]
 
-        running_index = 0        
-        for c_tag, c in model.compartments.items():
+    @property
+    def compartment(self):
+        """The compartment ID of each entry (a new array on every 
+        access, see species)."""
+        return self.compartment_names[self.compartment_codes]
 
-            self.index[c_tag] = {}
-            
-            # figure out which species are associated with this compartment
+    @property
+    def selection(self):
+        """The SelectionIndex of this state, which is built on first
+        use (see openrxn.systems.selection)."""
+        if self._selection is None:
+            self._selection = SelectionIndex(self)
+        return self._selection
+
+    def select(self, species=None, compartments=None, box=None, sphere=None, slab=None):
+        """Returns a sorted array with the indexes of the entries that 
+        satisfy all of the given conditions, e.g.:
+
+        state.select(species='drug', slab=('z', 23, 25))
+
+        (see SelectionIndex.select)"""
+        return self.selection.select(species,compartments,box,sphere,slab)
+
+    def _init_from_model(self, model, ordering):
+
+        # figure out which species are associated with each compartment
+        comp_species = {}
+        comp_pos = {}
+        for c_tag, c in model.compartments.items():
             spec = []
             for other_c, conn in c.connections.items():
                 spec += list(conn[1].species_rates.keys())
             for rxn in c.reactions:
                 spec += rxn.reactant_IDs
                 spec += rxn.product_IDs
-            spec_set = set(spec)
-
-            for i,s in enumerate(spec_set):
-                self.index[c_tag][s] = running_index + i
-
-            running_index += len(spec_set)
-
-            big_species_list += list(spec_set)
-            big_comp_list += [c.ID]*len(spec_set)
+            comp_species[c_tag] = sorted(set(spec))
 
             # for x, y and z, average the boundary values
             x = [None,None,None]
             for i in range(len(c.pos)):
                 x[i] = 0.5*(c.pos[i][0]+c.pos[i][1]).to(self.units[i]).magnitude
-            
-            big_x_list += [x[0]]*len(spec_set)
-            big_y_list += [x[1]]*len(spec_set)
-            big_z_list += [x[2]]*len(spec_set)
+            comp_pos[c_tag] = x
+
+        # compartment-major ordering
+        entries = [(c_tag,s) for c_tag in model.compartments for s in comp_species[c_tag]]
+
+        if ordering == 'species':
+            species_list = sorted(set([s for c_tag,s in entries]))
+            rank = {s:i for i,s in enumerate(species_list)}
+            entries.sort(key=lambda e: rank[e[1]])
+        elif ordering == 'rcm':
+            perm = self._rcm_permutation(model,entries)
+            entries = [entries[i] for i in perm]
+        elif ordering != 'compartment':
+            raise ValueError("Error! ordering must be one of 'compartment', 'species' or 'rcm' ({0})".format(ordering))
+        self.ordering = ordering
 
-        self.species = np.array(big_species_list)
-        self.compartment = np.array(big_comp_list)
-        self.x_pos = np.array(big_x_list)
-        self.y_pos = np.array(big_y_list)
-        self.z_pos = np.array(big_z_list)
+        # all compartments of the model are in the table, including
+        # those without any species
+        comp_tags = list(model.compartments.keys())
+        comp_code = {c_tag:k for k,c_tag in enumerate(comp_tags)}
+        self.species_names = np.array(sorted(set([s for c_tag,s in entries])),dtype=str)
+        spec_code = {s:k for k,s in enumerate(self.species_names)}
+        self.compartment_names = np.array(comp_tags,dtype=str)
+
+        n = len(entries)
+        self.compartment_codes = np.fromiter((comp_code[c_tag] for c_tag,s in entries),
+                                             dtype=np.int32,count=n)
+        self.species_codes = np.fromiter((spec_code[s] for c_tag,s in entries),
+                                         dtype=np.int32,count=n)
+
+        # positions are stored per compartment, then expanded
+        comp_xyz = np.array([comp_pos[c_tag] for c_tag in comp_tags],dtype=float).reshape(-1,3)
+        xyz = comp_xyz[self.compartment_codes].astype(self.position_dtype)
+        self.x_pos = xyz[:,0].copy()
+        self.y_pos = xyz[:,1].copy()
+        self.z_pos = xyz[:,2].copy()
+
+    def _rcm_permutation(self, model, entries):
+        # reverse Cuthill-McKee ordering of the graph where the species 
+        # in a compartment are connected to each other, and to the same 
+        # species in connected compartments
+        from scipy import sparse
+        from scipy.sparse.csgraph import reverse_cuthill_mckee
+
+        pos = {e:i for i,e in enumerate(entries)}
+        rows = []
+        cols = []
+        by_comp = {}
+        for i,(c_tag,s) in enumerate(entries):
+            by_comp.setdefault(c_tag,[]).append(i)
+        for c_tag, idxs in by_comp.items():
+            rows += [i for i in idxs for j in idxs]
+            cols += [j for i in idxs for j in idxs]
+            for other_c, conn in model.compartments[c_tag].connections.items():
+                for s in conn[1].species_rates.keys():
+                    if (other_c,s) in pos:
+                        rows.append(pos[(c_tag,s)])
+                        cols.append(pos[(other_c,s)])
+
+        n = len(entries)
+        graph = sparse.csr_matrix((np.ones(len(rows)),(rows,cols)),shape=(n,n))
+        graph = graph + graph.T
+        return reverse_cuthill_mckee(graph.tocsr(),symmetric_mode=True)
 
     def _init_from_df(self, df):
 
         # assign columns to self arrays
-        self.species = np.array(df['species'])
-        self.compartment = np.array(df['compartment'])
-        if 'x_pos' in df.columns:
-            self.x_pos = np.array(df['x_pos'])
-        if 'y_pos' in df.columns:
-            self.y_pos = np.array(df['y_pos'])
-        if 'z_pos' in df.columns:
-            self.z_pos = np.array(df['z_pos'])
-
-        # building self.index dictionary
-        for i in range(len(df['species'])):
-            if df['compartment'][i] not in self.index:
-                self.index[df['compartment'][i]] = {}
-            self.index[df['compartment'][i]][df['species'][i]] = i
+        names, codes = np.unique(np.asarray(df['species'],dtype=str),return_inverse=True)
+        self.species_names, self.species_codes = names, codes.astype(np.int32)
+        names, codes = np.unique(np.asarray(df['compartment'],dtype=str),return_inverse=True)
+        self.compartment_names, self.compartment_codes = names, codes.astype(np.int32)
+        for name in ['x_pos','y_pos','z_pos']:
+            if name in df.columns:
+                setattr(self,name,np.asarray(df[name],dtype=float).astype(self.position_dtype))
 
     def to_dataframe(self):
+        # pandas is only needed here
+        import pandas as pd
+
         df = pd.DataFrame()
         
-        df['species'] = self.species
-        df['compartment'] = self.compartment
+        df['species'] = pd.Categorical.from_codes(self.species_codes,categories=self.species_names)
+        df['compartment'] = pd.Categorical.from_codes(self.compartment_codes,
+                                                      categories=self.compartment_names)
         df['q_val'] = self.q_val
         
         if hasattr(self,'x_pos'):
@@ -4,8 +4,9 @@ in system.state .
 A system is moved forward in time with the system.propagate()
 function.
 
-In detail, all systems use a list of functions (system.dqdt), 
-where system.dqdt[i] returns the rate of change of quantity i.
+In detail, ODE systems use a MassActionNetwork (system.dqdt), 
+where system.dqdt.rhs(q,t) returns the rate of change of all 
+quantities, and Gillespie systems use a list of processes.
 
 The system need not store the values of every species in every 
 compartment.  Reporter functions can be attached to system objects
@@ -13,20 +14,36 @@ which can return the sum or average the concentrations in different
 sets of compartments.  Reporters can also be configured to return 
 ALL of the data and this is enabled by default.
 
+Events (see openrxn.systems.events) can also be attached to systems,
+to record the times at which linear combinations of quantities cross
+a threshold, and to stop runs early.
+
+Long runs can write checkpoints, and be continued from them with
+System.resume (see openrxn.systems.checkpoint).
+
 After running, results (a.k.a. the reports from the reporters) are 
 stored in system.results."""
 
 from openrxn import unit
 from openrxn.systems.state import State
+from openrxn.systems.profiler import NULL_PHASE
+from openrxn.systems.checkpoint import write_checkpoint, read_checkpoint
 
 import numpy as np
 import logging
+import time
 
 EPSILON = 1e-8
 
 class System(object):
 
-    def __init__(self, flatmodel, init_state=None, reporters=[]):
+    NA = 6.022e23
+
+    # if True, quantities are numbers of molecules that are rounded
+    # by default when they are set (see set_q_array)
+    integer_q = False
+
+    def __init__(self, flatmodel, init_state=None, reporters=[], ordering='compartment', events=[], profiler=None):
         """Systems must be initialized with FlatModel objects.
         initial states can be specified in the init_state argument,
         but care must be taken to ensure that this is compatible
@@ -41,25 +58,47 @@ class System(object):
         species_a_bottom_layer = np.where(np.logical_and(
                                     s.state.z_pos < 1, s.state.species == a.ID))
         s.state.set_q(species_a_bottom_layer, 1 * ureg.mol)
+
+        ordering sets the layout of the state vector when it is 
+        initialized from the model (see State).
+
+        profiler is an optional Profiler object that records the time
+        spent in each phase of building and running the system (see
+        openrxn.systems.profiler).
         """
 
         self.model = flatmodel
+        self.profiler = profiler
         
         if init_state != None:
             self.state = init_state
         else:
-            self.state = State(model=self.model)
+            with self._phase('state_init'):
+                self.state = State(model=self.model,ordering=ordering)
 
         self.reporters = []
         self.reporters += reporters
 
+        self.events = []
+        self.events += events
+        self.stop_time = None
+
+        self._volumes = None
+        self._run_state = None
+
     def add_reporter(self,reporter):
         self.reporters.append(reporter)
 
     def add_reporters(self,reporters):
         self.reporters += reporters
 
-    def run(self,total_time,**kwargs):
+    def add_event(self,event):
+        self.events.append(event)
+
+    def add_events(self,events):
+        self.events += events
+
+    def run(self,total_time,checkpoint=None,checkpoint_every=None,checkpoint_wall=None,**kwargs):
         """
         Runs the system forward in time using the system-specific
         self.propagate function,
@@ -71,36 +110,265 @@ class System(object):
         Note:  this function assumes that the initial state vector (q_val)
         has already been set, and that reporters have already been 
         defined and attached to the system.
+
+        If a terminal event occurs, the run stops at the time of the
+        event: the reporters are called with the state at this time, and
+        it is stored in self.stop_time (otherwise self.stop_time is None).
+
+        If a checkpoint path is given, a checkpoint is written there 
+        (see openrxn.systems.checkpoint) at the end of the propagation
+        intervals, so that the run can be continued with 
+        System.resume(checkpoint):
+
+        checkpoint_every : the simulation time between checkpoints.  
+                           These times are added to the ends of the 
+                           propagation intervals.  By default, a 
+                           checkpoint is written at every report.
+        checkpoint_wall  : the minimum wall clock time (in seconds) 
+                           between two checkpoints.
         """
 
-        report_freqs = [r.freq for r in self.reporters]
+        checkpoints = self._checkpoints(total_time)
+        checkpoint_times = None
+        if checkpoint_every is not None:
+            n = int(total_time/checkpoint_every) + 1
+            checkpoint_times = [checkpoint_every*i for i in range(1,n)]
+            checkpoints = sorted(set(checkpoints + checkpoint_times))
 
-        # add endpoints as default, even if reporters aren't present
-        checkpoints = [0,total_time]
-        for freq in report_freqs:
-            n = int(total_time/freq) + 1
-            checkpoints += [freq*i for i in range(n)]
+        for r in self.reporters:
+            r.reserve(r.times().shape[0] + int(total_time/r.freq) + 1)
 
-        checkpoints = list(set(checkpoints))
-        checkpoints.sort()
-        
-        for i in range(len(checkpoints)-1):
+        self._run_state = {'checkpoints' : checkpoints,
+                           'next' : 1,
+                           'kwargs' : kwargs,
+                           'checkpoint' : checkpoint,
+                           'checkpoint_times' : checkpoint_times,
+                           'checkpoint_wall' : checkpoint_wall}
+        return self._run_intervals()
+
+    @classmethod
+    def resume(cls,path,profiler=None):
+        """Continues the run that wrote the checkpoint at path, and
+        returns the system and the result of the last propagate call.
+        The system is not rebuilt from its model.  Checkpoints keep 
+        being written to the same path."""
+
+        data = read_checkpoint(path)
+        system = data['system']
+        system.profiler = profiler
+        np.random.set_state(data['rng'])
+        logging.info("Resuming from checkpoint: t = {0}".format(data['time']))
+
+        return system, system._run_intervals()
+
+    def _run_intervals(self):
+        # propagates through the remaining intervals of the run
+        run = self._run_state
+        checkpoints = run['checkpoints']
+        checkpoint_times = None
+        if run['checkpoint_times'] is not None:
+            checkpoint_times = set(run['checkpoint_times'])
+        last_write = time.perf_counter()
+        self.stop_time = None
+        result = None
+
+        for i in range(run['next']-1,len(checkpoints)-1):
             init_t = checkpoints[i]
             final_t = checkpoints[i+1]
             
-            result = self.propagate((init_t,final_t),**kwargs)
+            with self._phase('propagate'):
+                result = self.propagate((init_t,final_t),**run['kwargs'])
             if 'final_t' in result:
                 checkpoints[i+1] = result['final_t']
 
+            if result.get('status') == 1:
+                # a terminal event occurred
+                self.stop_time = checkpoints[i+1]
+                logging.info("Terminal event: t = {0}".format(self.stop_time))
+                with self._phase('report'):
+                    for r in self.reporters:
+                        r.report(self.stop_time, self.state.q_val)
+                break
+
             logging.info("Reached checkpoint: t = {0}".format(checkpoints[i+1]))
             
+            with self._phase('report'):
+                for r in self.reporters:
+                    # check whether final_t is a multiple of r.freq
+                    if final_t/r.freq - int(final_t/r.freq) < EPSILON:
+                        r.report(checkpoints[i+1], self.state.q_val)
+
+            if run['checkpoint'] is not None and i+2 < len(checkpoints):
+                due = checkpoint_times is None or final_t in checkpoint_times
+                if due and run['checkpoint_wall'] is not None:
+                    due = time.perf_counter() - last_write >= run['checkpoint_wall']
+                if due:
+                    run['next'] = i+2
+                    with self._phase('checkpoint'):
+                        write_checkpoint(run['checkpoint'],self,run)
+                    last_write = time.perf_counter()
+
+        with self._phase('report'):
             for r in self.reporters:
-                # check whether final_t is a multiple of r.freq
-                if final_t/r.freq - int(final_t/r.freq) < EPSILON:
-                    r.report(checkpoints[i+1], self.state.q_val)
+                r.flush()
 
         return result
         
+    def _checkpoints(self,total_time):
+        """Returns a sorted list of the times at which the
+        reporters need to be called."""
+
+        report_freqs = [r.freq for r in self.reporters]
+
+        # add endpoints as default, even if reporters aren't present
+        checkpoints = [0,total_time]
+        for freq in report_freqs:
+            n = int(total_time/freq) + 1
+            checkpoints += [freq*i for i in range(n)]
+
+        checkpoints = list(set(checkpoints))
+        checkpoints.sort()
+
+        return checkpoints
+
+    def __getstate__(self):
+        # the profiler (which can hold hooks) is not pickled, e.g. in
+        # checkpoints
+        state = self.__dict__.copy()
+        state['profiler'] = None
+        return state
+        
+    def volumes(self):
+        """Returns an array with the volume of the compartment of each
+        quantity in the state vector (as a magnitude, in the units of
+        the compartment volume), or nan if the compartment has no volume.
+        This is computed once for each system."""
+
+        if self._volumes is None:
+            sel = self.state.selection
+            vols = np.full(len(sel.compartment_names),np.nan)
+            for k,c in enumerate(sel.compartment_names):
+                v = self.model.compartments[c].volume
+                if v is not None:
+                    vols[k] = v.magnitude if hasattr(v,'magnitude') else v
+            self._volumes = vols[sel.compartment_codes]
+        return self._volumes
+
+    def _cast_q(self,values,idxs):
+        """Converts values to numbers of molecules for the quantities
+        at idxs.  Values can be unitless (numbers of molecules), amounts
+        (e.g. mol) or concentrations (e.g. mol/L), which are multiplied 
+        by the compartment volumes.  The units are converted only once."""
+
+        if not hasattr(values,'units'):
+            return np.asarray(values,dtype=float)
+
+        if values.units == unit.dimensionless:
+            return np.asarray(values.magnitude,dtype=float)
+        elif values.check('[substance]'):
+            return np.asarray(values.to(unit.mol).magnitude,dtype=float)*self.NA
+        elif values.check('[substance]/[length]**3'):
+            vols = self.volumes()[idxs]
+            if np.any(np.isnan(vols)):
+                raise ValueError("Error! Concentrations can only be set in compartments with a volume")
+            return np.asarray(values.to(unit.mol/unit.L).magnitude,dtype=float)*vols*self.NA
+        else:
+            raise ValueError("Quantity values should be either amounts (e.g. mol), concentrations (e.g. mol/L) or dimensionless")
+
+    def set_q_array(self,values,idxs=None,sample=None):
+        """Sets the quantities at idxs (default: all) to values, which
+        is a scalar or an array with one value per index, either unitless
+        (numbers of molecules) or a Quantity (see _cast_q).
+
+        sample controls how the numbers of molecules are made integer:
+        None    : not at all (default for ODE systems)
+        'round' : rounded to the nearest integer (default for 
+                  Gillespie systems)
+        'poisson' : sampled from a Poisson distribution with the 
+                    given mean, using numpy.random"""
+
+        if idxs is None:
+            idxs = np.arange(self.state.size)
+        else:
+            idxs = np.asarray(idxs,dtype=int).ravel()
+
+        q = np.broadcast_to(self._cast_q(values,idxs),idxs.shape)
+        if sample is None and self.integer_q:
+            sample = 'round'
+
+        if sample == 'round':
+            q = np.rint(q)
+        elif sample == 'poisson':
+            q = np.random.poisson(q).astype(float)
+        elif sample is not None:
+            raise ValueError("Error! sample must be None, 'round' or 'poisson' ({0})".format(sample))
+
+        self.state.q_val[idxs] = q
+
+    def set_q_function(self,func,idxs=None,units=None,sample=None):
+        """Sets the quantities at idxs (default: all) using a vectorized 
+        function of the positions, func(x, y, z), where x, y and z are
+        the arrays state.x_pos, state.y_pos and state.z_pos at idxs
+        (nan for dimensions that a compartment does not have).  The 
+        returned array is multiplied by units, if given.
+
+        e.g. a linear gradient of drug along z:
+        sel = s.state.select(species='drug')
+        s.set_q_function(lambda x,y,z: 1e-3*z, sel, units=unit.mol/unit.L)"""
+
+        if idxs is None:
+            idxs = np.arange(self.state.size)
+        else:
+            idxs = np.asarray(idxs,dtype=int).ravel()
+
+        pos = []
+        for name in ['x_pos','y_pos','z_pos']:
+            p = getattr(self.state,name,None)
+            if p is None:
+                pos.append(np.full(len(idxs),np.nan))
+            else:
+                pos.append(np.asarray(p[idxs],dtype=float))
+
+        values = func(*pos)
+        if units is not None:
+            values = values*units
+        self.set_q_array(values,idxs,sample)
+
+    def set_q_dataframe(self,df,column='q_val',units=None,sample=None):
+        """Sets quantities from a pandas DataFrame, with one row per 
+        quantity.  The rows are identified by 'compartment' and 'species'
+        columns, or by a (compartment, species) MultiIndex.  The values 
+        are taken from column, and multiplied by units, if given."""
+
+        if 'compartment' in df.columns and 'species' in df.columns:
+            comps, species = list(df['compartment']), list(df['species'])
+        else:
+            comps = list(df.index.get_level_values(0))
+            species = list(df.index.get_level_values(1))
+        try:
+            idxs = self.state.index.lookup(comps,species)
+        except KeyError as e:
+            raise ValueError("Error! {0} is not in the state".format(e))
+
+        values = np.asarray(df[column],dtype=float)
+        if units is not None:
+            values = values*units
+        self.set_q_array(values,idxs,sample)
+
+    def _phase(self,name):
+        """Returns a context manager that times the named phase if
+        a profiler is attached."""
+        if self.profiler is None:
+            return NULL_PHASE
+        return self.profiler.phase(name)
+
+    def _record_events(self,t_events):
+        """Appends the times in t_events (a list with an array of times
+        for each event in self.events) to the events."""
+
+        for e, times in zip(self.events,t_events):
+            e.times += [float(t) for t in times]
+
     def propagate(self,**kwargs):
         raise NotImplementedError
         